@@ -0,0 +1,194 @@
+"""
+Bulk inference of a pruning model (any infer.py --arch) over unlabelled images.
+
+The image paths are streamed from a directory walk (in sorted order) or from a manifest file
+with one path per line, decoded by a bounded pool of --workers threads and run through the model
+in batches of --batch-size. Every image gets one output row with its top-k classes and
+probabilities and the number of tokens it kept at every pruning stage; images that can not be
+read get a row with the error instead.
+
+The rows are written in chunks of --chunk-size images to <output>/part-<n>.jsonl (or .parquet,
+which needs pyarrow), each chunk renamed into place only once it is complete. Running the same
+command again skips the completed chunks without decoding their images and continues with the
+first missing one.
+
+    python bulk_infer.py --arch deit_small --model-path model.pth --source /data/images --output preds --batch-size 128 --workers 8
+"""
+import argparse
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import torch
+from PIL import Image
+
+from datasets import build_transform
+import infer
+
+
+IMG_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.ppm', '.bmp', '.pgm', '.tif', '.tiff', '.webp')
+
+
+def iter_directory(root):
+    """ image files under root, in the same sorted order on every run """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(IMG_EXTENSIONS):
+                yield os.path.join(dirpath, name)
+
+
+def iter_manifest(path):
+    """ paths listed in a manifest file, one per line, blank lines and # comments skipped """
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def iter_source(source):
+    return iter_directory(source) if os.path.isdir(source) else iter_manifest(source)
+
+
+def iter_chunks(paths, chunk_size):
+    paths = iter(paths)
+    while True:
+        chunk = list(islice(paths, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def decode_images(paths, transform, workers):
+    """ (path, image tensor or exception) in the order of paths, at most 4 x workers images in flight """
+    def load(path):
+        try:
+            with Image.open(path) as img:
+                return transform(img.convert('RGB'))
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(load, path)))
+            if len(pending) >= 4 * workers:
+                path, future = pending.popleft()
+                yield path, future.result()
+        for path, future in pending:
+            yield path, future.result()
+
+
+def predict(model, images, topk, args, device):
+    """ top-k (probabilities, classes) and the (B, stages) kept tokens of a batch of images """
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    with infer.inference_mode():
+        with infer.autocast(args, device):
+            output = model(torch.stack(images).to(device, memory_format=memory_format))
+        logits, telemetry = output if isinstance(output, (tuple, list)) else (output, None)
+        prob, index = logits.float().softmax(dim=-1).topk(topk, dim=-1)
+        if telemetry is not None and telemetry.keep_decision:
+            kept = torch.stack([keep.sum(dim=1) for keep in telemetry.keep_decision], dim=1)
+        else:
+            kept = torch.zeros(len(images), 0)
+    return prob.cpu().tolist(), index.cpu().tolist(), kept.long().cpu().tolist()
+
+
+def run_chunk(model, paths, transform, args, device):
+    """ output rows of one chunk of paths, in the order of paths """
+    rows, batch = [], []
+
+    def flush():
+        probs, indices, kept = predict(model, [image for _, image in batch], args.topk, args, device)
+        for (row, _), prob, index, keep in zip(batch, probs, indices, kept):
+            row.update(topk=[[i, round(p, 6)] for i, p in zip(index, prob)], kept_tokens=keep)
+        del batch[:]
+
+    for path, image in decode_images(paths, transform, args.workers):
+        rows.append({'path': path})
+        if isinstance(image, Exception):
+            rows[-1]['error'] = str(image)
+            continue
+        batch.append((rows[-1], image))
+        if len(batch) == args.batch_size:
+            flush()
+    if batch:
+        flush()
+    return rows
+
+
+def write_chunk(rows, path, output_format):
+    """ writes to a temporary file and renames it, so a chunk file on disk is always complete """
+    tmp = path + '.tmp'
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        columns = {k: [row.get(k) for row in rows] for k in ('path', 'topk', 'kept_tokens', 'error')}
+        pq.write_table(pa.table(columns), tmp)
+    else:
+        with open(tmp, 'w') as f:
+            for row in rows:
+                f.write(json.dumps(row) + '\n')
+    os.replace(tmp, path)
+
+
+def check_output(args):
+    """ writes <output>/meta.json on the first run and checks that a resumed run chunks the same source the same way """
+    os.makedirs(args.output, exist_ok=True)
+    meta = {'source': os.path.abspath(args.source), 'chunk_size': args.chunk_size, 'arch': args.arch,
+            'model_path': args.model_path, 'input_size': args.input_size, 'format': args.output_format}
+    path = os.path.join(args.output, 'meta.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            old = json.load(f)
+        for k in ('source', 'chunk_size', 'format'):
+            assert old[k] == meta[k], 'can not resume {}: it was written with {} {}, not {}'.format(
+                args.output, k, old[k], meta[k])
+    else:
+        with open(path, 'w') as f:
+            json.dump(meta, f, indent=2)
+
+
+def chunk_path(args, index):
+    return os.path.join(args.output, 'part-{:05d}.{}'.format(index, args.output_format))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Bulk inference', add_help=False)
+    parser.add_argument('--source', required=True, type=str,
+                        help='directory to walk for images, or a manifest file with one image path per line')
+    parser.add_argument('--output', required=True, type=str, help='directory of the output chunks')
+    parser.add_argument('--output-format', default='jsonl', choices=['jsonl', 'parquet'], type=str)
+    parser.add_argument('--chunk-size', default=10000, type=int, help='images per output chunk')
+    parser.add_argument('--workers', default=8, type=int, help='threads decoding and transforming the images')
+    parser.add_argument('--topk', default=5, type=int)
+    return parser
+
+
+def main(args):
+    device = infer.setup_runtime(args)
+    assert args.model_path, '--model-path is required'
+    check_output(args)
+    model = infer.build_model(args, device)
+    transform = build_transform(False, args)
+
+    num_images = num_done = 0
+    for index, paths in enumerate(iter_chunks(iter_source(args.source), args.chunk_size)):
+        path = chunk_path(args, index)
+        if os.path.exists(path):
+            num_done += len(paths)
+            continue
+        rows = run_chunk(model, paths, transform, args, device)
+        write_chunk(rows, path, args.output_format)
+        num_images += len(rows)
+        print('chunk {}: {} images, {} errors -> {}'.format(index, len(rows), sum('error' in r for r in rows), path))
+    print('## {} images scored, {} already done in completed chunks'.format(num_images, num_done))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Bulk inference', parents=[get_args_parser(), infer.get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -79,12 +79,7 @@ def evaluate(data_loader, model, device):
 
     # switch to evaluation mode
     model.eval()
-    zero_0 = 0
-    unzero_0 = 0
-    zero_1 = 0
-    unzero_1 = 0
-    zero_2 = 0
-    unzero_2 = 0
+    telemetry = utils.PruningTelemetry() # summed on the device, read once at the end
 
     for images, target in metric_logger.log_every(data_loader, 10, header):
         images = images.to(device, non_blocking=True)
@@ -97,12 +92,7 @@ def evaluate(data_loader, model, device):
             loss = criterion(output, target)
 
         acc1, acc5 = accuracy(output, target, topk=(1, 5))
-        zero_0 +=sparse[0][0]
-        unzero_0 +=sparse[0][1]
-        zero_1 +=sparse[1][0]
-        unzero_1 +=sparse[1][1]
-        zero_2 +=sparse[2][0]
-        unzero_2 +=sparse[2][1]
+        telemetry.update(sparse)
 
 
         batch_size = images.shape[0]
@@ -111,9 +101,13 @@ def evaluate(data_loader, model, device):
         metric_logger.meters['acc5'].update(acc5.item(), n=batch_size)
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
+    telemetry.synchronize_between_processes()
 
-    print('Sparsity0:{},Sparsity1:{},Sparsity2:{},'.format(zero_0/(zero_0+unzero_0),zero_1/(zero_1+unzero_1),zero_2/(zero_2+unzero_2)))
+    pruning_stats = telemetry.summary()
+    print(''.join('{}:{},'.format(k.capitalize(), v) for k, v in pruning_stats.items()))
     print('* Acc@1 {top1.global_avg:.3f} Acc@5 {top5.global_avg:.3f} loss {losses.global_avg:.3f}'
           .format(top1=metric_logger.acc1, top5=metric_logger.acc5, losses=metric_logger.loss))
 
-    return {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats = {k: meter.global_avg for k, meter in metric_logger.meters.items()}
+    stats.update(pruning_stats)
+    return stats
@@ -0,0 +1,294 @@
+"""
+Export a trained VisionTransformerDiffPruning (vit_l2_3keep_senet) to a static inference graph.
+
+The exported model keeps a fixed fraction of the tokens at every pruning location (the
+budget='topk' inference mode in compact form), so the forward is pure tensor code: no policy
+masks, score files, telemetry or python-side bookkeeping. Token selection is topk + gather, which
+become TopK / GatherElements in ONNX. The result is a TorchScript file that loads with
+torch.jit.load, or an ONNX file with dynamic batch and image size axes for ONNX Runtime, in a
+process that does not have this repository.
+
+LVViTDiffPruning has no compact forward (its aux head pools over the dropped tokens as well),
+so it can not be exported this way.
+
+    python export.py --arch deit_small --base_rate 0.7 --model-path checkpoint_best.pth --output deit_small_0.7.pt
+    python export.py --arch deit_small --base_rate 0.7 --model-path checkpoint_best.pth --format onnx --check
+"""
+import argparse
+import inspect
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+from utils import interpolate_pos_embed, topk_keep_index
+from vit_l2_3keep_senet import VisionTransformerDiffPruning
+
+
+class StaticAttention(nn.Module):
+    def __init__(self, attn):
+        super().__init__()
+        self.num_heads = attn.num_heads
+        self.head_dim = attn.qkv.out_features // (3 * attn.num_heads)
+        self.scale = attn.scale
+        self.qkv = attn.qkv
+        self.proj = attn.proj
+
+    def forward(self, x):
+        B, N, C = x.shape
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        attn = (q @ k.transpose(-2, -1)) * self.scale
+        x = (attn.softmax(dim=-1) @ v).transpose(1, 2).reshape(B, N, self.num_heads * self.head_dim)
+        return self.proj(x)
+
+
+class StaticBlock(nn.Module):
+    def __init__(self, block):
+        super().__init__()
+        self.norm1 = block.norm1
+        self.attn = StaticAttention(block.attn)
+        self.norm2 = block.norm2
+        self.mlp = block.mlp
+
+    def forward(self, x):
+        x = x + self.attn(self.norm1(x))
+        x = x + self.mlp(self.norm2(x))
+        return x
+
+
+class StaticPredictor(nn.Module):
+    """ MultiheadPredictorLG for a policy of all ones, which is what the compact topk forward feeds it
+
+    Returns the keep log-score (for the top-k) and the keep softmax score (for the representative token).
+    """
+    def __init__(self, predictor):
+        super().__init__()
+        self.num_heads = predictor.num_heads
+        self.senet = predictor.senet
+        self.in_conv = predictor.in_conv[0]
+        fc = predictor.out_conv[0][0]
+        half = fc.in_features // 2
+        self.local_fc = nn.Linear(half, fc.out_features)
+        self.global_fc = nn.Linear(half, fc.out_features, bias=False)
+        with torch.no_grad():
+            self.local_fc.weight.copy_(fc.weight[:, :half])
+            self.local_fc.bias.copy_(fc.bias)
+            self.global_fc.weight.copy_(fc.weight[:, half:])
+        self.out_conv = nn.Sequential(*list(predictor.out_conv[0])[1:])
+
+    def forward(self, x):
+        B, N, C = x.shape
+        x = x.reshape(B, N, self.num_heads, C // self.num_heads)
+        head_weights = self.senet(x.mean(dim=-1)).unsqueeze(3)
+        head_weights_sum = head_weights.sum(dim=2)
+        x = self.in_conv(x)
+        half = x.size(-1) // 2
+        x = self.local_fc(x[..., :half]) + self.global_fc(x[..., half:].mean(dim=1, keepdim=True))
+        score = torch.log_softmax(self.out_conv(x), dim=-1)
+        keep_score = (score * head_weights).sum(dim=2) / head_weights_sum
+        softmax_score = (score.exp() * head_weights).sum(dim=2) / head_weights_sum
+        return keep_score[:, :, 0], softmax_score[:, :, 0]
+
+
+class StaticPruneBlock(nn.Module):
+    """ one pruning location: keep the int(init_n * token_ratio) best spatial tokens, merge the dropped
+    ones into a new representative token appended after the existing num_rep ones, then run the block
+
+    init_n is the number of patches of the input, position the (B, N) original position of every
+    spatial slot (the top-k tie-break of topk_keep_index), both follow the input size at runtime.
+    The keep counts are looked up in a table of inputs up to max_patches patches: onnx would
+    compute a python float product in float32, which does not always round like the eager float64
+    int(init_n * token_ratio) (int(100 * 0.7 ** 2) is 48).
+    """
+    def __init__(self, block, predictor, token_ratio, num_rep, nan=1e-8, max_patches=4096):
+        super().__init__()
+        self.predictor = StaticPredictor(predictor)
+        self.block = StaticBlock(block)
+        self.register_buffer('keep_count', torch.tensor([int(n * token_ratio) for n in range(max_patches + 1)]))
+        self.num_rep = num_rep
+        self.nan = nan
+
+    def forward(self, x, position, init_n: int):
+        B, N, C = x.shape
+        spatial_x = x[:, 1:]
+        num_slots = N - 1 - self.num_rep
+        num_keep = int(self.keep_count[init_n])
+        keep_score, softmax_score = self.predictor(spatial_x)
+        index = topk_keep_index(keep_score[:, :num_slots], num_keep, position)
+        drop = torch.ones(B, num_slots, dtype=x.dtype, device=x.device).scatter(1, index, 0.)
+        placeholder_score = (softmax_score[:, :num_slots] * drop).unsqueeze(-1)
+        represent_token = torch.sum(spatial_x[:, :num_slots] * placeholder_score, dim=1, keepdim=True)
+        represent_token = torch.nan_to_num(represent_token, nan=self.nan)
+        kept = torch.gather(spatial_x[:, :num_slots], 1, index.unsqueeze(-1).expand(-1, -1, C))
+        x = torch.cat([x[:, :1], kept, spatial_x[:, num_slots:], represent_token], dim=1)
+        return self.block(x), torch.gather(position, 1, index)
+
+
+class StaticPrunedViT(nn.Module):
+    """ pure tensor inference graph of a VisionTransformerDiffPruning with a fixed keep budget
+
+    Same computation as the model's compact forward with budget='topk': at pruning location p it
+    keeps int(num_patches * token_ratio[p]) tokens of every image, where num_patches follows the
+    input size (pos_embed is resized like PosEmbedCache does), up to 4096 patches (1024 x 1024
+    images with 16 x 16 patches). Returns the logits and the
+    (stages, B, num_patches) 0/1 keep decisions at the original token positions, the stacked
+    telemetry.keep_decision of the eager forward.
+    """
+    def __init__(self, model, token_ratio=None, nan=1e-8):
+        super().__init__()
+        token_ratio = token_ratio or model.token_ratio
+        self.patch_proj = model.patch_embed.proj
+        self.cls_token = model.cls_token
+        self.pos_embed = model.pos_embed
+        self.grid = list(model.pos_embed_cache.grid)
+        blocks = []
+        for i, block in enumerate(model.blocks):
+            if i in model.pruning_loc:
+                p = model.pruning_loc.index(i)
+                blocks.append(StaticPruneBlock(block, model.score_predictor[p], token_ratio[p], p, nan))
+            else:
+                blocks.append(StaticBlock(block))
+        self.blocks = nn.ModuleList(blocks)
+        self.norm = model.norm
+        self.pre_logits = model.pre_logits
+        self.head = model.head
+
+    def forward(self, x):
+        x = self.patch_proj(x)
+        grid = [x.size(2), x.size(3)]
+        x = x.flatten(2).transpose(1, 2)
+        init_n = x.size(1)
+        x = torch.cat([self.cls_token.expand(x.size(0), -1, -1), x], dim=1)
+        x = x + interpolate_pos_embed(self.pos_embed, self.grid, grid) # exact copy at the training grid
+        position = torch.arange(init_n, device=x.device).view(1, init_n).expand(x.size(0), init_n)
+        keep_decision = []
+        for blk in self.blocks:
+            if isinstance(blk, StaticPruneBlock):
+                x, position = blk(x, position, init_n)
+                keep_decision.append(torch.zeros(x.size(0), init_n, dtype=x.dtype, device=x.device).scatter(1, position, 1.))
+            else:
+                x = blk(x)
+        x = self.norm(x)
+        return self.head(self.pre_logits(x[:, 0])), torch.stack(keep_decision)
+
+
+def static_graph(model):
+    return StaticPrunedViT(model).eval()
+
+
+def export_torchscript(model, path, example, freeze=True):
+    """ script the static graph, optionally freeze it (folds the weights in for graph level fusion) and save """
+    scripted = torch.jit.script(static_graph(model))
+    if freeze:
+        scripted = torch.jit.freeze(scripted)
+    with torch.no_grad():
+        scripted(example) # runs the profiling executor once so the saved graph is already specialized
+    torch.jit.save(scripted, path)
+    return scripted
+
+
+def export_onnx(model, path, example, opset_version=13):
+    """ script the static graph and export it to ONNX with dynamic batch, height and width axes
+
+    The graph is scripted rather than traced, so the keep counts int(num_patches * token_ratio)
+    and the pos_embed resize are computed from the input size at runtime instead of being
+    frozen to the size of the example.
+    """
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False # the TorchScript based exporter keeps dynamic_axes and needs no onnxscript
+    with torch.no_grad():
+        torch.onnx.export(torch.jit.script(static_graph(model)), example, path, input_names=['images'],
+                          output_names=['logits', 'keep_decision'],
+                          dynamic_axes={'images': {0: 'batch', 2: 'height', 3: 'width'}, 'logits': {0: 'batch'},
+                                        'keep_decision': {1: 'batch', 2: 'num_patches'}},
+                          opset_version=opset_version, do_constant_folding=True, **kwargs)
+
+
+def run_onnx(path, images):
+    """ logits and keep decisions of an exported ONNX file on ONNX Runtime CPU, needs the onnxruntime package """
+    import onnxruntime
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    return tuple(torch.from_numpy(out) for out in session.run(['logits', 'keep_decision'], {'images': images.numpy()}))
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Static inference graph export', add_help=False)
+    parser.add_argument('--arch', default='deit_small', type=str, choices=['deit_small', 'deit_256'])
+    parser.add_argument('--base_rate', type=float, default=0.7)
+    parser.add_argument('--model-path', default='', help='checkpoint to export, random weights when empty')
+    parser.add_argument('--input-size', default=224, type=int)
+    parser.add_argument('--format', default='torchscript', choices=['torchscript', 'onnx'], type=str)
+    parser.add_argument('--opset', default=13, type=int, help='onnx opset version')
+    parser.add_argument('--output', default='', type=str, help='default: <arch>_<base_rate>.pt (.onnx)')
+    parser.add_argument('--no-freeze', action='store_false', dest='freeze', help='keep the weights as module attributes')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the exported graph with the compact topk forward of the eager model '
+                             'on a batch of random images (onnx: on onnxruntime)')
+    parser.add_argument('--check-batch-size', default=8, type=int,
+                        help='differs from the batch size of the export example to exercise the dynamic axis')
+    parser.add_argument('--check-input-size', default=None, type=int,
+                        help='image size of the check batch, default --input-size (exercises the dynamic height and width)')
+    parser.add_argument('--tolerance', default=1e-4, type=float,
+                        help='max abs logits difference the check accepts on the images that keep the same tokens')
+    return parser
+
+
+def main(args):
+    KEEP_RATE = [args.base_rate, args.base_rate ** 2, args.base_rate ** 3]
+    PRUNING_LOC = [3, 6, 9]
+    if args.arch == 'deit_small':
+        model = VisionTransformerDiffPruning(
+            patch_size=16, embed_dim=384, depth=12, num_heads=6, mlp_ratio=4, qkv_bias=True,
+            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE, inference_mode='compact', budget='topk')
+    elif args.arch == 'deit_256':
+        model = VisionTransformerDiffPruning(
+            patch_size=16, embed_dim=256, depth=12, num_heads=4, mlp_ratio=4, qkv_bias=True,
+            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE, inference_mode='compact', budget='topk')
+    else:
+        raise NotImplementedError
+    if args.model_path:
+        checkpoint = torch.load(args.model_path, map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+    model.eval()
+
+    example = torch.randn(2, 3, args.input_size, args.input_size)
+    if args.format == 'onnx':
+        output = args.output or '{}_{}.onnx'.format(args.arch, args.base_rate)
+        export_onnx(model, output, example, opset_version=args.opset)
+    else:
+        output = args.output or '{}_{}.pt'.format(args.arch, args.base_rate)
+        export_torchscript(model, output, example, freeze=args.freeze)
+    print('token_ratio =', KEEP_RATE, 'at layer', PRUNING_LOC, 'exported to', output)
+
+    if args.check:
+        check_size = args.check_input_size or args.input_size
+        images = torch.randn(args.check_batch_size, 3, check_size, check_size)
+        start = time.time()
+        if args.format == 'onnx':
+            logits, keep_decision = run_onnx(output, images)
+        else:
+            with torch.no_grad():
+                logits, keep_decision = torch.jit.load(output)(images)
+        print('load + first batch time {:.2f}s'.format(time.time() - start))
+        with torch.no_grad():
+            reference, telemetry = model(images)
+        # scores that tie up to rounding (random weights score every token about the same) can
+        # select different tokens in the two graphs, so the logits are only compared on the
+        # images that keep the same tokens at every stage
+        same = (keep_decision == torch.stack(telemetry.keep_decision)).all(dim=2).all(dim=0)
+        diff = (logits[same] - reference[same]).abs().max().item() if same.any() else 0.
+        agree = (logits.argmax(-1) == reference.argmax(-1)).float().mean().item()
+        print('same kept tokens as the eager compact topk forward on {}/{} images'.format(int(same.sum()), len(same)))
+        print('max abs difference on those: {:.2e}, top-1 agreement {:.1f}%'.format(diff, 100 * agree))
+        if diff > args.tolerance:
+            print('max abs difference is above the tolerance {:.1e}'.format(args.tolerance))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Static inference graph export', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
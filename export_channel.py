@@ -0,0 +1,98 @@
+"""
+Physically remove the channels a vit_channel model masked out with its PrunedLayer vectors.
+
+Every PrunedLayer multiplies the input of qkv, proj, fc1 or fc2 by a learned vector. slim_channels
+drops the channels whose value is (close to) zero, folds the remaining values into the next Linear
+and writes the result as a narrower dense model, traced to TorchScript so it loads with
+torch.jit.load without this repository.
+
+    python export_channel.py --arch deit_small --model-path checkpoint_best.pth --output deit_small_slim.pt --check
+"""
+import argparse
+import time
+
+import torch
+
+from vit_channel import VisionTransformerDiffPruning, slim_channels
+
+
+def num_params(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def time_forward(model, images, num_batches):
+    with torch.no_grad():
+        model(images)
+        start = time.time()
+        for _ in range(num_batches):
+            model(images)
+    return num_batches * images.size(0) / (time.time() - start)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Channel slimming export', add_help=False)
+    parser.add_argument('--arch', default='deit_small', type=str, choices=['deit_small', 'deit_256'])
+    parser.add_argument('--base_rate', type=float, default=0.7)
+    parser.add_argument('--model-path', default='', help='checkpoint to slim, random weights when empty')
+    parser.add_argument('--input-size', default=224, type=int)
+    parser.add_argument('--threshold', default=0., type=float,
+                        help='channels whose mask value is at most this in magnitude are removed')
+    parser.add_argument('--output', default='', type=str, help='default: <arch>_slim.pt')
+    parser.add_argument('--check', action='store_true',
+                        help='compare the slimmed model with the masked one on a batch of random images')
+    parser.add_argument('--benchmark', default=0, type=int, help='time this many batches before and after slimming')
+    parser.add_argument('--batch-size', default=16, type=int)
+    return parser
+
+
+def main(args):
+    KEEP_RATE = [args.base_rate, args.base_rate ** 2, args.base_rate ** 3]
+    PRUNING_LOC = [3, 6, 9]
+    if args.arch == 'deit_small':
+        model = VisionTransformerDiffPruning(
+            patch_size=16, embed_dim=384, depth=12, num_heads=6, mlp_ratio=4, qkv_bias=True,
+            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE)
+    elif args.arch == 'deit_256':
+        model = VisionTransformerDiffPruning(
+            patch_size=16, embed_dim=256, depth=12, num_heads=4, mlp_ratio=4, qkv_bias=True,
+            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE)
+    else:
+        raise NotImplementedError
+    if args.model_path:
+        checkpoint = torch.load(args.model_path, map_location='cpu')
+        model.load_state_dict(checkpoint['model'])
+    model.eval()
+
+    images = torch.randn(args.batch_size, 3, args.input_size, args.input_size)
+    with torch.no_grad():
+        reference = model(images)
+    before = num_params(model)
+    if args.benchmark:
+        speed = time_forward(model, images, args.benchmark)
+
+    slim_channels(model, args.threshold)
+    print('parameters: {:.2f}M -> {:.2f}M'.format(before / 1e6, num_params(model) / 1e6))
+    for i, blk in enumerate(model.blocks):
+        print('block {}: qkv {} -> {}, proj {} -> {}, fc1 {} -> {}, fc2 {} -> {}'.format(
+            i, blk.attn.qkv.in_features, blk.attn.qkv.out_features, blk.attn.proj.in_features,
+            blk.attn.proj.out_features, blk.mlp.fc1.in_features, blk.mlp.fc1.out_features,
+            blk.mlp.fc2.in_features, blk.mlp.fc2.out_features))
+
+    output = args.output or '{}_slim.pt'.format(args.arch)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, images, check_trace=False)
+    torch.jit.save(traced, output)
+    print('exported to', output)
+
+    if args.check:
+        with torch.no_grad():
+            diff = (torch.jit.load(output)(images) - reference).abs().max().item()
+        print('max abs difference to the masked model: {:.2e}'.format(diff))
+    if args.benchmark:
+        print('throughput {:.1f} -> {:.1f} img/s'.format(speed, time_forward(traced, images, args.benchmark)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Channel slimming export', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
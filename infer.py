@@ -2,6 +2,7 @@
 # All rights reserved.
 import argparse
 import datetime
+import os
 import numpy as np
 import time
 import torch
@@ -23,10 +24,14 @@ from engine import train_one_epoch, evaluate
 from losses import DistillationLoss
 from samplers import RASampler
 from functools import partial
+import utils
+import quantize
 
 
+import vit_l2_3keep_senet
+import lvvit_l2_3keep_senet
 from vit_l2_3keep_senet import VisionTransformerDiffPruning
-from lvvit import LVViTDiffPruning
+from lvvit_l2_3keep_senet import LVViTDiffPruning
 
 
 def get_args_parser():
@@ -50,22 +55,119 @@ def get_args_parser():
                         help='')
     parser.set_defaults(pin_mem=True)
     parser.add_argument('--base_rate', type=float, default=0.7)
+    parser.add_argument('--inference-mode', default='mask', choices=['mask', 'compact', 'packed'], type=str,
+                        help='mask: keep all tokens and mask attention, compact: physically drop pruned tokens, '
+                             'packed: also pack the kept tokens of all images into one sequence (deit only)')
+    parser.add_argument('--budget', default=None, choices=['topk'], type=str,
+                        help='topk: keep exactly token_ratio of the tokens in every image instead of sampling the decisions')
+    parser.add_argument('--budget-table', default='', type=str,
+                        help='json table of named keep budgets with precomputed score thresholds')
+    parser.add_argument('--budget-name', default='', type=str,
+                        help="run with this entry of --budget-table (budget 'threshold'), e.g. base_rate_0.5")
+    parser.add_argument('--calibrate-budgets', default='', type=str,
+                        help='comma separated base rates: calibrate their keep thresholds on --calib-batches batches of '
+                             'the validation set and write them to --budget-table')
+    parser.add_argument('--live-attention', action='store_true',
+                        help='only compute the attention rows of cls, kept and representative tokens')
+    parser.add_argument('--live-mlp', action='store_true',
+                        help='only run the MLP on cls, kept and representative tokens')
+    parser.add_argument('--attn-chunk-size', default=None, type=int,
+                        help='compute the attention in blocks of this many queries x keys with an online softmax, '
+                             'memory grows linearly with the number of tokens')
+    parser.add_argument('--rebucket', default=None, type=int,
+                        help='compact: after every pruning location run the images in buckets of this many with '
+                             'similar keep counts, so each bucket is only padded to its own largest keep count')
+    parser.add_argument('--print-freq', default=50, type=int,
+                        help='batches between progress lines, each one reads the meters back from the device')
+    parser.add_argument('--score-sample-rate', default=1.0, type=float,
+                        help='fraction of the forwards whose keep scores / decisions are recorded')
+
+    # runtime
+    parser.add_argument('--device', default=None, type=str,
+                        help='device to run on, cuda when available and cpu otherwise by default')
+    parser.add_argument('--threads', default=None, type=int, help='intra-op threads (torch.set_num_threads)')
+    parser.add_argument('--interop-threads', default=None, type=int,
+                        help='inter-op threads (torch.set_num_interop_threads)')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='run the patch embedding convolution and its input in channels_last')
+    parser.add_argument('--bf16', action='store_true', help='bfloat16 autocast')
+    parser.add_argument('--warmup', default=5, type=int,
+                        help='batches excluded from the throughput / latency numbers')
+    parser.add_argument('--benchmark', default=0, type=int,
+                        help='time this many batches of random images instead of running the validation set')
+    parser.add_argument('--bench-output', default='', type=str,
+                        help='append the benchmark result as a json line to this file')
+
+    # autotune
+    parser.add_argument('--autotune', action='store_true',
+                        help='sweep batch size x threads x inference mode on random images and write --profile')
+    parser.add_argument('--profile', default='', type=str,
+                        help='json profile written by --autotune, without --autotune its best configuration '
+                             'replaces --batch-size, --threads and --inference-mode')
+    parser.add_argument('--tune-batch-sizes', default='1,8,16,32,64', type=str)
+    parser.add_argument('--tune-threads', default='', type=str, help='default: 1, 2, 4, ... up to the core count')
+    parser.add_argument('--tune-modes', default='mask,compact', type=str)
+    parser.add_argument('--latency-budget', default=None, type=float,
+                        help='only configurations with a p99 batch latency below this many ms can be picked')
+
+    # int8 quantization
+    parser.add_argument('--quantize', default=None, choices=['dynamic', 'static'], type=str,
+                        help='INT8 quantize the block and predictor Linears (cpu), the validation set is then run '
+                             'by the float and the quantized model side by side')
+    parser.add_argument('--calib-batches', default=10, type=int,
+                        help='static / --calibrate-budgets: batches of a random subset of the validation set used to calibrate the activations')
+    parser.add_argument('--float-predictor', action='store_true',
+                        help='keep the score predictor Linears in float')
+
+    # multi-process cpu inference
+    parser.add_argument('--processes', default='', type=str,
+                        help='comma separated process counts: run each as that many cpu processes pinned to disjoint '
+                             'core sets, each on its shard of the validation set (or --benchmark), and report img/s')
 
     return parser
 
 
-def main(args):
+def setup_runtime(args):
+    """ threads and device, called before any parallel work so that the inter-op pool is still unset """
+    if args.interop_threads is not None:
+        torch.set_num_interop_threads(args.interop_threads)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    if device.type == 'cuda':
+        cudnn.benchmark = True
+    print('device: {}, intra-op threads: {}, inter-op threads: {}'.format(
+        device, torch.get_num_threads(), torch.get_num_interop_threads()))
+    return device
 
-    cudnn.benchmark = True
-    dataset_val, _ = build_dataset(is_train=False, args=args)
 
-    data_loader_val = torch.utils.data.DataLoader(
-        dataset_val,
-        batch_size=args.batch_size,
-        num_workers=args.num_workers,
-        pin_memory=args.pin_mem,
-        drop_last=False
-    )
+def prepare_model(model, args, device):
+    model = model.to(device).eval()
+    if args.channels_last:
+        model.patch_embed.to(memory_format=torch.channels_last)
+    return model
+
+
+def autocast(args, device):
+    if args.bf16:
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+    return torch.cuda.amp.autocast(enabled=False)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+# torch.inference_mode is only available from torch 1.9
+inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+
+
+def build_model(args, device):
+    """ pruning model of args.arch with the checkpoint and runtime options of args, in eval on device """
+    # set here so every process that builds a model (run_sharded workers, serve.py, bulk_infer.py) samples at this rate
+    vit_l2_3keep_senet.score_log.sample_rate = args.score_sample_rate
+    lvvit_l2_3keep_senet.score_log.sample_rate = args.score_sample_rate
 
     base_rate = args.base_rate
     KEEP_RATE = [base_rate, base_rate ** 2, base_rate ** 3]
@@ -76,7 +178,8 @@ def main(args):
         print('token_ratio =', KEEP_RATE, 'at layer', PRUNING_LOC)
         model = VisionTransformerDiffPruning(
             patch_size=16, embed_dim=384, depth=12, num_heads=6, mlp_ratio=4, qkv_bias=True, 
-            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE
+            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE, inference_mode=args.inference_mode, budget=args.budget,
+            live_attention=args.live_attention, live_mlp=args.live_mlp
             )
     elif args.arch == 'deit_256':
         PRUNING_LOC = [3,6,9] 
@@ -84,7 +187,8 @@ def main(args):
         print('token_ratio =', KEEP_RATE, 'at layer', PRUNING_LOC)
         model = VisionTransformerDiffPruning(
             patch_size=16, embed_dim=256, depth=12, num_heads=4, mlp_ratio=4, qkv_bias=True, 
-            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE
+            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE, inference_mode=args.inference_mode, budget=args.budget,
+            live_attention=args.live_attention, live_mlp=args.live_mlp
             )
     elif args.arch == 'lvvit_s':
         PRUNING_LOC = [4,8,12] 
@@ -93,7 +197,8 @@ def main(args):
         model = LVViTDiffPruning(
             patch_size=16, embed_dim=384, depth=16, num_heads=6, mlp_ratio=3.,
             p_emb='4_2',skip_lam=2., return_dense=True,mix_token=True,
-            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE
+            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE, inference_mode=args.inference_mode, budget=args.budget,
+            live_attention=args.live_attention, live_mlp=args.live_mlp
         )
     elif args.arch == 'lvvit_m':
         PRUNING_LOC = [5,10,15] 
@@ -102,24 +207,174 @@ def main(args):
         model = LVViTDiffPruning(
             patch_size=16, embed_dim=512, depth=20, num_heads=8, mlp_ratio=3.,
             p_emb='4_2',skip_lam=2., return_dense=True,mix_token=True,
-            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE
+            pruning_loc=PRUNING_LOC, token_ratio=KEEP_RATE, inference_mode=args.inference_mode, budget=args.budget,
+            live_attention=args.live_attention, live_mlp=args.live_mlp
         )
     else:
         raise NotImplementedError
 
+    model.attn_chunk_size = args.attn_chunk_size
+    model.rebucket = args.rebucket
+
     model_path = args.model_path
-    checkpoint = torch.load(model_path, map_location="cpu")
-    model.load_state_dict(checkpoint["model"])
+    if model_path:
+        checkpoint = torch.load(model_path, map_location="cpu")
+        model.load_state_dict(checkpoint["model"])
+        print('## model has been successfully loaded')
+
+    model = prepare_model(model, args, device)
+    if args.budget_table and not args.calibrate_budgets:
+        model.budget_table = utils.load_budget_table(args.budget_table)
+    if args.budget_name:
+        model.set_budget(args.budget_name)
+        print('## budget {}: token_ratio {}, threshold {}'.format(args.budget_name, model.token_ratio, model.keep_threshold))
+    return model
+
+
+def cpu_sets(num_processes):
+    """ num_processes disjoint lists of the cpus this process may run on, as even as possible """
+    cpus = sorted(os.sched_getaffinity(0))
+    if num_processes > len(cpus):
+        print('Warning: {} processes on {} cpus, the cpu sets overlap'.format(num_processes, len(cpus)))
+        return [[cpus[i % len(cpus)]] for i in range(num_processes)]
+    return [s.tolist() for s in np.array_split(np.array(cpus), num_processes)]
+
+
+def shard_worker(rank, num_processes, cpus, args, dataset, barrier, results):
+    """ one process of run_sharded: pinned to cpus, runs images rank, rank + num_processes, ... of dataset """
+    try:
+        os.sched_setaffinity(0, cpus)
+        args.device, args.interop_threads = 'cpu', 1
+        args.threads = args.threads or len(cpus)
+        device = setup_runtime(args)
+        model = build_model(args, device)
+        barrier.wait() # time the processes side by side, not their startup
+        if dataset is None:
+            latency = time_model(model, args.batch_size, args.benchmark, args, device)
+            results.put((rank, {'images': latency.images, 'seconds': float(np.sum(latency.times))}))
+            return
+        loader = torch.utils.data.DataLoader(
+            torch.utils.data.Subset(dataset, range(rank, len(dataset), num_processes)),
+            batch_size=args.batch_size, num_workers=args.num_workers // num_processes, drop_last=False)
+        totals = torch.zeros(3, dtype=torch.float64) # loss, acc1 and acc5 summed over the images
+        images_seen = 0
+        start = time.time()
+        with inference_mode():
+            for images, target in utils.Prefetcher(loader, device):
+                with autocast(args, device):
+                    output = model(images)
+                output = output[0] if isinstance(output, (tuple, list)) else output
+                output = output.float()
+                acc1, acc5 = accuracy(output, target, topk=(1, 5))
+                loss = torch.nn.functional.cross_entropy(output, target)
+                totals += torch.stack([loss, acc1[0], acc5[0]]).double() * images.size(0)
+                images_seen += images.size(0)
+        loss, acc1, acc5 = totals.tolist()
+        results.put((rank, {'images': images_seen, 'seconds': time.time() - start, 'loss': loss, 'acc1': acc1, 'acc5': acc5}))
+    except Exception as e:
+        barrier.abort()
+        results.put((rank, {'error': repr(e)}))
+
+
+def run_sharded(args):
+    """ runs every --processes count as pinned cpu processes and reports the aggregate img/s of each
+
+    The processes start together after all of them built their model. The aggregate throughput
+    is the total number of images over the time of the slowest process. With a dataset the
+    top-1 / top-5 accuracy and loss of the shards are merged as well.
+    """
+    import multiprocessing
+    ctx = multiprocessing.get_context('spawn') # the children set up their own thread pools
+    dataset = None
+    if not args.benchmark:
+        assert args.model_path, '--model-path is required to run the validation set'
+        dataset, _ = build_dataset(is_train=False, args=args)
+
+    summary = []
+    for num_processes in [int(p) for p in args.processes.split(',')]:
+        sets = cpu_sets(num_processes)
+        barrier, results = ctx.Barrier(num_processes), ctx.Queue()
+        procs = [ctx.Process(target=shard_worker, args=(rank, num_processes, cpus, args, dataset, barrier, results))
+                 for rank, cpus in enumerate(sets)]
+        for p in procs:
+            p.start()
+        shards = dict(results.get() for _ in procs)
+        for p in procs:
+            p.join()
+        errors = {rank: r['error'] for rank, r in shards.items() if 'error' in r}
+        assert not errors, 'worker processes failed: {}'.format(errors)
+
+        images = sum(r['images'] for r in shards.values())
+        result = {'arch': args.arch, 'processes': num_processes, 'threads': args.threads or len(sets[0]),
+                  'batch_size': args.batch_size, 'inference_mode': args.inference_mode, 'images': images,
+                  'throughput': images / max(r['seconds'] for r in shards.values())}
+        if dataset is not None:
+            result.update({k: sum(r[k] for r in shards.values()) / images for k in ('loss', 'acc1', 'acc5')})
+        print(' * {processes} processes x {threads} threads: {throughput:.1f} img/s'.format(**result),
+              ' Acc@1 {acc1:.3f} Acc@5 {acc5:.3f}'.format(**result) if dataset is not None else '')
+        if args.bench_output:
+            with open(args.bench_output, 'a') as f:
+                f.write(json.dumps(result) + '\n')
+        summary.append(result)
+
+    best = max(summary, key=lambda r: r['throughput'])
+    print('## fastest layout: {processes} processes x {threads} threads, {throughput:.1f} img/s'.format(**best))
+    return summary
 
-    print('## model has been successfully loaded')
 
-    model = model.cuda()
+def main(args):
+    if args.profile and not args.autotune:
+        best = utils.load_inference_profile(args.profile, args.arch, args.base_rate)
+        print('## using the profiled configuration', best)
+        args.batch_size, args.threads, args.inference_mode = best['batch_size'], best['threads'], best['inference_mode']
+    if args.processes:
+        run_sharded(args)
+        return
+    device = setup_runtime(args)
+
+    assert args.model_path or args.benchmark or args.autotune, '--model-path is required to run the validation set'
+    model = build_model(args, device)
+    if args.quantize:
+        assert device.type == 'cpu' and not args.bf16, 'the INT8 kernels run on cpu in float32 around the Linears'
 
     n_parameters = sum(p.numel() for p in model.parameters())
     print('number of params:', n_parameters)
 
-    criterion = torch.nn.CrossEntropyLoss().cuda()
-    validate(data_loader_val, model, criterion)
+    if args.quantize and (args.autotune or args.benchmark):
+        # only the speed is measured, so random images are good enough for the static calibration
+        calib_loader = [(torch.randn(args.batch_size, 3, args.input_size, args.input_size), None)] * args.calib_batches
+        model = quantize_model(model, calib_loader, args, device)
+    if args.autotune:
+        autotune(model, args, device)
+        return
+    if args.benchmark:
+        benchmark(model, args, device)
+        return
+
+    dataset_val, _ = build_dataset(is_train=False, args=args)
+    data_loader_val = torch.utils.data.DataLoader(
+        dataset_val,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_mem and device.type == 'cuda',
+        drop_last=False
+    )
+
+    criterion = torch.nn.CrossEntropyLoss().to(device)
+    calib_loader = torch.utils.data.DataLoader(
+        dataset_val,
+        batch_size=args.batch_size,
+        sampler=torch.utils.data.RandomSampler(dataset_val, generator=torch.Generator().manual_seed(args.seed)),
+        num_workers=args.num_workers,
+        drop_last=False
+    )
+    if args.calibrate_budgets:
+        calibrate_budgets(model, calib_loader, args, device)
+        return
+    if args.quantize:
+        compare_quantized(data_loader_val, model, quantize_model(model, calib_loader, args, device), args, device)
+        return
+    validate(data_loader_val, model, criterion, args, device)
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -160,6 +415,39 @@ class ProgressMeter(object):
         fmt = '{:' + str(num_digits) + 'd}'
         return '[' + fmt + '/' + fmt.format(num_batches) + ']'
 
+class LatencyMeter(object):
+    """Forward time of every batch after the warmup, reported as throughput and per batch latency"""
+    def __init__(self, warmup):
+        self.warmup = warmup
+        self.seen = 0
+        self.times = []
+        self.images = 0
+
+    def update(self, seconds, n):
+        self.seen += 1
+        if self.seen > self.warmup:
+            self.times.append(seconds)
+            self.images += n
+
+    def summary(self):
+        if not self.times:
+            return {}
+        times = np.array(self.times)
+        return {
+            'throughput': self.images / times.sum(),
+            'latency_ms_mean': 1000 * times.mean(),
+            'latency_ms_p50': 1000 * np.percentile(times, 50),
+            'latency_ms_p90': 1000 * np.percentile(times, 90),
+            'latency_ms_p99': 1000 * np.percentile(times, 99),
+        }
+
+    def __str__(self):
+        stats = self.summary()
+        if not stats:
+            return 'no timed batches, all {} were warmup'.format(self.seen)
+        return ('Throughput {throughput:.1f} img/s, batch latency mean {latency_ms_mean:.1f} ms '
+                'p50 {latency_ms_p50:.1f} ms p90 {latency_ms_p90:.1f} ms p99 {latency_ms_p99:.1f} ms'.format(**stats))
+
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for the specified values of k"""
     with torch.no_grad():
@@ -176,34 +464,38 @@ def accuracy(output, target, topk=(1,)):
             res.append(correct_k.mul_(100.0 / batch_size))
         return res
 
-def validate(val_loader, model, criterion):
+def validate(val_loader, model, criterion, args, device):
     batch_time = AverageMeter('Time', ':6.3f')
     losses = AverageMeter('Loss', ':.4e')
     top1 = AverageMeter('Acc@1', ':6.2f')
     top5 = AverageMeter('Acc@5', ':6.2f')
+    latency = LatencyMeter(args.warmup)
     model.eval()
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
 
     progress = ProgressMeter(
         len(val_loader),
         [batch_time, losses, top1, top5],
         prefix='Test:')
 
-    with torch.no_grad():
+    with inference_mode():
         end = time.time()
-        for i, (images, target) in enumerate(val_loader):
-            images = images.cuda()
-            target = target.cuda()
-
+        # the next batch is loaded and copied while the current one computes
+        for i, (images, target) in enumerate(utils.Prefetcher(val_loader, device, memory_format)):
             # compute output
-            with torch.cuda.amp.autocast(enabled=False):
+            synchronize(device)
+            start = time.time()
+            with autocast(args, device):
                 output_all = model(images)  # Get the tuple of outputs
-                output = output_all[0]  # Use the primary output for loss calculation
+                output = output_all[0].float()  # Use the primary output for loss calculation
+            synchronize(device)
+            latency.update(time.time() - start, images.size(0))
 
             loss = criterion(output, target)
 
-            # measure accuracy and record loss
+            # measure accuracy and record loss, the meters sum on the device until they are printed
             acc1, acc5 = accuracy(output, target, topk=(1, 5))
-            losses.update(loss.item(), images.size(0))
+            losses.update(loss, images.size(0))
             top1.update(acc1[0], images.size(0))
             top5.update(acc5[0], images.size(0))
 
@@ -211,14 +503,168 @@ def validate(val_loader, model, criterion):
             batch_time.update(time.time() - end)
             end = time.time()
 
-            if i % 20 == 0:
+            if i % args.print_freq == 0:
                 progress.display(i)
 
         print(' * Acc@1 {top1.avg:.3f} Acc@5 {top5.avg:.3f}'
               .format(top1=top1, top5=top5))
+        print(' * {}'.format(latency))
 
     return top1.avg
 
+
+def time_model(model, batch_size, num_batches, args, device):
+    latency = LatencyMeter(args.warmup)
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    images = torch.randn(batch_size, 3, args.input_size, args.input_size).to(device, memory_format=memory_format)
+    with inference_mode():
+        for _ in range(args.warmup + num_batches):
+            synchronize(device)
+            start = time.time()
+            with autocast(args, device):
+                model(images)
+            synchronize(device)
+            latency.update(time.time() - start, images.size(0))
+    return latency
+
+
+def benchmark(model, args, device):
+    """ forward throughput / latency on random images, optionally appended to args.bench_output """
+    latency = time_model(model, args.batch_size, args.benchmark, args, device)
+    print(' * {} {}: {}'.format(args.arch, device, latency))
+
+    if args.bench_output:
+        result = {k: getattr(args, k) for k in ('arch', 'batch_size', 'input_size', 'base_rate', 'inference_mode', 'budget',
+                                                 'live_attention', 'live_mlp', 'channels_last', 'bf16')}
+        result.update(device=str(device), threads=torch.get_num_threads(), **latency.summary())
+        with open(args.bench_output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+    return latency.summary()
+
+
+def calibrate_budgets(model, calib_loader, args, device):
+    """ write the keep thresholds of every --calibrate-budgets base rate to --budget-table
+
+    Each entry is named base_rate_<rate>; infer.py --budget-name and model.set_budget select it at
+    runtime without rebuilding or reloading the model.
+    """
+    assert args.budget_table, '--calibrate-budgets writes to --budget-table'
+    rates = [float(r) for r in args.calibrate_budgets.split(',')]
+    token_ratios = [[r ** (p + 1) for p in range(len(model.pruning_loc))] for r in rates]
+    thresholds = utils.calibrate_keep_thresholds(model, calib_loader, token_ratios, args.calib_batches, device)
+    budgets = {}
+    for rate, ratio, threshold in zip(rates, token_ratios, thresholds):
+        budgets['base_rate_{}'.format(rate)] = {'token_ratio': ratio, 'threshold': threshold}
+        print('base_rate {}: token_ratio {} threshold {}'.format(rate, [round(r, 3) for r in ratio], [round(t, 4) for t in threshold]))
+    with open(args.budget_table, 'w') as f:
+        json.dump({'arch': args.arch, 'model_path': args.model_path, 'calib_batches': args.calib_batches,
+                   'budgets': budgets}, f, indent=2)
+    print('## budget table written to', args.budget_table)
+
+
+def quantize_model(model, calib_loader, args, device):
+    start = time.time()
+    if args.quantize == 'dynamic':
+        qmodel = quantize.quantize_dynamic(model, predictor=not args.float_predictor)
+    else:
+        qmodel = quantize.quantize_static(model, calib_loader, args.calib_batches, device, predictor=not args.float_predictor)
+    print('## {} INT8 quantization of {} Linears in {:.1f}s'.format(
+        args.quantize, len(quantize.quantized_linear_names(model, not args.float_predictor)), time.time() - start))
+    return qmodel
+
+
+def compare_quantized(val_loader, model, qmodel, args, device):
+    """ run the float and the quantized model on the same batches and report the deltas
+
+    Both forwards of a batch start from the same random state, so in the gumbel (non topk) mode
+    they draw the same noise and every keep decision that differs is caused by the quantization.
+    Decisions are compared at the original token positions, over all tokens of the stage.
+    """
+    names = ('float', 'int8')
+    top1 = [AverageMeter('Acc@1', ':6.2f') for _ in names]
+    top5 = [AverageMeter('Acc@5', ':6.2f') for _ in names]
+    latency = [LatencyMeter(args.warmup) for _ in names]
+    disagree = None # (stages, 2) counts, from the first batch with keep decisions
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+
+    with inference_mode():
+        for i, (images, target) in enumerate(val_loader):
+            images = images.to(device, memory_format=memory_format)
+            target = target.to(device)
+            telemetry = []
+            for j, m in enumerate((model, qmodel)):
+                torch.manual_seed(args.seed + i)
+                start = time.time()
+                output, t = m(images)
+                latency[j].update(time.time() - start, images.size(0))
+                telemetry.append(t)
+                acc1, acc5 = accuracy(output, target, topk=(1, 5))
+                top1[j].update(acc1[0], images.size(0))
+                top5[j].update(acc5[0], images.size(0))
+            if telemetry[0].keep_decision:
+                counts = quantize.keep_disagreement(telemetry[1], telemetry[0])
+                disagree = counts if disagree is None else disagree + counts
+
+            if i % 20 == 0:
+                print('Test: [{}/{}] float {:.2f} int8 {:.2f}'.format(i, len(val_loader), top1[0].avg, top1[1].avg))
+
+    for j, name in enumerate(names):
+        print(' * {} Acc@1 {:.3f} Acc@5 {:.3f} {}'.format(name, top1[j].avg, top5[j].avg, latency[j]))
+    stats = [l.summary() for l in latency]
+    speedup = stats[1]['throughput'] / stats[0]['throughput'] if all(stats) else float('nan')
+    print(' * int8 - float: Acc@1 {:+.3f} Acc@5 {:+.3f}, throughput x{:.2f}'.format(
+        top1[1].avg - top1[0].avg, top5[1].avg - top5[0].avg, speedup))
+    if disagree is None:
+        print(' * keep decision disagreement: no keep decisions to compare')
+        return []
+    rates = (disagree[:, 0] / disagree[:, 1]).tolist()
+    print(' * keep decision disagreement: {}'.format(', '.join('stage{} {:.4%}'.format(s, r) for s, r in enumerate(rates))))
+    return rates
+
+
+def autotune(model, args, device):
+    """ time every batch size x thread count x inference mode on random images and write the profile
+
+    The later pruning stages shrink the working set, so the fastest setting depends on the model
+    and its keep ratios. The profile keeps all results and the fastest configuration ('best'),
+    which infer.py --profile and the training scripts load with utils.load_inference_profile.
+    """
+    assert args.profile, '--autotune writes its result to --profile'
+    batch_sizes = [int(b) for b in args.tune_batch_sizes.split(',')]
+    modes = args.tune_modes.split(',')
+    if isinstance(model, LVViTDiffPruning):
+        modes = ['mask'] # no compact forward, see LVViTDiffPruning
+    if args.tune_threads:
+        threads = [int(t) for t in args.tune_threads.split(',')]
+    else:
+        threads = [1 << i for i in range(os.cpu_count().bit_length()) if 1 << i < os.cpu_count()] + [os.cpu_count()]
+    if device.type == 'cuda':
+        threads = [torch.get_num_threads()] # the host threads barely matter for the gpu forward
+
+    results = []
+    for mode in modes:
+        model.inference_mode = mode
+        for num_threads in threads:
+            torch.set_num_threads(num_threads)
+            for batch_size in batch_sizes:
+                latency = time_model(model, batch_size, args.benchmark or 10, args, device)
+                result = dict(inference_mode=mode, threads=num_threads, batch_size=batch_size, **latency.summary())
+                print(' * {}, {} threads, batch {}: {}'.format(mode, num_threads, batch_size, latency))
+                results.append(result)
+
+    candidates = [r for r in results if args.latency_budget is None or r['latency_ms_p99'] <= args.latency_budget]
+    assert candidates, 'no configuration meets the {} ms latency budget'.format(args.latency_budget)
+    best = max(candidates, key=lambda r: r['throughput'])
+    profile = {
+        'arch': args.arch, 'base_rate': args.base_rate, 'budget': args.budget, 'input_size': args.input_size,
+        'device': str(device), 'bf16': args.bf16, 'channels_last': args.channels_last,
+        'latency_budget': args.latency_budget, 'results': results, 'best': best,
+    }
+    with open(args.profile, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print('## best configuration', best, 'written to', args.profile)
+    return profile
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('Dynamic evaluation script', parents=[get_args_parser()])
     args = parser.parse_args()
@@ -13,7 +13,7 @@ import torch.nn as nn
 from timm.models.layers import trunc_normal_
 import numpy as np
 
-from utils import batch_index_select
+from utils import batch_index_select, topk_keep_index
 
 def _cfg(url='', **kwargs):
     return {
@@ -671,7 +671,7 @@ class LVViTDiffPruning(nn.Module):
                 else:
                     score = pred_score[:,:,0]
                     num_keep_node = int(init_n * self.token_ratio[p_count])
-                    keep_policy = torch.argsort(score, dim=1, descending=True)[:, :num_keep_node]
+                    keep_policy = topk_keep_index(score, num_keep_node)
                     if self.viz_mode:
                         decisions[p_count].append(keep_policy)
                     cls_policy = torch.zeros(B, 1, dtype=keep_policy.dtype, device=keep_policy.device)
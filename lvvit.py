@@ -13,7 +13,7 @@ import torch.nn as nn
 from timm.models.layers import trunc_normal_
 import numpy as np
 
-from utils import batch_index_select
+from utils import batch_index_select, topk_keep_index, PosEmbedCache
 
 def _cfg(url='', **kwargs):
     return {
@@ -344,9 +344,7 @@ class PatchEmbedNaive(nn.Module):
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # any input size, the model resizes pos_embed to the output grid
         x = self.proj(x)
         return x
 
@@ -571,6 +569,7 @@ class LVViTDiffPruning(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_embed_cache = PosEmbedCache([i // p for i, p in zip(to_2tuple(img_size), to_2tuple(patch_size))])
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         if order is None:
@@ -642,17 +641,18 @@ class LVViTDiffPruning(nn.Module):
 
     def forward(self, x):
         x = self.patch_embed(x)
+        grid = x.shape[-2:]
         x = x.flatten(2).transpose(1, 2)
         B = x.shape[0]
         cls_tokens = self.cls_token.expand(B, -1, -1)
         x = torch.cat((cls_tokens, x), dim=1)
-        x = x + self.pos_embed
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
         x = self.pos_drop(x)
 
 
         p_count = 0
         out_pred_prob = []
-        init_n = 14 * 14
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
         prev_decision = torch.ones(B, init_n, 1, dtype=x.dtype, device=x.device)
         policy = torch.ones(B, init_n + 1, 1, dtype=x.dtype, device=x.device)
         if self.viz_mode:
@@ -671,7 +671,7 @@ class LVViTDiffPruning(nn.Module):
                 else:
                     score = pred_score[:,:,0]
                     num_keep_node = int(init_n * self.token_ratio[p_count])
-                    keep_policy = torch.argsort(score, dim=1, descending=True)[:, :num_keep_node]
+                    keep_policy = topk_keep_index(score, num_keep_node)
                     if self.viz_mode:
                         decisions[p_count].append(keep_policy)
                     cls_policy = torch.zeros(B, 1, dtype=keep_policy.dtype, device=keep_policy.device)
@@ -14,7 +14,7 @@ from timm.models.layers import trunc_normal_
 import numpy as np
 import json
 
-from utils import batch_index_select
+from utils import batch_index_select, topk_keep_decision, PosEmbedCache
 
 file = 'lvvit_l2_score.json'
 
@@ -349,9 +349,7 @@ class PatchEmbedNaive(nn.Module):
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # any input size, the model resizes pos_embed to the output grid
         x = self.proj(x)
         return x
 
@@ -574,35 +572,28 @@ class MultiheadPredictorLG(nn.Module):
         self.out_conv = nn.ModuleList(out_conv_list)
 
     def forward(self, x, policy):
-
-        multihead_score = 0
-        multihead_softmax_score = 0
-        for i in range(self.num_heads):
-            x_single = x[:,:,self.embed_dim//self.num_heads*i:self.embed_dim//self.num_heads*(i+1)]   #([96, 196, 64])
-            x_single = self.in_conv[i](x_single)
-            B, N, C = x_single.size()       #([96, 196, 64])
-            local_x = x_single[:,:, :C//2]  #([96, 196, 32])
-            global_x = (x_single[:,:, C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 32])
-            x_single = torch.cat([local_x, global_x.expand(B, N, C//2)], dim=-1)  #([96, 196, 64])
-            x_single=self.out_conv[i](x_single) #([96, 196, 2])
-            
-            # for placeholder
-            m = nn.Softmax(dim=-1)
-            score_softmax = m(x_single)
-            multihead_softmax_score += score_softmax
-
-            # for gumble
-            n = nn.LogSoftmax(dim=-1)
-            score_single = n(x_single)
-            multihead_score += score_single
+        # in_conv / out_conv repeat one shared module for every head, so all heads run as one batch
+        # on a (B, N, num_heads, C // num_heads) view instead of a python loop over the heads
+        B, N, C = x.size()
+        x = x.reshape(B, N, self.num_heads, C // self.num_heads)  #([96, 196, 6, 64])
+        x = self.in_conv[0](x)
+        C = x.size(-1)
+        policy = torch.unsqueeze(policy, dim=3)
+        local_x = x[..., :C//2]  #([96, 196, 6, 32])
+        global_x = (x[..., C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 6, 32])
+        # first out_conv layer split into its local and global halves, so the global half runs once per
+        # image and the (B, N, num_heads, C) concat is never built
+        fc = self.out_conv[0][0]
+        x = F.linear(local_x, fc.weight[:, :C//2], fc.bias) + F.linear(global_x, fc.weight[:, C//2:])
+        score = F.log_softmax(self.out_conv[0][1:](x), dim=-1)  #([96, 196, 6, 2])
 
         # for gumble
-        multihead_score = multihead_score / self.num_heads  # ([96, 196, 2])
+        multihead_score = score.mean(dim=2)  # ([96, 196, 2])
 
-        # for placeholder
-        multihead_softmax_score = multihead_softmax_score / self.num_heads  # get softmax keep/drop probability
+        # for placeholder, softmax taken from the log-softmax
+        multihead_softmax_score = score.exp().mean(dim=2)  # get softmax keep/drop probability
 
-        return multihead_score, multihead_softmax_score  
+        return multihead_score, multihead_softmax_score
 
 
 class LVViTDiffPruning(nn.Module):
@@ -613,11 +604,13 @@ class LVViTDiffPruning(nn.Module):
         order: which order of layers will be used (default: None, will override depth if given)
         mix_token: use mix token augmentation for batch of tokens (default: False)
         return_dense: whether to return feature of all tokens with an additional aux_head (default: False)
+        budget: None samples the keep decisions with gumbel softmax in eval, 'topk' keeps exactly token_ratio of the tokens in every image (default: None)
     """
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0., drop_path_decay='linear', hybrid_backbone=None, norm_layer=nn.LayerNorm, p_emb='4_2', head_dim = None,
-                 skip_lam = 1.0,order=None, mix_token=False, return_dense=False, pruning_loc=None, token_ratio=None, distill=False, viz_mode=False):
+                 skip_lam = 1.0,order=None, mix_token=False, return_dense=False, pruning_loc=None, token_ratio=None, distill=False, viz_mode=False,
+                 budget=None):
         super().__init__()
         self.num_classes = num_classes
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
@@ -639,6 +632,7 @@ class LVViTDiffPruning(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_embed_cache = PosEmbedCache([i // p for i, p in zip(to_2tuple(img_size), to_2tuple(patch_size))])
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         if order is None:
@@ -670,6 +664,8 @@ class LVViTDiffPruning(nn.Module):
 
         self.pruning_loc = pruning_loc
         self.token_ratio = token_ratio
+        assert budget in (None, 'topk')
+        self.budget = budget
 
         if return_dense:
             self.aux_head=nn.Linear(embed_dim, num_classes) if num_classes > 0 else nn.Identity()
@@ -710,11 +706,12 @@ class LVViTDiffPruning(nn.Module):
 
     def forward(self, x):
         x = self.patch_embed(x)
+        grid = x.shape[-2:]
         x = x.flatten(2).transpose(1, 2)
         B = x.shape[0]
         cls_tokens = self.cls_token.expand(B, -1, -1)
         x = torch.cat((cls_tokens, x), dim=1)
-        x = x + self.pos_embed
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
         x = self.pos_drop(x)
 
 
@@ -722,7 +719,7 @@ class LVViTDiffPruning(nn.Module):
         out_pred_prob = []
         score_dict = {}
         sparse = []
-        init_n = 14 * 14
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
         prev_decision = torch.ones(B, init_n, 1, dtype=x.dtype, device=x.device)
         policy = torch.ones(B, init_n + 1, 1, dtype=x.dtype, device=x.device)
         if self.viz_mode:
@@ -738,10 +735,16 @@ class LVViTDiffPruning(nn.Module):
                 softmax_score = softmax_score.reshape(B, -1, 2)
                 #-------------------- 确定 informative token 和 placeholder 的 mask
                 if i == self.pruning_loc[0]:
-                    hard_keep_decision = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
+                    if not self.training and self.budget == 'topk':
+                        hard_keep_decision = topk_keep_decision(pred_score[:, :, 0], int(init_n * self.token_ratio[p_count]), prev_decision)
+                    else:
+                        hard_keep_decision = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
                     hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision) #  current drop decision
                 else:
-                    hard_keep_decision_all = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
+                    if not self.training and self.budget == 'topk': # representative tokens do not compete for the budget
+                        hard_keep_decision_all = torch.cat([topk_keep_decision(pred_score[:, :init_n, 0], int(init_n * self.token_ratio[p_count]), prev_decision[:, :init_n]), rep_decision], dim=1)
+                    else:
+                        hard_keep_decision_all = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
                     hard_keep_decision = torch.cat([hard_keep_decision_all[:,:-1], rep_decision], dim=1)
                     hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision)
                 ############### end
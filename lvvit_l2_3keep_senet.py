@@ -12,11 +12,10 @@ import torch.nn as nn
 
 from timm.models.layers import trunc_normal_
 import numpy as np
-import json
 
-from utils import batch_index_select
+from utils import StagePolicy, policy_sparsity, PruningTelemetry, ScoreLog, chunked_attention, PosEmbedCache, PruningStage
 
-file = 'lvvit_l2_score.json'
+score_log = ScoreLog('lvvit_l2_score') # sampled keep scores / decisions of the eval forwards
 
 def _cfg(url='', **kwargs):
     return {
@@ -131,31 +130,15 @@ class Attention(nn.Module):
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(self.head_dim* self.num_heads, dim)
         self.proj_drop = nn.Dropout(proj_drop)
-
-    def softmax_with_policy(self, attn, policy, eps=1e-6):
-        B, N, _ = policy.size()
-        B, H, N, N = attn.size()
-        attn_policy = policy.reshape(B, 1, 1, N)  # * policy.reshape(B, 1, N, 1)
-        eye = torch.eye(N, dtype=attn_policy.dtype, device=attn_policy.device).view(1, 1, N, N)
-        attn_policy = attn_policy + (1.0 - attn_policy) * eye
-        max_att = torch.max(attn, dim=-1, keepdim=True)[0]
-        attn = attn - max_att
-        # attn = attn.exp_() * attn_policy
-        # return attn / attn.sum(dim=-1, keepdim=True)
-
-        # for stable training
-        attn = attn.to(torch.float32).exp_() * attn_policy.to(torch.float32)
-        attn = (attn + eps/N) / (attn.sum(dim=-1, keepdim=True) + eps)
-        return attn.type_as(max_att)
+        self.chunk_size = None # eval only: attention in blocks of chunk_size queries x keys, see chunked_attention
 
     def forward(self, x, policy, padding_mask=None):
+        # policy: StagePolicy of the current pruning stage, or None for plain softmax
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
         # B,heads,N,C/heads 
         q, k, v = qkv[0], qkv[1], qkv[2]
         
-        # trick here to make q@k.t more stable
-        attn = ((q * self.scale) @ k.transpose(-2, -1))
         if padding_mask is not None:
             # attn = attn.view(B, self.num_heads, N, N)
             # attn = attn.masked_fill(
@@ -165,16 +148,21 @@ class Attention(nn.Module):
             # attn_float = attn.softmax(dim=-1, dtype=torch.float32)
             # attn = attn_float.type_as(attn)
             raise NotImplementedError
+        elif self.chunk_size and not self.training:
+            x = chunked_attention(q * self.scale, k, v, policy, self.chunk_size)
         else:
+            # trick here to make q@k.t more stable
+            attn = ((q * self.scale) @ k.transpose(-2, -1))
             if policy is None:
                 attn = attn.softmax(dim=-1)
             elif not self.training:
-                attn = self.softmax_with_policy(attn, policy, 0)
+                attn = policy.softmax(attn, 0)
             else:
-                attn = self.softmax_with_policy(attn, policy, 1e-6)
-        attn = self.attn_drop(attn)
+                attn = policy.softmax(attn, 1e-6)
+            attn = self.attn_drop(attn)
+            x = attn @ v
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, self.head_dim* self.num_heads)
+        x = x.transpose(1, 2).reshape(B, N, self.head_dim* self.num_heads)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
@@ -349,9 +337,7 @@ class PatchEmbedNaive(nn.Module):
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # any input size, the model resizes pos_embed to the output grid
         x = self.proj(x)
         return x
 
@@ -581,45 +567,33 @@ class MultiheadPredictorLG(nn.Module):
         self.out_conv = nn.ModuleList(out_conv_list)
 
     def forward(self, x, policy):
-
-        multihead_score = 0
-        multihead_softmax_score = 0
-        _, n, _ = x.size()
-        a = nn.AdaptiveAvgPool2d((n, self.num_heads)) #pooling
-        x_head = a(x)   #([64, 196, 6])
-
-        head_weights = self.senet(x_head)
-        head_weights_sum = torch.sum(head_weights, dim=2)
-        head_weights_sum = torch.unsqueeze(head_weights_sum, dim=2)  #([64, 196, 1])
-
-        for i in range(self.num_heads):
-            x_single = x[:,:,self.embed_dim//self.num_heads*i:self.embed_dim//self.num_heads*(i+1)]   #([96, 196, 64])
-            x_single = self.in_conv[i](x_single)
-            B, N, C = x_single.size()       #([96, 196, 64])
-            local_x = x_single[:,:, :C//2]  #([96, 196, 32])
-            global_x = (x_single[:,:, C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 32])
-            x_single = torch.cat([local_x, global_x.expand(B, N, C//2)], dim=-1)  #([96, 196, 64])
-            x_single=self.out_conv[i](x_single) #([96, 196, 2])
-            
-            # for placeholder
-            m = nn.Softmax(dim=-1)
-            score_softmax = m(x_single)
-            score_softmax = score_softmax * head_weights[:, :, i:i + 1]  # [64, 196, 2]
-            multihead_softmax_score += score_softmax
-
-            # for gumble
-            n = nn.LogSoftmax(dim=-1)
-            score_single = n(x_single)
-            score_single = score_single * head_weights[:, :, i:i + 1]  # [64, 196, 2]
-            multihead_score += score_single
-
-        # for placeholder
-        multihead_softmax_score = multihead_softmax_score / head_weights_sum
+        # in_conv / out_conv repeat one shared module for every head, so all heads run as one batch
+        # on a (B, N, num_heads, C // num_heads) view instead of a python loop over the heads
+        B, N, C = x.size()
+        x = x.reshape(B, N, self.num_heads, C // self.num_heads)  #([96, 196, 6, 64])
+
+        head_weights = self.senet(x.mean(dim=-1))  # same as AdaptiveAvgPool2d((N, num_heads)), ([64, 196, 6])
+        head_weights = torch.unsqueeze(head_weights, dim=3)  #([64, 196, 6, 1])
+        head_weights_sum = torch.sum(head_weights, dim=2)  #([64, 196, 1])
+
+        x = self.in_conv[0](x)
+        C = x.size(-1)
+        policy = torch.unsqueeze(policy, dim=3)
+        local_x = x[..., :C//2]  #([96, 196, 6, 32])
+        global_x = (x[..., C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 6, 32])
+        # first out_conv layer split into its local and global halves, so the global half runs once per
+        # image and the (B, N, num_heads, C) concat is never built
+        fc = self.out_conv[0][0]
+        x = F.linear(local_x, fc.weight[:, :C//2], fc.bias) + F.linear(global_x, fc.weight[:, C//2:])
+        score = F.log_softmax(self.out_conv[0][1:](x), dim=-1)  #([96, 196, 6, 2])
 
         # for gumble
-        multihead_score = multihead_score / head_weights_sum  # ([96, 196, 2])
+        multihead_score = torch.sum(score * head_weights, dim=2) / head_weights_sum  # ([96, 196, 2])
 
-        return multihead_score, multihead_softmax_score  #, represent_token, placeholder_weights, placeholder_score3
+        # for placeholder, softmax taken from the log-softmax
+        multihead_softmax_score = torch.sum(score.exp() * head_weights, dim=2) / head_weights_sum
+
+        return multihead_score, multihead_softmax_score
 
 
 class LVViTDiffPruning(nn.Module):
@@ -630,11 +604,19 @@ class LVViTDiffPruning(nn.Module):
         order: which order of layers will be used (default: None, will override depth if given)
         mix_token: use mix token augmentation for batch of tokens (default: False)
         return_dense: whether to return feature of all tokens with an additional aux_head (default: False)
+        inference_mode: only 'mask', there is no compact forward because the aux head max-pools over the dropped tokens too, whose values only the masked forward computes (default: 'mask')
+        budget: None samples the keep decisions with gumbel softmax in eval, 'topk' keeps exactly token_ratio of the tokens in every image, 'threshold' keeps the tokens whose keep score reaches keep_threshold (default: None)
+        live_attention: not supported, dropped tokens would keep a stale value that the aux head reads (default: False)
+        live_mlp: not supported, dropped tokens would get no MLP update but the aux head reads them (default: False)
+        attn_chunk_size: in eval, compute the attention in blocks of attn_chunk_size queries x keys with an online softmax, so the memory grows linearly with the number of tokens (default: None, full attention)
+        keep_threshold: per stage keep score threshold of budget='threshold', see calibrate_keep_thresholds (default: None)
     """
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=False, qk_scale=None, drop_rate=0., attn_drop_rate=0.,
                  drop_path_rate=0., drop_path_decay='linear', hybrid_backbone=None, norm_layer=nn.LayerNorm, p_emb='4_2', head_dim = None,
-                 skip_lam = 1.0,order=None, mix_token=False, return_dense=False, pruning_loc=None, token_ratio=None, distill=False, viz_mode=False):
+                 skip_lam = 1.0,order=None, mix_token=False, return_dense=False, pruning_loc=None, token_ratio=None, distill=False, viz_mode=False,
+                 inference_mode='mask', budget=None, live_attention=False,
+                 live_mlp=False, attn_chunk_size=None, keep_threshold=None):
         super().__init__()
         self.num_classes = num_classes
         self.num_features = self.embed_dim = embed_dim  # num_features for consistency with other models
@@ -656,6 +638,7 @@ class LVViTDiffPruning(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_embed_cache = PosEmbedCache([i // p for i, p in zip(to_2tuple(img_size), to_2tuple(patch_size))])
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         if order is None:
@@ -684,9 +667,19 @@ class LVViTDiffPruning(nn.Module):
         predictor_list = [MultiheadPredictorLG(num_heads,embed_dim) for _ in range(len(pruning_loc))]
 
         self.score_predictor = nn.ModuleList(predictor_list)
+        self.pruning_stage = PruningStage()
 
         self.pruning_loc = pruning_loc
         self.token_ratio = token_ratio
+        assert budget in (None, 'topk', 'threshold')
+        self.budget = budget
+        self.keep_threshold = keep_threshold
+        self.budget_table = {}
+        assert not live_attention, 'LVViTDiffPruning does not support live_attention, the aux head reads the dropped tokens'
+        self.live_attention = live_attention
+        assert not live_mlp, 'LVViTDiffPruning does not support live_mlp, the aux head reads the dropped tokens'
+        self.live_mlp = live_mlp
+        self.attn_chunk_size = attn_chunk_size
 
         if return_dense:
             self.aux_head=nn.Linear(embed_dim, num_classes) if num_classes > 0 else nn.Identity()
@@ -697,6 +690,9 @@ class LVViTDiffPruning(nn.Module):
         self.distill = distill
         self.viz_mode = viz_mode
 
+        assert inference_mode == 'mask', 'LVViTDiffPruning only supports the mask forward, the aux head reads the dropped tokens'
+        self.inference_mode = inference_mode
+
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
         self.apply(self._init_weights)
@@ -718,6 +714,37 @@ class LVViTDiffPruning(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token'}
 
+    @property
+    def attn_chunk_size(self):
+        return self._attn_chunk_size
+
+    @attn_chunk_size.setter
+    def attn_chunk_size(self, chunk_size):
+        self._attn_chunk_size = chunk_size
+        for m in self.modules():
+            if isinstance(m, Attention):
+                m.chunk_size = chunk_size
+
+    def set_budget(self, budget='topk', token_ratio=None, threshold=None):
+        """ switch the eval keep budget without rebuilding the model
+
+        budget is None, 'topk', 'threshold' or the name of a budget_table entry
+        ({'token_ratio': [...], 'threshold': [...]}, see infer.py --calibrate-budgets), which
+        selects the 'threshold' budget with that entry's precomputed thresholds.
+        """
+        if budget in self.budget_table:
+            entry = self.budget_table[budget]
+            budget, token_ratio, threshold = 'threshold', entry['token_ratio'], entry['threshold']
+        assert budget in (None, 'topk', 'threshold'), 'unknown budget {}'.format(budget)
+        if token_ratio is not None:
+            assert len(token_ratio) == len(self.pruning_loc), 'need one keep ratio per pruning stage'
+            self.token_ratio = list(token_ratio)
+        if threshold is not None:
+            assert len(threshold) == len(self.pruning_loc), 'need one threshold per pruning stage'
+            self.keep_threshold = list(threshold)
+        assert budget != 'threshold' or self.keep_threshold is not None, 'budget threshold needs keep_threshold'
+        self.budget = budget
+
     def get_classifier(self):
         return self.head
 
@@ -726,84 +753,57 @@ class LVViTDiffPruning(nn.Module):
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
     def forward(self, x):
+        assert self.training or self.inference_mode == 'mask', 'LVViTDiffPruning only supports the mask forward'
+
         x = self.patch_embed(x)
+        grid = x.shape[-2:]
         x = x.flatten(2).transpose(1, 2)
         B = x.shape[0]
         cls_tokens = self.cls_token.expand(B, -1, -1)
         x = torch.cat((cls_tokens, x), dim=1)
-        x = x + self.pos_embed
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
         x = self.pos_drop(x)
 
 
         p_count = 0
         out_pred_prob = []
-        score_dict = {}
-        sparse = []
-        init_n = 14 * 14
-        prev_decision = torch.ones(B, init_n, 1, dtype=x.dtype, device=x.device)
-        policy = torch.ones(B, init_n + 1, 1, dtype=x.dtype, device=x.device)
+        telemetry = PruningTelemetry()
+        record = [] if not self.training and score_log.sample() else None
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
+        # cls, spatial and all rep tokens, every stage writes its keep decision over the spatial entries
+        policy = torch.ones(B, 1 + init_n + len(self.pruning_loc), 1, dtype=x.dtype, device=x.device)
+        stage_policy = StagePolicy(policy[:, :init_n + 1]) # rebuilt only at pruning locations
         if self.viz_mode:
             decisions = [[] for _ in self.pruning_loc]
         for i, blk in enumerate(self.blocks):
             if i in self.pruning_loc:
                 spatial_x = x[:, 1:]
-                if i != self.pruning_loc[0]:
-                    rep_decision = torch.ones(B, p_count, 1, dtype=x.dtype, device=x.device)
-                    prev_decision = torch.cat([prev_decision, rep_decision], dim=1)
+                prev_decision = policy[:, 1:1 + init_n + p_count] # the rep tokens are always kept
                 pred_score, softmax_score = self.score_predictor[p_count](spatial_x, prev_decision)
                 pred_score = pred_score.reshape(B, -1, 2)
                 softmax_score = softmax_score.reshape(B, -1, 2)
-                #-------------------- 确定 informative token 和 placeholder 的 mask
-                if i == self.pruning_loc[0]:
-                    hard_keep_decision = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
-                    hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision) #  current drop decision
-                else:
-                    hard_keep_decision_all = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
-                    hard_keep_decision = torch.cat([hard_keep_decision_all[:,:-p_count], rep_decision], dim=1)
-                    hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision)
-                ############### end
-
-                ###get representative token  (regularization)
-                softmax_score = softmax_score[:, :, 0:1]  # softmax score of all tokens to keep
-                placeholder_score = softmax_score * hard_drop_decision  #keep score of only placeholder tokens
-                x2 = spatial_x * placeholder_score  # placehoder score [96, 196, 384]
-                x2_sum = torch.sum(x2, dim=1)  # sum by the N dimension, output (B,N,C)-->(B,C) [96, 384]
-                x2_sum = torch.unsqueeze(x2_sum, dim=1)  # resize to (B,1,C)  [96, 1, 384]
-                #--------------------
-                placeholder_score_sum = torch.sum(placeholder_score, dim=1)  # sum of token score, [96, 196, 1]-->[96, 1]
-                placeholder_score_sum = torch.unsqueeze(placeholder_score_sum, dim=1)  # resize to [96, 1, 1]
-                #--------------------
-                represent_token = x2_sum #/ placeholder_score_sum  # regularization --> [96, 1, 384] representitave token
-                rep_mean = represent_token.mean()
-                if torch.isnan(rep_mean):
-                    print('has nan')
-                    represent_token = torch.nan_to_num(represent_token, nan = 1e-6)
-             
+                threshold = self.keep_threshold[p_count] if self.budget == 'threshold' else None
+                hard_keep_decision, represent_token = self.pruning_stage(
+                    spatial_x, pred_score, softmax_score, prev_decision, init_n, self.budget,
+                    int(init_n * self.token_ratio[p_count]), threshold)
+                represent_token = score_log.nan_to_num(represent_token, nan = 1e-6)
 
                 x = torch.cat((x,represent_token), dim=1)
-                if i != self.pruning_loc[0]:
-                    hard_keep_decision = hard_keep_decision[:,:-p_count]
+                policy, stage_mask = self.pruning_stage.policy(policy, hard_keep_decision, p_count + 1)
+                stage_policy = StagePolicy(stage_mask, self.live_attention, self.live_mlp)
+                x = blk(x, policy=stage_policy)
+                prev_decision = hard_keep_decision
 
                 if self.training:
                     out_pred_prob.append(hard_keep_decision.reshape(B, init_n))
-                    cls_policy = torch.ones(B, 1, 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    rep_policy = torch.ones(B, (p_count + 1), 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    policy = torch.cat([cls_policy, hard_keep_decision, rep_policy], dim=1)
-                    x = blk(x, policy=policy)
-                    prev_decision = hard_keep_decision
                 else:
-                    cls_policy = torch.ones(B, 1, 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    rep_policy = torch.ones(B, (p_count + 1), 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    policy = torch.cat([cls_policy, hard_keep_decision, rep_policy], dim=1)
-                    zeros, unzeros = test_irregular_sparsity(p_count, policy)
-                    sparse.append([zeros, unzeros])
-                    x = blk(x, policy=policy)
-                    prev_decision = hard_keep_decision
-                    score = pred_score[:, :, 0:1].cpu().numpy().tolist()
-                    score_dict[p_count] = score[0] #144/12=12x30x87x4=125280= 1.5G
+                    telemetry.add_stage(policy_sparsity(stage_mask), (hard_keep_decision > 0.5).sum(dim=(1, 2)), init_n, represent_token,
+                                        hard_keep_decision[:, :, 0])
+                    if record is not None:
+                        record.append((pred_score[0, :, 0], hard_keep_decision[0, :, 0]))
                 p_count += 1
             else:
-                x = blk(x, policy)
+                x = blk(x, stage_policy)
         
         x = self.norm(x)
         x_cls = self.head(x[:,0])
@@ -816,11 +816,9 @@ class LVViTDiffPruning(nn.Module):
             else:
                 return final_pred, out_pred_prob
         else:
-            with open(file, 'a') as f: # ins
-                json.dump(score_dict, f)
-                f.write('\n')
-            sparse = torch.FloatTensor(sparse).cuda()
-            return final_pred, sparse
+            if record:
+                score_log.append(record) # written by the background thread
+            return final_pred, telemetry
 
 class LVViT_Teacher(nn.Module):
     """ Vision Transformer with tricks
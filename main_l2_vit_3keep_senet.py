@@ -23,6 +23,8 @@ from samplers import RASampler
 import utils
 from functools import partial
 import torch.nn as nn
+import vit_l2_3keep_senet
+import lvvit_l2_3keep_senet
 from vit_l2_3keep_senet import VisionTransformerDiffPruning, VisionTransformerTeacher, _cfg, checkpoint_filter_fn
 from lvvit_l2_3keep_senet import LVViTDiffPruning, LVViT_Teacher
 import math
@@ -157,6 +159,11 @@ def get_args_parser():
                         help='start epoch')
     parser.add_argument('--eval', action='store_true', help='Perform evaluation only')
     parser.add_argument('--dist-eval', action='store_true', default=False, help='Enabling distributed evaluation')
+    parser.add_argument('--score-sample-rate', default=1.0, type=float,
+                        help='fraction of the eval forwards whose keep scores / decisions are recorded')
+    parser.add_argument('--profile', default='', type=str,
+                        help='infer.py --autotune profile, its best configuration sets the eval batch size, '
+                             'inference mode and (on cpu) thread count')
     parser.add_argument('--num_workers', default=10, type=int)
     parser.add_argument('--pin-mem', action='store_true',
                         help='Pin CPU memory in DataLoader for more efficient (sometimes) transfer to GPU.')
@@ -233,6 +240,14 @@ def main(args):
 
     cudnn.benchmark = True
 
+    eval_batch_size = int(1.5 * args.batch_size)
+    profile = None
+    if args.profile:
+        profile = utils.load_inference_profile(args.profile, args.arch)
+        eval_batch_size = profile['batch_size']
+        if device.type == 'cpu':
+            torch.set_num_threads(profile['threads'])
+
     dataset_train, args.nb_classes = build_dataset(is_train=True, args=args)
     dataset_val, _ = build_dataset(is_train=False, args=args)
 
@@ -270,7 +285,7 @@ def main(args):
 
     data_loader_val = torch.utils.data.DataLoader(
         dataset_val, sampler=sampler_val,
-        batch_size=int(1.5 * args.batch_size),
+        batch_size=eval_batch_size,
         num_workers=args.num_workers,
         pin_memory=args.pin_mem,
         drop_last=False
@@ -461,6 +476,9 @@ def main(args):
 
         model.load_state_dict(checkpoint_model, strict=False)
 
+    if profile is not None: # only used by the eval forward
+        model.inference_mode = profile['inference_mode']
+
     #model = nn.DataParallel(model)
     model.to(device)
 
@@ -545,6 +563,9 @@ def main(args):
             if 'scaler' in checkpoint:
                 loss_scaler.load_state_dict(checkpoint['scaler'])
 
+    vit_l2_3keep_senet.score_log.sample_rate = args.score_sample_rate
+    lvvit_l2_3keep_senet.score_log.sample_rate = args.score_sample_rate
+
     if args.eval:
         test_stats = evaluate(data_loader_val, model, device)
         print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
@@ -6,14 +6,15 @@ import torch
 from einops import rearrange
 from torch import nn
 import math
-import json
 import torch.nn.functional as F
 import numpy as np
 from functools import partial
 from timm.models.layers import DropPath, trunc_normal_
 from timm.models.registry import register_model
 
-file = 'score.json'
+from utils import StagePolicy, PruningStage, policy_sparsity, PruningTelemetry, ScoreLog
+
+score_log = ScoreLog('score') # sampled keep scores / decisions of the eval forwards
 
 class Mlp(nn.Module):
     def __init__(self, in_features, hidden_features=None, out_features=None, act_layer=nn.GELU, drop=0.):
@@ -47,34 +48,26 @@ class Attention(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def softmax_with_policy(self, attn, policy, eps=1e-6):
-        B, N, _ = policy.size()
-        B, H, N, N = attn.size()
-        attn_policy = policy.reshape(B, 1, 1, N)  # * policy.reshape(B, 1, N, 1)
-        eye = torch.eye(N, dtype=attn_policy.dtype, device=attn_policy.device).view(1, 1, N, N)
-        attn_policy = attn_policy + (1.0 - attn_policy) * eye
-        max_att = torch.max(attn, dim=-1, keepdim=True)[0]
-        attn = attn - max_att
-
-        attn = attn.to(torch.float32).exp_() * attn_policy.to(torch.float32)
-        attn = (attn + eps/N) / (attn.sum(dim=-1, keepdim=True) + eps)
-        return attn.type_as(max_att)
-
     def forward(self, x, policy):
+        # policy: StagePolicy of the current pruning stage, or None for plain softmax
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-
-        if policy is None:
-            attn = attn.softmax(dim=-1)
-        elif not self.training:
-            attn = self.softmax_with_policy(attn, policy, 0)
+        if policy is not None and policy.live_rows:
+            x = policy.live_attention(q * self.scale, k, v, 1e-6 if self.training else 0)
         else:
-            attn = self.softmax_with_policy(attn, policy, 1e-6)
+            attn = (q @ k.transpose(-2, -1)) * self.scale
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+            if policy is None:
+                attn = attn.softmax(dim=-1)
+            elif not self.training:
+                attn = policy.softmax(attn, 0)
+            else:
+                attn = policy.softmax(attn, 1e-6)
+            x = attn @ v
+
+        x = x.transpose(1, 2).reshape(B, N, C)
 
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -140,52 +133,39 @@ class MultiheadPredictorLG(nn.Module):
         self.out_conv = nn.ModuleList(out_conv_list)
 
     def forward(self, x, policy):
-
-        multihead_score = 0
-        multihead_softmax_score = 0
-
-        _, n, _ = x.size()
-        a = nn.AdaptiveAvgPool2d((n, self.num_heads)) #pooling
-        x_head = a(x)   #([64, 196, 6])
-
-        head_weights = self.senet(x_head)
-        head_weights_sum = torch.sum(head_weights, dim=2)
-        head_weights_sum = torch.unsqueeze(head_weights_sum, dim=2)  #([64, 196, 1])
-
-
-        for i in range(self.num_heads):
-            x_single = x[:,:,x.shape[2]//self.num_heads*i:x.shape[2]//self.num_heads*(i+1)]   #([96, 196, 64])
-            x_single = self.in_conv[i](x_single)
-            B, N, C = x_single.size()       #([96, 196, 64])
-            local_x = x_single[:,:, :C//2]  #([96, 196, 32])
-            global_x = (x_single[:,:, C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 32])
-            x_single = torch.cat([local_x, global_x.expand(B, N, C//2)], dim=-1)  #([96, 196, 64])
-            x_single = self.out_conv[i](x_single)  # ([96, 196, 2])
-
-            # for placeholder
-            m = nn.Softmax(dim=-1)
-            score_softmax = m(x_single)
-            score_softmax = score_softmax * head_weights[:, :, i:i + 1]  # [64, 196, 2]
-            multihead_softmax_score += score_softmax
-
-            # for gumble
-            n = nn.LogSoftmax(dim=-1)
-            score_single = n(x_single)
-            score_single = score_single * head_weights[:, :, i:i + 1]  # [64, 196, 2]
-            multihead_score += score_single
-
-        # for placeholder
-        multihead_softmax_score = multihead_softmax_score / head_weights_sum
+        # in_conv / out_conv repeat one shared module for every head, so all heads run as one batch
+        # on a (B, N, num_heads, C // num_heads) view instead of a python loop over the heads
+        B, N, C = x.size()
+        x = x.reshape(B, N, self.num_heads, C // self.num_heads)  #([96, 196, 6, 64])
+
+        head_weights = self.senet(x.mean(dim=-1))  # same as AdaptiveAvgPool2d((N, num_heads)), ([64, 196, 6])
+        head_weights = torch.unsqueeze(head_weights, dim=3)  #([64, 196, 6, 1])
+        head_weights_sum = torch.sum(head_weights, dim=2)  #([64, 196, 1])
+
+        x = self.in_conv[0](x)
+        C = x.size(-1)
+        policy = torch.unsqueeze(policy, dim=3)
+        local_x = x[..., :C//2]  #([96, 196, 6, 32])
+        global_x = (x[..., C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 6, 32])
+        # first out_conv layer split into its local and global halves, so the global half runs once per
+        # image and the (B, N, num_heads, C) concat is never built
+        fc = self.out_conv[0][0]
+        x = F.linear(local_x, fc.weight[:, :C//2], fc.bias) + F.linear(global_x, fc.weight[:, C//2:])
+        score = F.log_softmax(self.out_conv[0][1:](x), dim=-1)  #([96, 196, 6, 2])
 
         # for gumble
-        multihead_score = multihead_score / head_weights_sum  # ([96, 196, 2])
+        multihead_score = torch.sum(score * head_weights, dim=2) / head_weights_sum  # ([96, 196, 2])
 
-        return multihead_score, multihead_softmax_score  # , represent_token, placeholder_weights, placeholder_score3
+        # for placeholder, softmax taken from the log-softmax
+        multihead_softmax_score = torch.sum(score.exp() * head_weights, dim=2) / head_weights_sum
+
+        return multihead_score, multihead_softmax_score
 
 
 class Transformer(nn.Module):
     def __init__(self, base_dim, depth, heads, mlp_ratio,
-                 drop_rate=.0, attn_drop_rate=.0, drop_path_prob=None, pruning_loc=None, token_ratio=None, distill=False):
+                 drop_rate=.0, attn_drop_rate=.0, drop_path_prob=None, pruning_loc=None, token_ratio=None, distill=False, budget=None,
+                 live_attention=False):
         super(Transformer, self).__init__()
         self.layers = nn.ModuleList([])
         embed_dim = base_dim * heads
@@ -215,10 +195,14 @@ class Transformer(nn.Module):
         predictor_list = [MultiheadPredictorLG(heads,embed_dim) for _ in range(len(pruning_loc_stage))]
 
         self.score_predictor = nn.ModuleList(predictor_list)
+        self.pruning_stage = PruningStage()
         self.token_ratio = token_ratio
+        assert budget in (None, 'topk')
+        self.budget = budget
+        self.live_attention = live_attention
         self.pruning_loc_stage = pruning_loc_stage
 
-    def forward(self, x, cls_tokens, rep_token, policy):
+    def forward(self, x, cls_tokens, rep_token, policy, record=None, telemetry=None):
         h, w = x.shape[2:4]
         x = rearrange(x, 'b c h w -> b (h w) c') # 此时 (h w) 是 token_numbers 了
         B = x.shape[0]
@@ -226,81 +210,44 @@ class Transformer(nn.Module):
 
         p_count = 0
         out_pred_prob = []
-        sparse = []
-        score_dict = {}
         init_n = x.shape[1]
-        prev_decision = policy[:, token_length:]
+        # prefix, spatial and rep token, the pruning location writes its keep decision over the spatial entries
+        policy = torch.cat([policy, policy[:, :token_length]], dim=1)
+        stage_policy = StagePolicy(policy[:, :token_length + init_n]) # rebuilt only at the pruning location
         x = torch.cat((cls_tokens, x), dim=1)
 
         for i, blk in enumerate(self.blocks):
             if i in self.pruning_loc_stage:
-                if self.depth != 2:
-                    #print('yes')
+                num_rep = 0 if self.depth == 2 else token_length # the rep token of the previous stage
+                if num_rep:
                     x = torch.cat((x, rep_token), dim=1)
                 spatial_x = x[:, token_length:]
-                if self.depth != 2:
-                    #print('yes')
-                    rep_decision = torch.ones(B, 1, 1, dtype=x.dtype, device=x.device)
-                    prev_decision = torch.cat([prev_decision, rep_decision], dim=1)
-                    #print('spatial_x',spatial_x.size())
-                    #print('prev_decision',prev_decision.size())
+                prev_decision = policy[:, token_length:token_length + init_n + num_rep]
                 pred_score, softmax_score = self.score_predictor[p_count](spatial_x, prev_decision)
                 pred_score = pred_score.reshape(B, -1, 2)
                 softmax_score = softmax_score.reshape(B, -1, 2)
-                #-------------------- 确定 informative token 和 placeholder 的 mask
-                if self.depth == 2:
-                    hard_keep_decision = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
-                    hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision) #  current drop decision
-                else:
-                    hard_keep_decision_all = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
-                    hard_keep_decision = torch.cat([hard_keep_decision_all[:,:-1], rep_decision], dim=1)
-                    hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision)
-                ############### end
-                ###get representative token  (regularization)
-                softmax_score = softmax_score[:, :, 0:1]  # softmax score of all tokens to keep
-                placeholder_score = softmax_score * hard_drop_decision  #keep score of only placeholder tokens
-                x2 = spatial_x * placeholder_score  # placehoder score [96, 196, 384]
-                x2_sum = torch.sum(x2, dim=1)  # sum by the N dimension, output (B,N,C)-->(B,C) [96, 384]
-                x2_sum = torch.unsqueeze(x2_sum, dim=1)  # resize to (B,1,C)  [96, 1, 384]
-                #--------------------
-                placeholder_score_sum = torch.sum(placeholder_score, dim=1)  # sum of token score, [96, 196, 1]-->[96, 1]
-                placeholder_score_sum = torch.unsqueeze(placeholder_score_sum, dim=1)  # resize to [96, 1, 1]
-                #--------------------
-                represent_token = x2_sum / placeholder_score_sum  # regularization --> [96, 1, 384] representitave token
-
-                if self.depth == 2:
-                    x = torch.cat((x,represent_token), dim=1)
-                    #print('x', x.size())
-                else:
+                hard_keep_decision, represent_token = self.pruning_stage(
+                    spatial_x, pred_score, softmax_score, prev_decision, init_n, self.budget,
+                    int(init_n * self.token_ratio), normalize=True)
+
+                if num_rep:
                     represent_token = x[:, -1:, :] + represent_token
                     x = x[:,:-1]
-                    #print('after x', x.size())
-                    x = torch.cat((x,represent_token), dim=1)
-                    #print('after cat rep x', x.size())
-                    hard_keep_decision = hard_keep_decision[:,:-1]
+                x = torch.cat((x,represent_token), dim=1)
+                policy, stage_mask = self.pruning_stage.policy(policy, hard_keep_decision, token_length)
+                stage_policy = StagePolicy(stage_mask, self.live_attention)
+                x = blk(x, policy=stage_policy)
 
                 if self.training:
                     out_pred_prob.append(hard_keep_decision.reshape(B, init_n))
-                    cls_policy = torch.ones(B, token_length, 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    rep_policy = torch.ones(B, token_length, 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    #print('cls_policy, hard_keep_decision, rep_policy',cls_policy.size(), hard_keep_decision.size(), rep_policy.size())
-                    policy = torch.cat([cls_policy, hard_keep_decision, rep_policy], dim=1)
-                    #print('policy',policy.size())
-                    x = blk(x, policy=policy)
-                    prev_decision = hard_keep_decision
                 else:
-                    cls_policy = torch.ones(B, token_length, 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    rep_policy = torch.ones(B, token_length, 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    policy = torch.cat([cls_policy, hard_keep_decision, rep_policy], dim=1)
-                    zeros, unzeros = test_irregular_sparsity(p_count, policy)
-                    sparse.append([zeros, unzeros])
-                    x = blk(x,policy=policy)
-                    prev_decision = hard_keep_decision
-                    score = pred_score[:, :, 0:1].cpu().numpy().tolist()
-                    score_dict[p_count] = score[0] #144/12=12x30x87x4=125280= 1.5G
+                    telemetry.add_stage(policy_sparsity(stage_mask), (hard_keep_decision > 0.5).sum(dim=(1, 2)), init_n, represent_token,
+                                        hard_keep_decision[:, :, 0])
+                    if record is not None: # collected by PoolingTransformer over all stages
+                        record.append((pred_score[0, :, 0], hard_keep_decision[0, :, 0]))
                 p_count += 1
             else:
-                x = blk(x, policy)
+                x = blk(x, stage_policy)
 
         cls_tokens = x[:, :token_length]
         rep_token = x[:, -1:]
@@ -313,10 +260,7 @@ class Transformer(nn.Module):
             else:
                 return x, cls_tokens, out_pred_prob, rep_token
         else:
-            with open(file, 'a') as f:
-                json.dump(score_dict, f)
-                f.write('\n')
-            return x, cls_tokens, rep_token, sparse
+            return x, cls_tokens, rep_token
 
 
 class Transformer_Teacher(nn.Module):
@@ -409,7 +353,7 @@ class PoolingTransformer(nn.Module):
     def __init__(self, image_size, patch_size, stride, base_dims, depth, heads,
                  mlp_ratio, num_classes=1000, in_chans=3,
                  attn_drop_rate=.0, drop_rate=.0, drop_path_rate=.0,
-                 pruning_loc=None, token_ratio=None, distill=False):
+                 pruning_loc=None, token_ratio=None, distill=False, budget=None, live_attention=False):
         super(PoolingTransformer, self).__init__()
 
         total_block = sum(depth)
@@ -445,6 +389,9 @@ class PoolingTransformer(nn.Module):
 
         self.pruning_loc = pruning_loc  # 不同阶段就插一个吧。我不求了。。。
         self.token_ratio = token_ratio
+        assert budget in (None, 'topk')
+        self.budget = budget
+        self.live_attention = live_attention
 
         for stage in range(len(depth)):
             print('stage',stage)
@@ -455,7 +402,10 @@ class PoolingTransformer(nn.Module):
             self.transformers.append(
                 Transformer(base_dims[stage], depth[stage], heads[stage], # 不同的 stage，三种不同模式的 transformer
                             mlp_ratio,
-                            drop_rate, attn_drop_rate, drop_path_prob, pruning_loc[stage], token_ratio[stage], distill)
+                            drop_rate, attn_drop_rate, drop_path_prob, pruning_loc[stage], token_ratio[stage], distill, budget,
+                            # conv_head_pooling reads every spatial token, dropped ones included, so
+                            # dropped tokens may only keep a stale value in the last stage
+                            live_attention and stage == len(depth) - 1)
             )
             if stage < len(heads) - 1:
                 self.pools.append(
@@ -509,7 +459,8 @@ class PoolingTransformer(nn.Module):
 
 
         out_pred_prob = []
-        out_sparse = []
+        telemetry = PruningTelemetry()
+        record = [] if not self.training and score_log.sample() else None
         for stage in range(len(self.pools)): #only two pool stage
             h, w = x.shape[2:4] #27,27 and 14,14
             init_n = h * w
@@ -523,8 +474,7 @@ class PoolingTransformer(nn.Module):
                     out_pred_prob = out_pred_prob + sub_pred_prob
 
                 else:
-                    x, cls_tokens, rep_token, sparse = self.transformers[stage](x, cls_tokens, rep_token = None, policy = policy)
-                    out_sparse = out_sparse + sparse
+                    x, cls_tokens, rep_token = self.transformers[stage](x, cls_tokens, rep_token = None, policy = policy, record = record, telemetry = telemetry)
                 x, cls_tokens, rep_token = self.pools[stage](x, cls_tokens, rep_token)
             else:
                 if self.training:
@@ -535,8 +485,7 @@ class PoolingTransformer(nn.Module):
                     out_pred_prob = out_pred_prob + sub_pred_prob
 
                 else:
-                    x, cls_tokens, rep_token, sparse = self.transformers[stage](x, cls_tokens, rep_token, policy=policy)
-                    out_sparse = out_sparse + sparse
+                    x, cls_tokens, rep_token = self.transformers[stage](x, cls_tokens, rep_token, policy=policy, record=record, telemetry=telemetry)
                 x, cls_tokens, rep_token = self.pools[stage](x, cls_tokens, rep_token)
 
         h, w = x.shape[2:4]  #7,7
@@ -550,15 +499,16 @@ class PoolingTransformer(nn.Module):
             out_pred_prob = out_pred_prob + sub_pred_prob
 
         else:
-            x, cls_tokens, rep_token, sparse = self.transformers[-1](x, cls_tokens, rep_token, policy = policy)
-            out_sparse = out_sparse + sparse
+            x, cls_tokens, rep_token = self.transformers[-1](x, cls_tokens, rep_token, policy = policy, record = record, telemetry = telemetry)
+            if record:
+                score_log.append(record) # written by the background thread
 
         cls_tokens = self.norm(cls_tokens)
 
         if self.training: # x ==  features
             return cls_tokens, x, policy[:, token_length:-1], out_pred_prob
         else:
-            return cls_tokens, x, policy[:, token_length:-1], out_sparse
+            return cls_tokens, x, policy[:, token_length:-1], telemetry
 
     def forward(self, x):
         cls_token, features, prev_decision, out_pred_prob = self.forward_features(x)
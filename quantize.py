@@ -0,0 +1,101 @@
+"""
+INT8 post training quantization of the pruning models (vit_l2_3keep_senet, lvvit_l2_3keep_senet) on CPU.
+
+Only the nn.Linear layers of the blocks (attn.qkv, attn.proj, mlp.fc1, mlp.fc2) and of the score
+predictors are quantized, which is where nearly all the inference FLOPs are. Everything between them
+stays in float: the patch embedding, LayerNorm, the policy softmax, GELU, the log-softmax of the
+predictor, the gumbel / topk keep decision, the representative token and the heads.
+
+dynamic: weights are INT8, activations are quantized per batch on the fly, no calibration needed.
+static: every quantized Linear gets a QuantStub / DeQuantStub pair whose activation range is
+    calibrated on a few batches, so no range has to be computed at inference time.
+
+infer.py --quantize dynamic|static compares the quantized model with the float one on the validation
+set: accuracy, throughput and the rate at which the keep decisions differ.
+"""
+import copy
+
+import torch
+import torch.nn as nn
+
+
+def quantized_linear_names(model, predictor=True):
+    """ names of the Linear layers to quantize
+
+    The first out_conv Linear of MultiheadPredictorLG is read through its weight (split into a
+    local and a global half), so it stays in float.
+    """
+    names = []
+    for name, m in model.named_modules():
+        if not isinstance(m, nn.Linear):
+            continue
+        if name.startswith('blocks.'):
+            names.append(name)
+        elif predictor and name.startswith('score_predictor.') and not name.endswith('out_conv.0.0'):
+            names.append(name)
+    return names
+
+
+def set_quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in engines:
+            torch.backends.quantized.engine = engine
+            return engine
+    raise RuntimeError('no quantized engine available, supported: {}'.format(engines))
+
+
+def quantize_dynamic(model, predictor=True):
+    """ copy of the model with INT8 weights and dynamically quantized activations in the selected Linears """
+    set_quantized_engine()
+    names = set(quantized_linear_names(model, predictor))
+    return torch.quantization.quantize_dynamic(copy.deepcopy(model).eval(), qconfig_spec=names, dtype=torch.qint8)
+
+
+class QuantizedLinearStub(nn.Module):
+    """ float in, float out around a Linear that torch.quantization.convert turns into an INT8 one """
+    def __init__(self, linear):
+        super().__init__()
+        self.quant = torch.quantization.QuantStub()
+        self.linear = linear
+        self.dequant = torch.quantization.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.linear(self.quant(x)))
+
+
+def _set_module(model, name, module):
+    parent, _, child = name.rpartition('.')
+    setattr(dict(model.named_modules())[parent], child, module)
+
+
+def quantize_static(model, calib_loader, num_batches, device='cpu', predictor=True):
+    """ copy of the model with the selected Linears statically quantized
+
+    The activation ranges are observed over num_batches batches of calib_loader (images, target).
+    """
+    engine = set_quantized_engine()
+    model = copy.deepcopy(model).eval()
+    qconfig = torch.quantization.get_default_qconfig(engine)
+    modules = dict(model.named_modules())
+    for name in quantized_linear_names(model, predictor):
+        stub = QuantizedLinearStub(modules[name])
+        stub.qconfig = qconfig
+        _set_module(model, name, stub)
+    torch.quantization.prepare(model, inplace=True)
+
+    with torch.no_grad():
+        for i, (images, _) in enumerate(calib_loader):
+            if i == num_batches:
+                break
+            model(images.to(device))
+    return torch.quantization.convert(model, inplace=True)
+
+
+def keep_disagreement(telemetry, reference):
+    """ per stage (num_disagree, num_decisions) of the keep decisions of two forwards over the same images """
+    assert len(telemetry.keep_decision) == len(reference.keep_decision), 'no keep decisions in the telemetry'
+    counts = []
+    for keep, ref in zip(telemetry.keep_decision, reference.keep_decision):
+        counts.append(torch.stack([((keep > 0.5) != (ref > 0.5)).sum(), torch.tensor(ref.numel(), device=ref.device)]))
+    return torch.stack(counts).float()
@@ -0,0 +1,315 @@
+"""
+Local inference server with dynamic batching for the pruning models of infer.py.
+
+Requests are POST /predict with an encoded image (jpeg, png, ...) as the body. Decoding and the
+eval transform run in a thread pool; the decoded images wait in a queue and are run by the model
+as one batch as soon as --max-batch-size images are waiting or the first of them has waited
+--max-wait-ms. Under concurrent load the forwards see large batches, with a single client the
+latency is that of a batch of one plus at most --max-wait-ms.
+
+Every response reports the top-5 classes, the latency of the request, the time it spent queued,
+the size of its batch and the queue depth when the batch was formed. GET /stats returns the
+aggregated numbers.
+
+    python serve.py --arch deit_small --model-path model.pth --device cpu --port 8000
+    python serve.py --client 500 --client-concurrency 16 --port 8000
+
+--unix-socket serves (and --client connects) on a unix socket instead of host:port.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from PIL import Image
+
+from datasets import build_transform
+import infer
+
+
+class ServerStats(object):
+    """ request latencies (last window requests) and batch / queue counters of the server """
+    def __init__(self, window=10000):
+        self.latency = deque(maxlen=window)
+        self.queue_time = deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.forward_time = 0.
+        self.start = time.time()
+
+    def add_batch(self, batch_size, queue_depth, forward_time):
+        self.batches += 1
+        self.requests += batch_size
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        self.forward_time += forward_time
+
+    def add_request(self, latency, queue_time):
+        self.latency.append(latency)
+        self.queue_time.append(queue_time)
+
+    def summary(self, queue_depth):
+        stats = {'requests': self.requests, 'batches': self.batches, 'queue_depth': queue_depth,
+                 'max_queue_depth': self.max_queue_depth,
+                 'mean_batch_size': self.requests / max(self.batches, 1),
+                 'forward_img_per_s': self.requests / max(self.forward_time, 1e-9),
+                 'uptime_s': time.time() - self.start}
+        if self.latency:
+            latency = 1000 * np.array(self.latency)
+            stats.update(latency_ms_p50=np.percentile(latency, 50), latency_ms_p99=np.percentile(latency, 99),
+                         queue_ms_mean=1000 * np.mean(self.queue_time))
+        return stats
+
+
+class DynamicBatcher(object):
+    """ collects submitted images into batches and runs them through the model on one worker thread
+
+    A batch is closed when max_batch_size images are waiting or max_wait seconds after its first
+    image arrived. Images that arrive during a forward wait in the queue and form the next batch.
+    """
+    def __init__(self, model, args, device, max_batch_size, max_wait):
+        self.model = model
+        self.args = args
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.stats = ServerStats()
+        self.memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+        self._executor = ThreadPoolExecutor(max_workers=1) # one forward at a time, torch parallelizes inside it
+
+    async def submit(self, image):
+        """ top-5 (class, probability) of one (3, H, W) image and the timings of its batch """
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((image, future, time.time()))
+        return await future
+
+    def forward(self, images):
+        with infer.inference_mode():
+            images = torch.stack(images).to(self.device, memory_format=self.memory_format)
+            with infer.autocast(self.args, self.device):
+                output = self.model(images)
+            output = output[0] if isinstance(output, (tuple, list)) else output
+            prob, index = output.float().softmax(dim=-1).topk(5, dim=-1)
+        return prob.cpu().tolist(), index.cpu().tolist()
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty(): # images queued during the last forward join without waiting
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            queue_depth = self.queue.qsize()
+            start = time.time()
+            try:
+                probs, indices = await loop.run_in_executor(self._executor, self.forward, [b[0] for b in batch])
+            except Exception as e: # fail the requests of this batch, keep serving
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            end = time.time()
+            self.stats.add_batch(len(batch), queue_depth, end - start)
+            for (_, future, arrival), prob, index in zip(batch, probs, indices):
+                self.stats.add_request(end - arrival, start - arrival)
+                future.set_result({
+                    'top5': [[i, p] for i, p in zip(index, prob)], 'latency_ms': 1000 * (end - arrival),
+                    'queue_ms': 1000 * (start - arrival), 'batch_size': len(batch), 'queue_depth': queue_depth})
+            if self.stats.batches % self.args.log_every == 0:
+                print('## {}'.format(json.dumps(self.stats.summary(self.queue.qsize()))))
+
+
+class InferenceServer(object):
+    """ minimal HTTP/1.1 front end (keep-alive, Content-Length bodies) of a DynamicBatcher """
+    def __init__(self, batcher, transform, preprocess_workers):
+        self.batcher = batcher
+        self.transform = transform
+        self._preprocess = ThreadPoolExecutor(max_workers=preprocess_workers)
+
+    def preprocess(self, data):
+        return self.transform(Image.open(io.BytesIO(data)).convert('RGB'))
+
+    async def handle(self, method, path, body):
+        if method == 'POST' and path == '/predict':
+            try:
+                image = await asyncio.get_event_loop().run_in_executor(self._preprocess, self.preprocess, body)
+            except Exception as e:
+                return 400, {'error': 'can not decode the image: {}'.format(e)}
+            return 200, await self.batcher.submit(image)
+        if method == 'GET' and path == '/stats':
+            return 200, self.batcher.stats.summary(self.batcher.queue.qsize())
+        return 404, {'error': 'unknown endpoint {} {}'.format(method, path)}
+
+    async def serve_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                try:
+                    status, result = await self.handle(method, path, body)
+                except Exception as e:
+                    status, result = 500, {'error': str(e)}
+                write_response(writer, status, result)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+def write_response(writer, status, result):
+    body = json.dumps(result).encode()
+    writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(
+        status, REASONS[status], len(body)).encode() + body)
+
+
+async def read_response(reader):
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        if key.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def open_connection(args):
+    if args.unix_socket:
+        return await asyncio.open_unix_connection(args.unix_socket)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def serve(args):
+    device = infer.setup_runtime(args)
+    if not args.model_path:
+        print('Warning: no --model-path, serving random weights')
+    model = infer.build_model(args, device)
+    batcher = DynamicBatcher(model, args, device, args.max_batch_size, args.max_wait_ms / 1000)
+    with infer.inference_mode(): # the first forwards are slow, keep them out of the request latencies
+        for batch_size in sorted({1, args.max_batch_size}):
+            batcher.forward([torch.zeros(3, args.input_size, args.input_size)] * batch_size)
+    server = InferenceServer(batcher, build_transform(False, args), args.preprocess_workers)
+    asyncio.ensure_future(batcher.run())
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        listener = await asyncio.start_unix_server(server.serve_connection, path=args.unix_socket)
+        print('## serving {} on unix socket {}'.format(args.arch, args.unix_socket))
+    else:
+        listener = await asyncio.start_server(server.serve_connection, args.host, args.port)
+        print('## serving {} on http://{}:{}'.format(args.arch, args.host, args.port))
+    async with listener:
+        await listener.serve_forever()
+
+
+def client_payloads(args):
+    """ encoded images sent by the client: --client-images, or random jpegs of the input size """
+    if args.client_images:
+        payloads = []
+        for path in args.client_images:
+            with open(path, 'rb') as f:
+                payloads.append(f.read())
+        return payloads
+    rng = np.random.RandomState(args.seed)
+    payloads = []
+    for _ in range(8):
+        buf = io.BytesIO()
+        size = int(args.input_size * 256 / 224)
+        Image.fromarray(rng.randint(0, 256, (size, size, 3), dtype=np.uint8)).save(buf, format='JPEG')
+        payloads.append(buf.getvalue())
+    return payloads
+
+
+async def run_client(args):
+    """ sends --client requests over --client-concurrency keep-alive connections and reports the latencies """
+    payloads = client_payloads(args)
+    counter = iter(range(args.client))
+    latencies, batch_sizes = [], []
+
+    async def worker():
+        reader, writer = await open_connection(args)
+        for i in counter:
+            body = payloads[i % len(payloads)]
+            start = time.time()
+            writer.write('POST /predict HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n\r\n'.format(
+                args.host, len(body)).encode() + body)
+            await writer.drain()
+            status, result = await read_response(reader)
+            assert status == 200, result
+            latencies.append(time.time() - start)
+            batch_sizes.append(result['batch_size'])
+        writer.close()
+
+    start = time.time()
+    await asyncio.gather(*[worker() for _ in range(args.client_concurrency)])
+    elapsed = time.time() - start
+    latency = 1000 * np.array(latencies)
+    print('{} requests, concurrency {}: {:.1f} img/s, latency p50 {:.1f} ms p99 {:.1f} ms, mean batch size {:.1f}'.format(
+        len(latencies), args.client_concurrency, len(latencies) / elapsed, np.percentile(latency, 50),
+        np.percentile(latency, 99), np.mean(batch_sizes)))
+
+    reader, writer = await open_connection(args)
+    writer.write(b'GET /stats HTTP/1.1\r\nConnection: close\r\n\r\n')
+    print('server stats:', (await read_response(reader))[1])
+    writer.close()
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Inference server', add_help=False)
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix-socket', default='', type=str, help='serve on this unix socket instead of host:port')
+    parser.add_argument('--max-batch-size', default=32, type=int)
+    parser.add_argument('--max-wait-ms', default=5., type=float,
+                        help='longest time the first image of a batch waits for more images')
+    parser.add_argument('--preprocess-workers', default=4, type=int, help='threads decoding and transforming images')
+    parser.add_argument('--log-every', default=100, type=int, help='print the server stats every this many batches')
+
+    # client
+    parser.add_argument('--client', default=0, type=int, help='send this many requests to a running server and exit')
+    parser.add_argument('--client-concurrency', default=16, type=int, help='concurrent client connections')
+    parser.add_argument('--client-images', default=[], nargs='*', help='image files to send, random jpegs by default')
+    return parser
+
+
+def main(args):
+    asyncio.run(run_client(args) if args.client else serve(args))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Inference server', parents=[get_args_parser(), infer.get_args_parser()])
+    args = parser.parse_args()
+    main(args)
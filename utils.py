@@ -5,11 +5,18 @@ Misc functions, including distributed helpers.
 Mostly copy-paste from torchvision references.
 """
 import io
+import contextlib
 import os
 import time
-from collections import defaultdict, deque
+import json
+import atexit
+import queue
+import threading
+from collections import defaultdict, deque, OrderedDict
 import datetime
+from typing import List, Optional
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.distributed as dist
@@ -39,7 +46,7 @@ class SmoothedValue(object):
         """
         if not is_dist_avail_and_initialized():
             return
-        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda')
+        t = torch.tensor([self.count, self.total], dtype=torch.float64, device='cuda' if dist.get_backend() == 'nccl' else 'cpu')
         dist.barrier()
         dist.all_reduce(t)
         t = t.tolist()
@@ -159,6 +166,59 @@ class MetricLogger(object):
             header, total_time_str, total_time / len(iterable)))
 
 
+class Prefetcher(object):
+    """ iterates the (images, target) batches of a loader with the following batches already in flight
+
+    A background thread takes up to depth batches ahead from the loader, so decoding and collation
+    overlap the forward even without loader workers, and pins them when the device is cuda. On cuda
+    the copy of the next batch is issued on a side stream before the current batch is returned,
+    so it overlaps the forward of the current one. Images are returned in memory_format.
+    """
+    def __init__(self, loader, device, memory_format=torch.contiguous_format, depth=2):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.memory_format = memory_format
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _produce(self, batches):
+        try:
+            for images, target in self.loader:
+                if self.device.type == 'cuda' and not images.is_pinned():
+                    images, target = images.pin_memory(), target.pin_memory()
+                batches.put((images, target))
+        except Exception as e: # raised again by the consumer
+            batches.put(e)
+        batches.put(None)
+
+    def _to_device(self, batch, stream):
+        if batch is None or isinstance(batch, Exception):
+            return batch
+        images, target = batch
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            images = images.to(self.device, non_blocking=True, memory_format=self.memory_format)
+            target = target.to(self.device, non_blocking=True)
+        return images, target
+
+    def __iter__(self):
+        batches = queue.Queue(maxsize=self.depth)
+        threading.Thread(target=self._produce, args=(batches,), daemon=True).start()
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        next_batch = self._to_device(batches.get(), stream)
+        while next_batch is not None:
+            if isinstance(next_batch, Exception):
+                raise next_batch
+            if stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(stream)
+                for t in next_batch: # allocated on the side stream, used on the current one
+                    t.record_stream(torch.cuda.current_stream(self.device))
+            batch = next_batch
+            next_batch = self._to_device(batches.get(), stream)
+            yield batch
+
+
 def _load_checkpoint_for_ema(model_ema, checkpoint):
     """
     Workaround for ModelEma._load_checkpoint to accept an already-loaded object
@@ -257,6 +317,660 @@ def batch_index_select(x, idx):
         raise NotImplementedError
 
 
+def gumbel_keep_decision(pred_score, index=None, num_tokens=None, tau=1.0):
+    """ hard keep decision (B, N, 1), same as F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1]
+
+    When the forward runs on a compacted token set, pred_score only holds the tokens
+    at `index` of the full `num_tokens` long sequence. The gumbel noise is then drawn
+    for the full sequence and gathered, so the compact and the masked forward sample
+    the same decisions from the same random state.
+    """
+    if index is None:
+        return F.gumbel_softmax(pred_score, tau=tau, hard=True)[:, :, 0:1]
+    B = pred_score.size(0)
+    gumbels = -torch.empty(B, num_tokens, 2, dtype=pred_score.dtype, device=pred_score.device).exponential_().log()
+    gumbels = batch_index_select(gumbels, index)
+    y_soft = ((pred_score + gumbels) / tau).softmax(dim=-1)
+    y_hard = (y_soft[:, :, 0:1] >= y_soft[:, :, 1:2]).to(y_soft.dtype) # argmax picks the first index on ties
+    return y_hard - y_soft[:, :, 0:1].detach() + y_soft[:, :, 0:1]
+
+
+def compact_keep_order(keep_decision):
+    """ indices that gather the kept tokens of every image to the front, in spatial order
+
+    keep_decision: (B, N, 1) hard 0/1 decision. Returns (order, num_keep) where order is
+    (B, K) with K the largest keep count in the batch; images keeping fewer tokens are
+    padded with dropped tokens, which the caller masks out through the policy.
+    """
+    B, N, _ = keep_decision.size()
+    keep = keep_decision[:, :, 0] > 0.5
+    num_keep = keep.sum(dim=1)
+    position = torch.arange(N, device=keep_decision.device).view(1, N)
+    order = torch.argsort((~keep).long() * N + position, dim=1) # kept tokens first, then dropped ones
+    return order[:, :int(num_keep.max())], num_keep
+
+
+def rebucket_tokens(x, policy, num_keep, bucket_size):
+    """ split a padded compact batch into sub-batches of images with similar keep counts
+
+    x: (B, 1 + S + R, C) cls, S kept / padding slots and R representative tokens, with S the
+    largest of the (B,) keep counts num_keep, policy: (B, 1 + S + R, 1). The images are sorted by
+    num_keep and cut into buckets of bucket_size images, and every bucket keeps only the slots its
+    images use. The blocks up to the next pruning location then compute the padding of the worst
+    image of each bucket instead of the worst image of the batch.
+    Returns [(index, x, policy)] with index the batch positions of the bucket's images.
+    """
+    order = num_keep.argsort()
+    counts = num_keep[order].tolist() # one host sync for all buckets
+    num_slots = counts[-1]
+    buckets = []
+    for start in range(0, len(counts), bucket_size):
+        index = order[start:start + bucket_size]
+        used = counts[min(start + bucket_size, len(counts)) - 1]
+        cut = torch.cat([torch.arange(1 + used), torch.arange(1 + num_slots, x.size(1))]).to(x.device)
+        buckets.append((index, x[index][:, cut], policy[index][:, cut]))
+    return buckets
+
+
+def unbucket_tokens(buckets, num_slots, num_rep):
+    """ padded (B, 1 + num_slots + num_rep, C) batch in the original order from rebucket_tokens buckets [(index, x)] """
+    batch_size = sum(index.numel() for index, _ in buckets)
+    x = buckets[0][1]
+    out = x.new_zeros(batch_size, 1 + num_slots + num_rep, x.size(-1))
+    for index, x in buckets:
+        used = x.size(1) - num_rep
+        out[index, :used] = x[:, :used]
+        out[index, 1 + num_slots:] = x[:, used:]
+    return out
+
+
+def pack_tokens(x, policy):
+    """ drop the policy-masked tokens of a padded (B, N, C) batch and pack the rest back to back
+
+    Returns the packed (T, C) rows, the (B, N) bool mask used to pack them and the (T,) index of
+    every row in the flattened (B * N) batch. Both stay on the device and are computed once per
+    stage (the nonzero is the only host sync), unpack_tokens and the packed attention scatter
+    the rows back with the index.
+    """
+    mask = policy[:, :, 0] > 0.5
+    index = mask.flatten().nonzero().squeeze(1)
+    return x.flatten(0, 1).index_select(0, index), mask, index
+
+
+def unpack_tokens(x, mask, index):
+    """ inverse of pack_tokens, masked positions are filled with zeros """
+    B, N = mask.size()
+    return x.new_zeros(B * N, x.size(-1)).index_copy_(0, index, x).reshape(B, N, -1)
+
+
+class StagePolicy(object):
+    """ attention policy of one pruning stage
+
+    Built once at a pruning location from the (B, N, 1) keep policy and shared by every block
+    until the next one. Dropped tokens are masked out as keys but still attend to themselves,
+    like the eye term of softmax_with_policy. With live_rows=True the attention layers call
+    live_attention and skip the query rows of dropped tokens, with live_mlp=True the blocks run
+    LayerNorm + MLP through live_tokens on the live rows only.
+
+    live_rows and live_mlp only apply without autograd. In training the stale values of dropped tokens
+    would still reach the next predictor and representative token through the straight-through
+    terms of their decisions, and change the gradients, so the full masked rows are computed.
+    """
+    def __init__(self, policy, live_rows=False, live_mlp=False):
+        B, N, _ = policy.size()
+        self.policy = policy
+        self.key_policy = policy.reshape(B, 1, 1, N).float()
+        self.self_policy = 1.0 - policy.reshape(B, 1, N).float() # gives dropped tokens their own key back
+        self.live_rows = live_rows and not torch.is_grad_enabled()
+        self.live_mlp = live_mlp and not torch.is_grad_enabled()
+        self._attn_policy = None
+        self._live = None
+
+    @property
+    def attn_policy(self):
+        """ full (B, 1, N, N) mask, only built for the autograd path """
+        if self._attn_policy is None:
+            N = self.key_policy.size(-1)
+            eye = torch.eye(N, dtype=self.key_policy.dtype, device=self.key_policy.device).view(1, 1, N, N)
+            self._attn_policy = self.key_policy + (1.0 - self.key_policy) * eye
+        return self._attn_policy
+
+    def softmax(self, attn, eps=1e-6):
+        """ masked softmax of the (B, H, N, N) attention logits, computed in fp32
+
+        Without autograd the logits buffer is reused in place and the N x N mask is never
+        materialized: keys are masked with the (B, 1, 1, N) policy and the self attention of
+        dropped tokens is put back on the diagonal.
+        """
+        N = attn.size(-1)
+        if attn.requires_grad:
+            max_att = torch.max(attn, dim=-1, keepdim=True)[0]
+            out = (attn - max_att).to(torch.float32).exp() * self.attn_policy
+            out = (out + eps/N) / (out.sum(dim=-1, keepdim=True) + eps)
+            return out.type_as(attn)
+
+        out = attn.to(torch.float32) # no copy for fp32 logits
+        out.sub_(out.amax(dim=-1, keepdim=True)).exp_()
+        diag = out.diagonal(dim1=-2, dim2=-1)
+        self_attn = diag * self.self_policy
+        out.mul_(self.key_policy)
+        diag.add_(self_attn)
+        denom = out.sum(dim=-1, keepdim=True).add_(eps)
+        out.add_(eps/N).div_(denom)
+        return out.type_as(attn)
+
+    def live_index(self):
+        """ (B, K) positions of the live tokens of every image, padded with dropped ones, and the
+        StagePolicy of those K tokens. Computed once per stage. """
+        if self._live is None:
+            order, _ = compact_keep_order(self.policy)
+            self._live = (order, StagePolicy(batch_index_select(self.policy, order)))
+        return self._live
+
+    def live_attention(self, q, k, v, eps=1e-6, attn_drop=None, chunk_size=None):
+        """ masked attention that only computes the query rows of live tokens
+
+        q (already scaled), k, v: (B, H, N, d). The outputs of dropped tokens never reach a kept
+        token again, so their q @ k rows are skipped and they just keep their own value. The keys
+        are cut down to the live tokens as well and the cost is K x K instead of N x N. Without
+        autograd only (see StagePolicy). chunk_size runs the K x K part through chunked_attention (eps=0).
+        """
+        B, H, N, d = q.size()
+        order, live_stage = self.live_index()
+        K = order.size(1)
+        index = order.view(B, 1, K, 1).expand(-1, H, -1, d)
+        q = q.gather(2, index)
+        if chunk_size:
+            out = chunked_attention(q, k.gather(2, index), v.gather(2, index), live_stage, chunk_size)
+        else:
+            attn = live_stage.softmax(q @ k.gather(2, index).transpose(-2, -1), eps)
+            if attn_drop is not None:
+                attn = attn_drop(attn)
+            out = attn @ v.gather(2, index)
+        return v.scatter(2, index, out.type_as(v))
+
+    def live_tokens(self, fn, x):
+        """ apply the token-wise fn to the live rows of x (B, N, C) only
+
+        Returns the (B, N, C') output with zeros for dropped tokens. The live outputs are multiplied
+        by their policy (1 for real tokens, 0 for padding). Without autograd only (see StagePolicy).
+        """
+        B, N, C = x.size()
+        order, live_stage = self.live_index()
+        index = order.unsqueeze(-1).expand(-1, -1, C)
+        out = fn(x.gather(1, index)) * live_stage.policy
+        index = order.unsqueeze(-1).expand(-1, -1, out.size(-1))
+        return out.new_zeros(B, N, out.size(-1)).scatter(1, index, out)
+
+
+def chunked_attention(q, k, v, policy=None, chunk_size=128):
+    """ softmax(q @ k^T) @ v with the masking of StagePolicy.softmax (eps=0), without autograd
+
+    q (already scaled), k, v: (B, H, N, d). Blocks of chunk_size queries run against blocks of
+    chunk_size keys with a running max and sum (online softmax), so only (B, H, chunk_size,
+    chunk_size) logits exist at a time and the memory grows linearly with N instead of the
+    (B, H, N, N) of the full attention. Query and key blocks share their boundaries, so the
+    self attention of dropped tokens always sits on the diagonal of the qs == ks block.
+    """
+    B, H, N, d = q.size()
+    out = torch.empty(B, H, N, v.size(-1), dtype=torch.float32, device=v.device)
+    for qs in range(0, N, chunk_size):
+        qe = min(qs + chunk_size, N)
+        q_chunk = q[:, :, qs:qe].float()
+        row_max = q_chunk.new_full((B, H, qe - qs, 1), float('-inf'))
+        row_sum = q_chunk.new_zeros(B, H, qe - qs, 1)
+        acc = q_chunk.new_zeros(B, H, qe - qs, v.size(-1))
+        for ks in range(0, N, chunk_size):
+            ke = min(ks + chunk_size, N)
+            attn = q_chunk @ k[:, :, ks:ke].float().transpose(-2, -1)
+            new_max = torch.max(row_max, attn.amax(dim=-1, keepdim=True))
+            attn.sub_(new_max).exp_()
+            if policy is not None and qs == ks: # dropped queries keep their own key, like StagePolicy.softmax
+                diag = attn.diagonal(dim1=-2, dim2=-1)
+                self_attn = diag * policy.self_policy[:, :, qs:qe]
+                attn.mul_(policy.key_policy[..., ks:ke])
+                diag.add_(self_attn)
+            elif policy is not None:
+                attn.mul_(policy.key_policy[..., ks:ke])
+            scale = (row_max - new_max).exp_()
+            row_sum.mul_(scale).add_(attn.sum(dim=-1, keepdim=True))
+            acc.mul_(scale).add_(attn @ v[:, :, ks:ke].float())
+            row_max = new_max
+        out[:, :, qs:qe] = acc.div_(row_sum)
+    return out.type_as(v)
+
+
+def topk_keep_index(score, num_keep: int, position: Optional[torch.Tensor] = None, tie_eps: float = 1e-6):
+    """ indices (B, num_keep) of the num_keep highest scores of every image, in spatial order
+
+    torch.topk avoids the full sort of argsort, and sorting the few selected indices keeps
+    the kept tokens in the order they had in the image. Scores closer than tie_eps are
+    broken towards the lower original token position (position: (B, N), default the index),
+    so a graph that sums in another order (onnxruntime, a frozen TorchScript graph) keeps the
+    same tokens.
+    """
+    if position is None:
+        position = torch.arange(score.size(1), device=score.device).view(1, -1)
+    score = score - position.to(score.dtype) * tie_eps
+    index = torch.topk(score, num_keep, dim=1, sorted=False)[1]
+    return index.sort(dim=1)[0]
+
+
+def topk_keep_decision(score, num_keep, prev_decision):
+    """ hard keep decision (B, N, 1) that keeps exactly num_keep live tokens of every image
+
+    score: (B, N) keep score, prev_decision: (B, N, 1). Tokens dropped at an earlier stage
+    can not be picked again. Used by the budget='topk' inference mode.
+    """
+    score = score.masked_fill(prev_decision[:, :, 0] < 0.5, float('-inf'))
+    index = topk_keep_index(score, num_keep)
+    return torch.zeros_like(prev_decision).scatter_(1, index.unsqueeze(-1), 1.0)
+
+
+def threshold_keep_decision(score, threshold, prev_decision):
+    """ hard keep decision (B, N, 1) that keeps the live tokens whose score is at least threshold
+
+    Used by the budget='threshold' inference mode: the keep count follows the content of every
+    image instead of being fixed, and no sort is needed. Every image keeps at least its best live
+    token so a stage can not empty an image.
+    """
+    live = prev_decision[:, :, 0] > 0.5
+    keep = ((score >= threshold) & live).unsqueeze(-1).to(prev_decision.dtype)
+    best = score.masked_fill(~live, float('-inf')).argmax(dim=1, keepdim=True)
+    return keep.scatter_(1, best.unsqueeze(-1), 1.0)
+
+
+class PruningStage(nn.Module):
+    """ keep decision, representative token and policy of one pruning location
+
+    Shared by the pruning forwards of vit_l2_3keep_senet, lvvit_l2_3keep_senet and pit. The
+    decision only covers the first num_tokens (spatial) tokens, the representative tokens after
+    them are always kept. The representative token is the sum of the tokens dropped at this stage
+    weighted by their keep score, computed as one (B, 1, N) @ (B, N, C) matmul. The policy of
+    the stage is written into a (B, num_prefix + num_tokens + R, 1) buffer of ones that the
+    forward allocates once for all its stages (see policy()).
+    """
+    def __init__(self, num_prefix=1):
+        super().__init__()
+        self.num_prefix = num_prefix
+
+    def keep_decision(self, pred_score, prev_decision, num_tokens, budget=None, num_keep=None, threshold=None):
+        """ (B, num_tokens, 1) hard keep decision of the spatial tokens, see the budget argument of the models """
+        if not self.training and budget == 'topk':
+            return topk_keep_decision(pred_score[:, :num_tokens, 0], num_keep, prev_decision[:, :num_tokens])
+        if not self.training and budget == 'threshold':
+            return threshold_keep_decision(pred_score[:, :num_tokens, 0], threshold, prev_decision[:, :num_tokens])
+        # sampled over all tokens, so the random stream does not depend on how many are spatial
+        return F.gumbel_softmax(pred_score, hard=True)[:, :num_tokens, 0:1] * prev_decision[:, :num_tokens]
+
+    def representative_token(self, spatial_x, softmax_score, keep, prev_decision, normalize=False):
+        """ (B, 1, C) keep score weighted sum of the spatial tokens dropped at this stage
+
+        normalize divides by the summed weights (the PiT variant).
+        """
+        num_tokens = keep.size(1)
+        placeholder_score = softmax_score[:, :num_tokens, 0:1] * (prev_decision[:, :num_tokens] - keep)
+        represent_token = placeholder_score.transpose(1, 2) @ spatial_x[:, :num_tokens]
+        if normalize:
+            represent_token = represent_token / placeholder_score.sum(dim=1, keepdim=True)
+        return represent_token
+
+    def policy(self, policy, keep, num_rep):
+        """ (policy, stage policy): keep written over the spatial entries of policy and the view
+        of its first num_prefix + num_tokens + num_rep entries
+
+        policy holds ones for the prefix and the representative slots. Without autograd keep is
+        written in place, so a stage allocates nothing; with autograd the previous policy can be
+        saved for backward and a new one is put together with a single cat.
+        """
+        P, N = self.num_prefix, keep.size(1)
+        if torch.is_grad_enabled():
+            policy = torch.cat([policy[:, :P], keep, policy[:, P + N:]], dim=1)
+        else:
+            policy[:, P:P + N] = keep
+        return policy, policy[:, :P + N + num_rep]
+
+    def forward(self, spatial_x, pred_score, softmax_score, prev_decision, num_tokens, budget=None, num_keep=None,
+                threshold=None, normalize=False):
+        """ (B, num_tokens, 1) keep decision and (B, 1, C) representative token of the stage
+
+        spatial_x: (B, N, C) tokens after the prefix, pred_score / softmax_score: (B, N, 2) of the
+        score predictor, prev_decision: (B, N, 1) of which the first num_tokens can be dropped.
+        """
+        keep = self.keep_decision(pred_score, prev_decision, num_tokens, budget, num_keep, threshold)
+        return keep, self.representative_token(spatial_x, softmax_score, keep, prev_decision, normalize)
+
+
+def calibrate_keep_thresholds(model, data_loader, token_ratios, num_batches, device='cpu'):
+    """ per stage score thresholds that keep token_ratios of the tokens on average, for budget='threshold'
+
+    token_ratios is a list of per stage keep ratios (like the token_ratio argument of the models).
+    Every budget runs the model with budget='topk' at its ratios over num_batches batches of
+    data_loader (images, target), and the keep scores of the live tokens of every stage are pooled
+    over all images; the threshold is the score of the last token that the topk budget keeps over
+    the whole pool. Returns a list of per stage threshold lists, one for every budget.
+    """
+    predictors = list(model.score_predictor)
+    scores = [[] for _ in predictors]
+
+    def record(p):
+        def hook(module, inputs, outputs):
+            spatial_x, prev_decision = inputs
+            score = outputs[0].reshape(spatial_x.size(0), -1, 2)[:, :spatial_x.size(1) - p, 0] # no rep tokens
+            live = prev_decision[:, :score.size(1), 0] > 0.5
+            scores[p].append(score[live].float().cpu())
+        return hook
+
+    saved = model.training, model.budget, model.token_ratio
+    handles = [m.register_forward_hook(record(p)) for p, m in enumerate(predictors)]
+    thresholds = []
+    try:
+        model.eval()
+        for ratios in token_ratios:
+            assert len(ratios) == len(predictors), 'need one keep ratio per pruning stage'
+            model.budget, model.token_ratio = 'topk', list(ratios)
+            for s in scores:
+                del s[:]
+            num_images, init_n = 0, None
+            with torch.no_grad():
+                for i, (images, _) in enumerate(data_loader):
+                    if i == num_batches:
+                        break
+                    images = images.to(device, non_blocking=True)
+                    model(images)
+                    num_images += images.size(0)
+                    init_n = scores[0][-1].numel() // images.size(0)
+            stage_thresholds = []
+            for p, ratio in enumerate(ratios):
+                pool = torch.cat(scores[p])
+                num_keep = num_images * int(init_n * ratio)
+                stage_thresholds.append(torch.topk(pool, num_keep)[0][-1].item())
+            thresholds.append(stage_thresholds)
+    finally:
+        for h in handles:
+            h.remove()
+        model.budget, model.token_ratio = saved[1:]
+        model.train(saved[0])
+    return thresholds
+
+
+def load_budget_table(path):
+    """ {name: {'token_ratio': [...], 'threshold': [...]}} of an infer.py --calibrate-budgets table """
+    with open(path) as f:
+        return json.load(f)['budgets']
+
+
+def interpolate_pos_embed(pos_embed, grid: List[int], new_grid: List[int], num_prefix: int = 1):
+    """ pos_embed (1, num_prefix + H * W, C) of the (H, W) grid bilinearly resized to new_grid, scriptable """
+    prefix, pos_grid = pos_embed[:, :num_prefix], pos_embed[:, num_prefix:]
+    pos_grid = pos_grid.reshape(1, grid[0], grid[1], -1).permute(0, 3, 1, 2)
+    pos_grid = F.interpolate(pos_grid, size=(new_grid[0], new_grid[1]), mode='bilinear', align_corners=False)
+    return torch.cat([prefix, pos_grid.flatten(2).transpose(1, 2)], dim=1)
+
+
+class PosEmbedCache(object):
+    """ pos_embed of the training patch grid resized to the patch grid of the input
+
+    pos_embed: (1, num_prefix + H * W, C) with grid = (H, W). The grid part is bilinearly
+    interpolated like resize_pos_embed, for any height and width. Without autograd the result is
+    kept in an LRU of maxsize grids, so a repeated input size costs nothing; the cache is dropped
+    when pos_embed changes (new weights, an optimizer step). With autograd it is always recomputed
+    so that pos_embed gets its gradient.
+    """
+    def __init__(self, grid, num_prefix=1, maxsize=8):
+        self.grid = tuple(grid)
+        self.num_prefix = num_prefix
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._key = None
+
+    def resize(self, pos_embed, grid):
+        return interpolate_pos_embed(pos_embed, list(self.grid), list(grid), self.num_prefix)
+
+    def __call__(self, pos_embed, grid):
+        grid = tuple(grid)
+        if grid == self.grid:
+            return pos_embed
+        if torch.is_grad_enabled() and pos_embed.requires_grad:
+            return self.resize(pos_embed, grid)
+        key = (pos_embed.data_ptr(), pos_embed._version, pos_embed.dtype)
+        if key != self._key:
+            self._cache.clear()
+            self._key = key
+        if grid in self._cache:
+            self._cache.move_to_end(grid)
+        else:
+            self._cache[grid] = self.resize(pos_embed.detach(), grid)
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return self._cache[grid]
+
+
+def load_inference_profile(path, arch=None, base_rate=None):
+    """ best configuration ({'batch_size', 'threads', 'inference_mode', ...}) of an infer.py --autotune profile """
+    with open(path) as f:
+        profile = json.load(f)
+    assert arch is None or profile['arch'] == arch, 'profile {} was tuned for {}, not {}'.format(path, profile['arch'], arch)
+    if base_rate is not None and profile['base_rate'] != base_rate:
+        print('Warning: profile {} was tuned with base_rate {}, running {}'.format(path, profile['base_rate'], base_rate))
+    return profile['best']
+
+
+def policy_sparsity(policy):
+    """ (2,) float tensor [zeros, non_zeros] of a keep policy, counted on the policy's device
+
+    Same numbers as test_irregular_sparsity, but without copying the policy to the host.
+    """
+    non_zeros = torch.count_nonzero(policy).float()
+    return torch.stack([policy.numel() - non_zeros, non_zeros])
+
+
+def _add_stages(a, b):
+    if not a:
+        return list(b)
+    out = []
+    for x, y in zip(a, b):
+        if x.shape != y.shape: # keep histograms of forwards at different resolutions
+            n = max(x.numel(), y.numel())
+            x, y = F.pad(x, (0, n - x.numel())), F.pad(y, (0, n - y.numel()))
+        out.append(x + y)
+    return out
+
+
+class PruningTelemetry(object):
+    """ pruning statistics of the eval forwards, filled and summed on the device
+
+    Per pruning stage it holds the [zeros, non_zeros] count of the keep policy, a histogram of
+    the number of tokens each image keeps and the summed L2 norm of the representative tokens.
+    A forward fills one with add_stage() and returns it. evaluate() sums the forwards with
+    update(), all-reduces them once with synchronize_between_processes() and reads them back
+    with summary(). update() also takes the plain (stages, 2) sparse counts of the older models.
+    The per token keep decisions of the forward are kept in keep_decision, they are not summed.
+    """
+    def __init__(self):
+        self.sparse = []
+        self.keep_hist = []
+        self.rep_norm = []
+        self.keep_decision = []
+
+    def add_stage(self, sparse, num_keep, num_tokens, represent_token, keep_decision=None):
+        """ sparse: (2,) counts of the stage policy, num_keep: (B,) int kept tokens of every image
+        out of num_tokens, represent_token: (B, 1, C), keep_decision: (B, num_tokens) 0/1 decision
+        at the original token positions """
+        if keep_decision is not None:
+            self.keep_decision.append(keep_decision)
+        hist = torch.zeros(num_tokens + 1, device=num_keep.device)
+        self.sparse.append(sparse.float())
+        self.keep_hist.append(hist.index_add_(0, num_keep.long(), torch.ones(num_keep.numel(), device=num_keep.device)))
+        self.rep_norm.append(represent_token.detach().float().norm(dim=-1).sum())
+
+    def update(self, other):
+        if not isinstance(other, PruningTelemetry):
+            other = torch.as_tensor(other, dtype=torch.float)
+            self.sparse = _add_stages(self.sparse, other.unbind(0))
+            return
+        self.sparse = _add_stages(self.sparse, other.sparse)
+        self.keep_hist = _add_stages(self.keep_hist, other.keep_hist)
+        self.rep_norm = _add_stages(self.rep_norm, other.rep_norm)
+
+    def synchronize_between_processes(self):
+        """ sum over the processes with a single all_reduce """
+        if not is_dist_avail_and_initialized() or not self.sparse:
+            return
+        stats = self.sparse + self.keep_hist + self.rep_norm
+        t = torch.cat([s.reshape(-1) for s in stats])
+        if dist.get_backend() == 'nccl':
+            t = t.cuda()
+        dist.barrier()
+        dist.all_reduce(t)
+        stats = [s.view_as(old) for s, old in zip(t.split([s.numel() for s in stats]), stats)]
+        num_stages = len(self.sparse)
+        self.sparse = stats[:num_stages]
+        self.keep_hist = stats[num_stages:num_stages + len(self.keep_hist)]
+        self.rep_norm = stats[num_stages + len(self.keep_hist):]
+
+    def summary(self):
+        """ per stage sparsity, mean number of kept tokens and mean representative token norm """
+        out = {}
+        for i, sparse in enumerate(self.sparse):
+            zeros, non_zeros = sparse.tolist()
+            out['sparsity{}'.format(i)] = zeros / (zeros + non_zeros)
+        for i, (hist, rep_norm) in enumerate(zip(self.keep_hist, self.rep_norm)):
+            hist = hist.cpu()
+            num_images = hist.sum().item()
+            out['keep{}'.format(i)] = (hist * torch.arange(len(hist))).sum().item() / num_images
+            out['rep_norm{}'.format(i)] = rep_norm.item() / num_images
+        return out
+
+
+# one entry per recorded pruning stage in the .idx file of a score shard
+SCORE_INDEX_DTYPE = np.dtype([('record', '<i8'), ('stage', '<i4'), ('num_scores', '<i4'),
+                              ('num_keep', '<i4'), ('offset', '<i8')])
+
+
+class ScoreLog(object):
+    """ records the keep scores and decisions of sampled eval forwards into binary shards
+
+    sample() is called once per eval forward and picks every 1 / sample_rate-th forward. The
+    forward collects the (score, keep) tensors of the first image at every pruning stage and hands
+    them to append(), which only starts the copy to the host and puts them on a bounded queue; when
+    the queue is full the record is dropped rather than stalling the forward. A background thread
+    writes the scores as fp16 and the decisions bit-packed to <path>/shard_<pid>_<n>.bin and one
+    SCORE_INDEX_DTYPE entry per stage to the matching .idx file, starting a new shard every
+    shard_records records. read_score_shard loads a shard back.
+
+    Pruning stages whose representative token had to be cleaned of NaNs are counted on the device
+    and reported by flush(), which also waits until the queue is written and runs at exit.
+    """
+    def __init__(self, path, sample_rate=1.0, queue_size=64, shard_records=10000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.shard_records = shard_records
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.num_forwards = 0
+        self.num_dropped = 0
+        self.nan_count = 0
+        self._credit = 0.
+        self._thread = None
+        self._num_shards = 0
+        self._shard_len = 0
+        self._bin = self._idx = None
+        atexit.register(self.flush)
+
+    def sample(self):
+        """ whether the current eval forward is recorded """
+        self.num_forwards += 1
+        self._credit += self.sample_rate
+        if self._credit < 1:
+            return False
+        self._credit -= 1
+        return True
+
+    def append(self, stages):
+        """ stages: [(score (N,), keep decision (M,)) of the first image for every pruning stage] """
+        host = [(score.detach().half().to('cpu', non_blocking=True), (keep > 0.5).to('cpu', non_blocking=True))
+                for score, keep in stages]
+        event = None
+        if stages[0][0].is_cuda: # the worker waits for the copies, not the forward
+            event = torch.cuda.Event()
+            event.record()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._drain, daemon=True)
+            self._thread.start()
+        try:
+            self.queue.put_nowait((self.num_forwards - 1, host, event))
+        except queue.Full:
+            self.num_dropped += 1
+
+    def nan_to_num(self, x, nan):
+        self.nan_count = self.nan_count + torch.isnan(x).any()
+        return torch.nan_to_num(x, nan=nan)
+
+    def _drain(self):
+        while True:
+            record, stages, event = self.queue.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                self._write(record, stages)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, record, stages):
+        if self._bin is None or self._shard_len >= self.shard_records:
+            self._open_shard()
+        index = np.zeros(len(stages), dtype=SCORE_INDEX_DTYPE)
+        for stage, (score, keep) in enumerate(stages):
+            index[stage] = (record, stage, score.numel(), keep.numel(), self._bin.tell())
+            self._bin.write(score.numpy().tobytes())
+            self._bin.write(np.packbits(keep.numpy()).tobytes())
+        self._idx.write(index.tobytes())
+        self._shard_len += 1
+
+    def _open_shard(self):
+        if self._bin is not None:
+            self._bin.close()
+            self._idx.close()
+        os.makedirs(self.path, exist_ok=True)
+        name = os.path.join(self.path, 'shard_{}_{:05d}'.format(os.getpid(), self._num_shards))
+        self._bin = open(name + '.bin', 'wb')
+        self._idx = open(name + '.idx', 'wb')
+        self._num_shards += 1
+        self._shard_len = 0
+
+    def flush(self):
+        self.queue.join()
+        if self._bin is not None:
+            self._bin.flush()
+            self._idx.flush()
+        if int(self.nan_count):
+            print('has nan in {} pruning stages'.format(int(self.nan_count)))
+        self.nan_count = 0
+        if self.num_dropped:
+            print('score log: {} records dropped, the writer could not keep up'.format(self.num_dropped))
+            self.num_dropped = 0
+
+
+def read_score_shard(name):
+    """ records of a ScoreLog shard, name is the shard path without .bin / .idx
+
+    Returns one dict per recorded stage with the record (forward) number, the stage, the fp16
+    keep scores and the bool keep decisions.
+    """
+    index = np.fromfile(name + '.idx', dtype=SCORE_INDEX_DTYPE)
+    data = np.fromfile(name + '.bin', dtype=np.uint8)
+    out = []
+    for record, stage, num_scores, num_keep, offset in index:
+        keep_offset = offset + 2 * num_scores
+        out.append({
+            'record': int(record),
+            'stage': int(stage),
+            'score': data[offset:keep_offset].view(np.float16),
+            'keep': np.unpackbits(data[keep_offset:keep_offset + (num_keep + 7) // 8])[:num_keep].astype(bool),
+        })
+    return out
+
+
 class SoftTargetCrossEntropy_max(nn.Module):
 
     def __init__(self):
@@ -29,7 +29,7 @@ import torch.nn.functional as F
 import numpy as np
 import json
 
-from utils import batch_index_select
+from utils import batch_index_select, topk_keep_index, PosEmbedCache
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
@@ -239,10 +239,7 @@ class PatchEmbed(nn.Module):
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # any input size, the model resizes pos_embed to the (H // patch_size, W // patch_size) grid
         x = self.proj(x).flatten(2).transpose(1, 2)
         return x
 
@@ -408,6 +405,7 @@ class VisionTransformerDiffPruning(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_embed_cache = PosEmbedCache([i // p for i, p in zip(to_2tuple(img_size), to_2tuple(patch_size))])
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
@@ -457,6 +455,12 @@ class VisionTransformerDiffPruning(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token'}
 
+    def patch_grid(self, x):
+        """ (H, W) patch grid of the images x, any size is accepted and pos_embed is resized to it """
+        if not hasattr(self.patch_embed, 'patch_size'): # hybrid backbones keep their training grid
+            return self.pos_embed_cache.grid
+        return x.size(-2) // self.patch_embed.patch_size[0], x.size(-1) // self.patch_embed.patch_size[1]
+
     def get_classifier(self):
         return self.head
 
@@ -466,17 +470,18 @@ class VisionTransformerDiffPruning(nn.Module):
 
     def forward(self, x):
         B = x.shape[0]
+        grid = self.patch_grid(x)
         x = self.patch_embed(x)
 
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
-        x = x + self.pos_embed
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
         x = self.pos_drop(x)
 
         p_count = 0
         out_pred_prob = []
         score_dict = {}
-        init_n = 14 * 14
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
         prev_decision = torch.ones(B, init_n, 1, dtype=x.dtype, device=x.device)
         policy = torch.ones(B, init_n + 1, 1, dtype=x.dtype, device=x.device)
         for i, blk in enumerate(self.blocks):
@@ -494,7 +499,7 @@ class VisionTransformerDiffPruning(nn.Module):
                 else:
                     score = pred_score[:,:,0]
                     num_keep_node = int(init_n * self.token_ratio[p_count])
-                    keep_policy = torch.argsort(score, dim=1, descending=True)[:, :num_keep_node]
+                    keep_policy = topk_keep_index(score, num_keep_node)
                     cls_policy = torch.zeros(B, 1, dtype=keep_policy.dtype, device=keep_policy.device)
                     now_policy = torch.cat([cls_policy, keep_policy + 1], dim=1)
                     x = batch_index_select(x, now_policy)
@@ -27,7 +27,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from utils import batch_index_select
+from utils import batch_index_select, topk_keep_index, StagePolicy, PosEmbedCache
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
@@ -40,9 +40,45 @@ class PrunedLayer(nn.Module):
         self.params = nn.Parameter(torch.ones(1, unit_num), requires_grad=req_grad)
 
     def forward(self, x):
-        para = self.params.unsqueeze(0).repeat(x.shape[0], x.shape[1], 1) # 对数据维度进行扩充/沿着指定的维度重复tensor
-        #print('x.shape, para.shape',x.shape, para.shape) #（256，197，192）
-        return torch.mul(x, para) # see size of each x
+        # (1, C) broadcasts over the batch and token dims, no B x N x C copy of the mask
+        return x * self.params
+
+    def keep_index(self, threshold=0.):
+        """ channels whose mask value is larger than threshold in magnitude """
+        return (self.params[0].detach().abs() > threshold).nonzero()[:, 0]
+
+
+class ChannelSelect(nn.Module):
+    """ takes the index channels of the last dim, stands in for a PrunedLayer once slim() folded its mask into the next Linear """
+    def __init__(self, index):
+        super().__init__()
+        self.register_buffer('index', index)
+
+    def forward(self, x):
+        return x.index_select(-1, self.index)
+
+
+def channel_select(index, num_channels):
+    return nn.Identity() if len(index) == num_channels else ChannelSelect(index)
+
+
+def narrow_linear(linear, out_index=None, in_index=None, in_scale=None):
+    """ dense Linear made of the out_index rows and in_index columns of linear, the columns multiplied by in_scale """
+    weight = linear.weight.detach()
+    bias = linear.bias.detach() if linear.bias is not None else None
+    if out_index is not None:
+        weight = weight[out_index]
+        bias = bias[out_index] if bias is not None else None
+    if in_scale is not None:
+        weight = weight * in_scale.detach()
+    if in_index is not None:
+        weight = weight[:, in_index]
+    narrow = nn.Linear(weight.size(1), weight.size(0), bias=bias is not None).to(weight.device)
+    with torch.no_grad():
+        narrow.weight.copy_(weight)
+        if bias is not None:
+            narrow.bias.copy_(bias)
+    return narrow
 
 
 def _cfg(url='', **kwargs):
@@ -164,6 +200,18 @@ class Mlp(nn.Module):
         x = self.drop(x)
         return x
 
+    def slim(self, threshold=0.):
+        """ drop the input and hidden channels masked out by pruned_layer_3 / pruned_layer_4 and fold the
+        remaining mask values into the fc1 / fc2 columns. GELU is element-wise, so a masked hidden unit
+        only removes a row of fc1 and a column of fc2. """
+        in_index = self.pruned_layer_3.keep_index(threshold)
+        hidden_index = self.pruned_layer_4.keep_index(threshold)
+        in_features = self.fc1.in_features
+        self.fc1 = narrow_linear(self.fc1, hidden_index, in_index, self.pruned_layer_3.params[0])
+        self.fc2 = narrow_linear(self.fc2, None, hidden_index, self.pruned_layer_4.params[0])
+        self.pruned_layer_3 = channel_select(in_index, in_features)
+        self.pruned_layer_4 = nn.Identity()
+
 
 
 class Attention(nn.Module):
@@ -181,41 +229,54 @@ class Attention(nn.Module):
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
-    def softmax_with_policy(self, attn, policy, eps=1e-6):
-        B, N, _ = policy.size()
-        B, H, N, N = attn.size()
-        attn_policy = policy.reshape(B, 1, 1, N)  # * policy.reshape(B, 1, N, 1)
-        eye = torch.eye(N, dtype=attn_policy.dtype, device=attn_policy.device).view(1, 1, N, N)
-        attn_policy = attn_policy + (1.0 - attn_policy) * eye
-        max_att = torch.max(attn, dim=-1, keepdim=True)[0]
-        attn = attn - max_att # also for stable training
-        # attn = attn.exp_() * attn_policy
-        # return attn / attn.sum(dim=-1, keepdim=True)
-
-        # for stable training
-        attn = attn.to(torch.float32).exp_() * attn_policy.to(torch.float32)
-        attn = (attn + eps/N) / (attn.sum(dim=-1, keepdim=True) + eps)
-        return attn.type_as(max_att)
-
     def forward(self, x, policy):
+        # policy: StagePolicy of the current pruning stage, or None for plain softmax
         B, N, C = x.shape
         x = self.pruned_layer_1(x)  # prune 1d
-        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
-        q, k, v = qkv[0], qkv[1], qkv[2]   # make torchscript happy (cannot use tensor as tuple)
+        qkv = self.qkv(x)
+        # v is narrower than q / k once slim() dropped the channels masked by pruned_layer_2
+        q, k, v = qkv.split([C, C, qkv.size(-1) - 2 * C], dim=-1)
+        q = q.reshape(B, N, self.num_heads, -1).transpose(1, 2)
+        k = k.reshape(B, N, self.num_heads, -1).transpose(1, 2)
+        v = v.reshape(B, N, self.num_heads, -1).transpose(1, 2)
 
         attn = (q @ k.transpose(-2, -1)) * self.scale
 
         if policy is None:
             attn = attn.softmax(dim=-1)
         else:
-            attn = self.softmax_with_policy(attn, policy)
+            attn = policy.softmax(attn)
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+        x = (attn @ v).transpose(1, 2).reshape(B, N, -1)
         x = self.pruned_layer_2(x)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
+    def slim(self, threshold=0.):
+        """ drop the channels masked out by pruned_layer_1 (qkv input) and pruned_layer_2 (v / proj input)
+        and fold the remaining mask values into the qkv / proj columns
+
+        Every head keeps as many v channels as the head with the most unmasked ones, so the heads stay
+        the same size; the extra channels of the other heads get a zero proj column.
+        """
+        dim = self.qkv.in_features
+        head_dim = dim // self.num_heads
+        in_index = self.pruned_layer_1.keep_index(threshold)
+
+        v_keep = self.pruned_layer_2.params[0].detach().abs() > threshold
+        keep = v_keep.view(self.num_heads, head_dim)
+        v_dim = max(int(keep.sum(dim=1).max()), 1)
+        position = torch.arange(head_dim, device=keep.device)
+        order = torch.argsort((~keep).long() * head_dim + position, dim=1)[:, :v_dim] # unmasked channels first
+        v_index = (order + head_dim * torch.arange(self.num_heads, device=keep.device).view(-1, 1)).reshape(-1)
+
+        qk_index = torch.arange(2 * dim, device=keep.device)
+        self.qkv = narrow_linear(self.qkv, torch.cat([qk_index, 2 * dim + v_index]), in_index, self.pruned_layer_1.params[0])
+        self.proj = narrow_linear(self.proj, None, v_index, self.pruned_layer_2.params[0] * v_keep)
+        self.pruned_layer_1 = channel_select(in_index, dim)
+        self.pruned_layer_2 = nn.Identity()
+
 
 
 class Block(nn.Module):
@@ -238,6 +299,19 @@ class Block(nn.Module):
         return x
 
 
+def slim_channels(model, threshold=0.):
+    """ replace the PrunedLayer masks of every block by physically narrower Linears, in place
+
+    Channels whose mask value is at most threshold in magnitude are removed, the others are folded
+    into the weights, so the result computes the same function (exactly for threshold=0) as a dense
+    model with smaller weights.
+    """
+    for blk in model.blocks:
+        blk.attn.slim(threshold)
+        blk.mlp.slim(threshold)
+    return model
+
+
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
     """
@@ -253,10 +327,7 @@ class PatchEmbed(nn.Module):
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # any input size, the model resizes pos_embed to the (H // patch_size, W // patch_size) grid
         x = self.proj(x).flatten(2).transpose(1, 2)
         return x
 
@@ -377,6 +448,7 @@ class VisionTransformerDiffPruning(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_embed_cache = PosEmbedCache([i // p for i, p in zip(to_2tuple(img_size), to_2tuple(patch_size))])
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
@@ -426,6 +498,12 @@ class VisionTransformerDiffPruning(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token'}
 
+    def patch_grid(self, x):
+        """ (H, W) patch grid of the images x, any size is accepted and pos_embed is resized to it """
+        if not hasattr(self.patch_embed, 'patch_size'): # hybrid backbones keep their training grid
+            return self.pos_embed_cache.grid
+        return x.size(-2) // self.patch_embed.patch_size[0], x.size(-1) // self.patch_embed.patch_size[1]
+
     def get_classifier(self):
         return self.head
 
@@ -435,18 +513,20 @@ class VisionTransformerDiffPruning(nn.Module):
 
     def forward(self, x):
         B = x.shape[0]
+        grid = self.patch_grid(x)
         x = self.patch_embed(x)
 
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
-        x = x + self.pos_embed
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
         x = self.pos_drop(x) # [B, 196, 384]
 
         p_count = 0
         out_pred_prob = []
-        init_n = 14 * 14
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
         prev_decision = torch.ones(B, init_n, 1, dtype=x.dtype, device=x.device)
         policy = torch.ones(B, init_n + 1, 1, dtype=x.dtype, device=x.device)
+        stage_policy = StagePolicy(policy) # rebuilt only at pruning locations
         for i, blk in enumerate(self.blocks):
             if i in self.pruning_loc:
                 spatial_x = x[:, 1:]
@@ -456,12 +536,13 @@ class VisionTransformerDiffPruning(nn.Module):
                     out_pred_prob.append(hard_keep_decision.reshape(B, init_n))
                     cls_policy = torch.ones(B, 1, 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
                     policy = torch.cat([cls_policy, hard_keep_decision], dim=1)
-                    x = blk(x, policy=policy)
+                    stage_policy = StagePolicy(policy)
+                    x = blk(x, policy=stage_policy)
                     prev_decision = hard_keep_decision
                 else:
                     score = pred_score[:,:,0]
                     num_keep_node = int(init_n * self.token_ratio[p_count])
-                    keep_policy = torch.argsort(score, dim=1, descending=True)[:, :num_keep_node]
+                    keep_policy = topk_keep_index(score, num_keep_node)
                     cls_policy = torch.zeros(B, 1, dtype=keep_policy.dtype, device=keep_policy.device)
                     now_policy = torch.cat([cls_policy, keep_policy + 1], dim=1)
                     x = batch_index_select(x, now_policy)
@@ -470,7 +551,7 @@ class VisionTransformerDiffPruning(nn.Module):
                 p_count += 1
             else:
                 if self.training:
-                    x = blk(x, policy)
+                    x = blk(x, stage_policy)
                 else:
                     x = blk(x)
 
@@ -24,7 +24,7 @@ import torch.nn.functional as F
 import numpy as np
 import json
 
-from utils import batch_index_select
+from utils import batch_index_select, topk_keep_decision, PosEmbedCache
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
@@ -246,10 +246,7 @@ class PatchEmbed(nn.Module):
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # any input size, the model resizes pos_embed to the (H // patch_size, W // patch_size) grid
         x = self.proj(x).flatten(2).transpose(1, 2)
         return x
 
@@ -353,35 +350,28 @@ class MultiheadPredictorLG(nn.Module):
         self.out_conv = nn.ModuleList(out_conv_list)
 
     def forward(self, x, policy):
-
-        multihead_score = 0
-        multihead_softmax_score = 0
-        for i in range(self.num_heads):
-            x_single = x[:,:,self.embed_dim//self.num_heads*i:self.embed_dim//self.num_heads*(i+1)]   #([96, 196, 64])
-            x_single = self.in_conv[i](x_single)
-            B, N, C = x_single.size()       #([96, 196, 64])
-            local_x = x_single[:,:, :C//2]  #([96, 196, 32])
-            global_x = (x_single[:,:, C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 32])
-            x_single = torch.cat([local_x, global_x.expand(B, N, C//2)], dim=-1)  #([96, 196, 64])
-            x_single = self.out_conv[i](x_single) #([96, 196, 2])
-
-            # for placeholder
-            m = nn.Softmax(dim=-1)
-            score_softmax = m(x_single)
-            multihead_softmax_score += score_softmax
-
-            # for gumble
-            n = nn.LogSoftmax(dim=-1)
-            score_single = n(x_single)
-            multihead_score += score_single
+        # in_conv / out_conv repeat one shared module for every head, so all heads run as one batch
+        # on a (B, N, num_heads, C // num_heads) view instead of a python loop over the heads
+        B, N, C = x.size()
+        x = x.reshape(B, N, self.num_heads, C // self.num_heads)  #([96, 196, 6, 64])
+        x = self.in_conv[0](x)
+        C = x.size(-1)
+        policy = torch.unsqueeze(policy, dim=3)
+        local_x = x[..., :C//2]  #([96, 196, 6, 32])
+        global_x = (x[..., C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 6, 32])
+        # first out_conv layer split into its local and global halves, so the global half runs once per
+        # image and the (B, N, num_heads, C) concat is never built
+        fc = self.out_conv[0][0]
+        x = F.linear(local_x, fc.weight[:, :C//2], fc.bias) + F.linear(global_x, fc.weight[:, C//2:])
+        score = F.log_softmax(self.out_conv[0][1:](x), dim=-1)  #([96, 196, 6, 2])
 
         # for gumble
-        multihead_score = multihead_score / self.num_heads  # ([96, 196, 2])
+        multihead_score = score.mean(dim=2)  # ([96, 196, 2])
 
-        # for placeholder
-        multihead_softmax_score = multihead_softmax_score / self.num_heads  # get softmax keep/drop probability
+        # for placeholder, softmax taken from the log-softmax
+        multihead_softmax_score = score.exp().mean(dim=2)  # get softmax keep/drop probability
 
-        return multihead_score, multihead_softmax_score  #, represent_token, placeholder_weights, placeholder_score3
+        return multihead_score, multihead_softmax_score
 
 
 class VisionTransformerDiffPruning(nn.Module):
@@ -392,7 +382,7 @@ class VisionTransformerDiffPruning(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=True, qk_scale=None, representation_size=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0., hybrid_backbone=None, norm_layer=None,
-                 pruning_loc=None, token_ratio=None, distill=False):
+                 pruning_loc=None, token_ratio=None, distill=False, budget=None):
         """
         Args:
             img_size (int, tuple): input image size
@@ -411,6 +401,8 @@ class VisionTransformerDiffPruning(nn.Module):
             drop_path_rate (float): stochastic depth rate
             hybrid_backbone (nn.Module): CNN backbone to use in-place of PatchEmbed module
             norm_layer: (nn.Module): normalization layer
+            budget (str): None samples the keep decisions with gumbel softmax in eval, 'topk' keeps exactly
+                token_ratio of the tokens in every image so that all batches have the same keep counts
         """
         super().__init__()
 
@@ -431,6 +423,7 @@ class VisionTransformerDiffPruning(nn.Module):
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         #self.pre_token = nn.Parameter(torch.zeros(1, 1, embed_dim)) # 咱们多生成一个 pre_token
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_embed_cache = PosEmbedCache([i // p for i, p in zip(to_2tuple(img_size), to_2tuple(patch_size))])
         #self.pos_embed_re = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_drop = nn.Dropout(p=drop_rate)
 
@@ -463,6 +456,8 @@ class VisionTransformerDiffPruning(nn.Module):
 
         self.pruning_loc = pruning_loc
         self.token_ratio = token_ratio
+        assert budget in (None, 'topk')
+        self.budget = budget
 
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
@@ -481,6 +476,12 @@ class VisionTransformerDiffPruning(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token'}
 
+    def patch_grid(self, x):
+        """ (H, W) patch grid of the images x, any size is accepted and pos_embed is resized to it """
+        if not hasattr(self.patch_embed, 'patch_size'): # hybrid backbones keep their training grid
+            return self.pos_embed_cache.grid
+        return x.size(-2) // self.patch_embed.patch_size[0], x.size(-1) // self.patch_embed.patch_size[1]
+
     def get_classifier(self):
         return self.head
 
@@ -490,18 +491,19 @@ class VisionTransformerDiffPruning(nn.Module):
 
     def forward(self, x):
         B = x.shape[0]
+        grid = self.patch_grid(x)
         x = self.patch_embed(x)
 
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
 
-        x = x + self.pos_embed
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
 
         x = self.pos_drop(x)
 
         p_count = 0
         out_pred_prob = []
-        init_n = 14 * 14
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
         sparse = []
         score_dict = {}
         policy = torch.ones(B, init_n + 1, 1, dtype=x.dtype, device=x.device)
@@ -519,10 +521,16 @@ class VisionTransformerDiffPruning(nn.Module):
                 softmax_score = softmax_score.reshape(B, -1, 2)
                 #-------------------- 确定 informative token 和 placeholder 的 mask
                 if i == self.pruning_loc[0]:
-                    hard_keep_decision = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
+                    if not self.training and self.budget == 'topk':
+                        hard_keep_decision = topk_keep_decision(pred_score[:, :, 0], int(init_n * self.token_ratio[p_count]), prev_decision)
+                    else:
+                        hard_keep_decision = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
                     hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision) #  current drop decision
                 else:
-                    hard_keep_decision_all = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
+                    if not self.training and self.budget == 'topk': # representative tokens do not compete for the budget
+                        hard_keep_decision_all = torch.cat([topk_keep_decision(pred_score[:, :init_n, 0], int(init_n * self.token_ratio[p_count]), prev_decision[:, :init_n]), rep_decision], dim=1)
+                    else:
+                        hard_keep_decision_all = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
                     hard_keep_decision = torch.cat([hard_keep_decision_all[:,:-1], rep_decision], dim=1)
                     hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision)
                 ############### end
@@ -591,7 +599,7 @@ class VisionTransformerDiffPruning(nn.Module):
             with open(file, 'a') as f: # ins
                 json.dump(score_dict, f)
                 f.write('\n')
-            sparse = torch.FloatTensor(sparse).cuda()
+            sparse = torch.FloatTensor(sparse).to(x.device)
             return x, sparse.detach()
 
 class VisionTransformerTeacher(nn.Module):
@@ -22,9 +22,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
-import json
 
-from utils import batch_index_select
+from utils import batch_index_select, gumbel_keep_decision, topk_keep_index, threshold_keep_decision, StagePolicy, compact_keep_order, pack_tokens, unpack_tokens, policy_sparsity, PruningTelemetry, ScoreLog, chunked_attention, PosEmbedCache, rebucket_tokens, unbucket_tokens, PruningStage
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
@@ -34,7 +33,9 @@ import os
 
 _logger = logging.getLogger(__name__)
 
-file = 'score_placeholder.json'
+scaled_dot_product_attention = getattr(F, 'scaled_dot_product_attention', None) # torch >= 2.0
+
+score_log = ScoreLog('score_placeholder') # sampled keep scores / decisions of the eval forwards
 
 
 def _cfg(url='', **kwargs):
@@ -164,36 +165,59 @@ class Attention(nn.Module):
         self.attn_drop = nn.Dropout(attn_drop)
         self.proj = nn.Linear(dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
-
-    def softmax_with_policy(self, attn, policy, eps=1e-6):
-        B, N, _ = policy.size()
-        B, H, N, N = attn.size()
-        attn_policy = policy.reshape(B, 1, 1, N)  # * policy.reshape(B, 1, N, 1)
-        eye = torch.eye(N, dtype=attn_policy.dtype, device=attn_policy.device).view(1, 1, N, N)
-        attn_policy = attn_policy + (1.0 - attn_policy) * eye
-        max_att = torch.max(attn, dim=-1, keepdim=True)[0]
-        attn = attn - max_att
-
-        attn = attn.to(torch.float32).exp_() * attn_policy.to(torch.float32)
-        attn = (attn + eps/N) / (attn.sum(dim=-1, keepdim=True) + eps)
-        return attn.type_as(max_att)
+        self.chunk_size = None # eval only: attention in blocks of chunk_size queries x keys, see chunked_attention
 
     def forward(self, x, policy):
+        # policy: StagePolicy of the current pruning stage, or None for plain softmax
         B, N, C = x.shape
         qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         #with torch.cuda.amp.autocast(enabled=False):
         q, k, v = qkv[0].float(), qkv[1].float(), qkv[2].float()   # make torchscript happy (cannot use tensor as tuple)
+        chunk_size = None if self.training else self.chunk_size
 
-        attn = (q @ k.transpose(-2, -1)) * self.scale
-
-        if policy is None:
-                attn = attn.softmax(dim=-1)
-        elif not self.training:
-                attn = self.softmax_with_policy(attn, policy, 0)
+        if policy is not None and policy.live_rows:
+            x = policy.live_attention(q * self.scale, k, v, 1e-6 if self.training else 0, chunk_size=chunk_size)
+        elif chunk_size:
+            x = chunked_attention(q * self.scale, k, v, policy, chunk_size)
         else:
-                attn = self.softmax_with_policy(attn, policy, 1e-6)
+            attn = (q @ k.transpose(-2, -1)) * self.scale
 
-        x = (attn @ v).transpose(1, 2).reshape(B, N, C)
+            if policy is None:
+                    attn = attn.softmax(dim=-1)
+            elif not self.training:
+                    attn = policy.softmax(attn, 0)
+            else:
+                    attn = policy.softmax(attn, 1e-6)
+            x = attn @ v
+
+        x = x.transpose(1, 2).reshape(B, N, C)
+
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+    def forward_packed(self, x, mask, index):
+        """ x: (T, C) tokens of all images packed back to back, mask / index: see pack_tokens.
+        Each image only attends to its own tokens. qkv and proj run on the packed rows, the attention
+        of all images is one batched matmul: the qkv rows are scattered to their (B, N) slots and the
+        empty slots are masked out as keys, their query rows are dropped again by the gather.
+        """
+        T, C = x.shape
+        B, N = mask.shape
+        qkv = self.qkv(x)
+        qkv = qkv.new_zeros(B * N, 3 * C).index_copy_(0, index, qkv)
+        qkv = qkv.reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0].float(), qkv[1].float(), qkv[2].float()   # (B, heads, N, head_dim)
+
+        key_mask = mask.reshape(B, 1, 1, N)
+        if scaled_dot_product_attention is not None:
+            # fused kernel, it scales by head_dim ** -0.5 itself
+            x = scaled_dot_product_attention(q * (self.scale * q.size(-1) ** 0.5), k, v, attn_mask=key_mask)
+        else:
+            attn = (q @ k.transpose(-2, -1)) * self.scale
+            attn = attn.masked_fill(~key_mask, float('-inf')).softmax(dim=-1)
+            x = attn @ v
+        x = x.transpose(1, 2).reshape(B * N, C).index_select(0, index).type_as(qkv)
 
         x = self.proj(x)
         x = self.proj_drop(x)
@@ -218,18 +242,30 @@ class Block(nn.Module):
 
         if i is None:  # first 3 layers, no need to save rep. token for placeholder
             x = x + self.drop_path(self.attn(self.norm1(x), policy=policy))
-            x = x + self.drop_path(self.mlp(self.norm2(x)))
+            x = x + self.drop_path(self.forward_mlp(x, policy))
             return x
         else:
             x_1 = self.drop_path(self.attn(self.norm1(x), policy=policy))
             rep_1 = x_1[:,-1:]   # output rep token of MSA [96, 1, 384]
             x = x + x_1   #skip connection
 
-            x_2 = self.drop_path(self.mlp(self.norm2(x)))
+            x_2 = self.drop_path(self.forward_mlp(x, policy))
             rep_2 = x_2[:, -1:]   # output rep token of FFN [96, 1, 384]
             x = x + x_2
             return x, rep_1, rep_2
 
+    def forward_mlp(self, x, policy):
+        if policy is not None and policy.live_mlp:
+            # dropped tokens get no MLP update, their outputs are never used
+            return policy.live_tokens(lambda t: self.mlp(self.norm2(t)), x)
+        return self.mlp(self.norm2(x))
+
+    def forward_packed(self, x, mask, index):
+        # LayerNorm and MLP are token-wise, so they run directly on the packed rows
+        x = x + self.drop_path(self.attn.forward_packed(self.norm1(x), mask, index))
+        x = x + self.drop_path(self.mlp(self.norm2(x)))
+        return x
+
 
 class PatchEmbed(nn.Module):
     """ Image to Patch Embedding
@@ -246,10 +282,7 @@ class PatchEmbed(nn.Module):
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # any input size, the model resizes pos_embed to the (H // patch_size, W // patch_size) grid
         x = self.proj(x).flatten(2).transpose(1, 2)
         return x
 
@@ -361,46 +394,33 @@ class MultiheadPredictorLG(nn.Module):
         self.out_conv = nn.ModuleList(out_conv_list)
 
     def forward(self, x, policy):
-
-        multihead_score = 0
-        multihead_softmax_score = 0
-
-        _, n, _ = x.size()
-        a = nn.AdaptiveAvgPool2d((n, self.num_heads)) #pooling
-        x_head = a(x)   #([64, 196, 6])
-
-        head_weights = self.senet(x_head)
-        head_weights_sum = torch.sum(head_weights, dim=2)
-        head_weights_sum = torch.unsqueeze(head_weights_sum, dim=2)  #([64, 196, 1])
-
-        for i in range(self.num_heads):
-            x_single = x[:,:,self.embed_dim//self.num_heads*i:self.embed_dim//self.num_heads*(i+1)]   #([96, 196, 64])
-            x_single = self.in_conv[i](x_single)
-            B, N, C = x_single.size()       #([96, 196, 64])
-            local_x = x_single[:,:, :C//2]  #([96, 196, 32])
-            global_x = (x_single[:,:, C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 32])
-            x_single = torch.cat([local_x, global_x.expand(B, N, C//2)], dim=-1)  #([96, 196, 64])
-            x_single = self.out_conv[i](x_single) #([96, 196, 2])
-
-            # for placeholder
-            m = nn.Softmax(dim=-1)
-            score_softmax = m(x_single)
-            score_softmax = score_softmax * head_weights[:, :, i:i + 1]  # [64, 196, 2]
-            multihead_softmax_score += score_softmax
-
-            # for gumble
-            n = nn.LogSoftmax(dim=-1)
-            score_single = n(x_single)
-            score_single = score_single * head_weights[:, :, i:i + 1]  # [64, 196, 2]
-            multihead_score += score_single
-
-        # for placeholder
-        multihead_softmax_score = multihead_softmax_score / head_weights_sum
+        # in_conv / out_conv repeat one shared module for every head, so all heads run as one batch
+        # on a (B, N, num_heads, C // num_heads) view instead of a python loop over the heads
+        B, N, C = x.size()
+        x = x.reshape(B, N, self.num_heads, C // self.num_heads)  #([96, 196, 6, 64])
+
+        head_weights = self.senet(x.mean(dim=-1))  # same as AdaptiveAvgPool2d((N, num_heads)), ([64, 196, 6])
+        head_weights = torch.unsqueeze(head_weights, dim=3)  #([64, 196, 6, 1])
+        head_weights_sum = torch.sum(head_weights, dim=2)  #([64, 196, 1])
+
+        x = self.in_conv[0](x)
+        C = x.size(-1)
+        policy = torch.unsqueeze(policy, dim=3)
+        local_x = x[..., :C//2]  #([96, 196, 6, 32])
+        global_x = (x[..., C//2:] * policy).sum(dim=1, keepdim=True) / torch.sum(policy, dim=1, keepdim=True)  #([96, 1, 6, 32])
+        # first out_conv layer split into its local and global halves, so the global half runs once per
+        # image and the (B, N, num_heads, C) concat is never built
+        fc = self.out_conv[0][0]
+        x = F.linear(local_x, fc.weight[:, :C//2], fc.bias) + F.linear(global_x, fc.weight[:, C//2:])
+        score = F.log_softmax(self.out_conv[0][1:](x), dim=-1)  #([96, 196, 6, 2])
 
         # for gumble
-        multihead_score = multihead_score / head_weights_sum  # ([96, 196, 2])
+        multihead_score = torch.sum(score * head_weights, dim=2) / head_weights_sum  # ([96, 196, 2])
+
+        # for placeholder, softmax taken from the log-softmax
+        multihead_softmax_score = torch.sum(score.exp() * head_weights, dim=2) / head_weights_sum
 
-        return multihead_score, multihead_softmax_score  #, represent_token, placeholder_weights, placeholder_score3
+        return multihead_score, multihead_softmax_score
 
 
 class VisionTransformerDiffPruning(nn.Module):
@@ -411,7 +431,9 @@ class VisionTransformerDiffPruning(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=True, qk_scale=None, representation_size=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0., hybrid_backbone=None, norm_layer=None,
-                 pruning_loc=None, token_ratio=None, distill=False):
+                 pruning_loc=None, token_ratio=None, distill=False, inference_mode='mask', budget=None,
+                 live_attention=False, live_mlp=False, attn_chunk_size=None, keep_threshold=None,
+                 rebucket=None):
         """
         Args:
             img_size (int, tuple): input image size
@@ -430,6 +452,21 @@ class VisionTransformerDiffPruning(nn.Module):
             drop_path_rate (float): stochastic depth rate
             hybrid_backbone (nn.Module): CNN backbone to use in-place of PatchEmbed module
             norm_layer: (nn.Module): normalization layer
+            inference_mode (str): 'mask' keeps all tokens and masks attention with the policy in eval,
+                'compact' gathers cls + kept + representative tokens into a smaller tensor after each pruning location,
+                'packed' additionally packs the tokens of all images into one sequence so no padding is computed
+            budget (str): None samples the keep decisions with gumbel softmax in eval, 'topk' keeps exactly
+                token_ratio of the tokens in every image so that all batches have the same keep counts,
+                'threshold' keeps the tokens whose keep score reaches keep_threshold, so the keep count follows the image
+            live_attention (bool): without autograd, only compute the attention rows of cls, kept and representative
+                tokens after each pruning location, dropped tokens just keep their own value
+            live_mlp (bool): without autograd, only run LayerNorm + MLP on cls, kept and representative tokens after each pruning location
+            attn_chunk_size (int): in eval, compute the attention in blocks of attn_chunk_size queries x keys with an
+                online softmax, so the memory grows linearly with the number of tokens (None: full attention)
+            keep_threshold (list): per stage keep score threshold of budget='threshold', see calibrate_keep_thresholds
+            rebucket (int): in the padded compact forward, sort the images by keep count after every pruning location
+                and run the blocks up to the next one in buckets of rebucket images, each padded to its own largest
+                keep count (None: one batch padded to the largest keep count of all images)
         """
         super().__init__()
 
@@ -449,6 +486,7 @@ class VisionTransformerDiffPruning(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_embed_cache = PosEmbedCache([i // p for i, p in zip(to_2tuple(img_size), to_2tuple(patch_size))])
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
@@ -475,11 +513,23 @@ class VisionTransformerDiffPruning(nn.Module):
         predictor_list = [MultiheadPredictorLG(num_heads,embed_dim) for _ in range(len(pruning_loc))]
 
         self.score_predictor = nn.ModuleList(predictor_list)
+        self.pruning_stage = PruningStage()
 
         self.distill = distill
 
         self.pruning_loc = pruning_loc
         self.token_ratio = token_ratio
+        assert budget in (None, 'topk', 'threshold')
+        self.budget = budget
+        self.keep_threshold = keep_threshold
+        self.budget_table = {}
+        self.rebucket = rebucket
+        self.live_attention = live_attention
+        self.live_mlp = live_mlp
+        self.attn_chunk_size = attn_chunk_size
+
+        assert inference_mode in ('mask', 'compact', 'packed')
+        self.inference_mode = inference_mode
 
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
@@ -498,6 +548,43 @@ class VisionTransformerDiffPruning(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token'}
 
+    def patch_grid(self, x):
+        """ (H, W) patch grid of the images x, any size is accepted and pos_embed is resized to it """
+        if not hasattr(self.patch_embed, 'patch_size'): # hybrid backbones keep their training grid
+            return self.pos_embed_cache.grid
+        return x.size(-2) // self.patch_embed.patch_size[0], x.size(-1) // self.patch_embed.patch_size[1]
+
+    @property
+    def attn_chunk_size(self):
+        return self._attn_chunk_size
+
+    @attn_chunk_size.setter
+    def attn_chunk_size(self, chunk_size):
+        self._attn_chunk_size = chunk_size
+        for m in self.modules():
+            if isinstance(m, Attention):
+                m.chunk_size = chunk_size
+
+    def set_budget(self, budget='topk', token_ratio=None, threshold=None):
+        """ switch the eval keep budget without rebuilding the model
+
+        budget is None, 'topk', 'threshold' or the name of a budget_table entry
+        ({'token_ratio': [...], 'threshold': [...]}, see infer.py --calibrate-budgets), which
+        selects the 'threshold' budget with that entry's precomputed thresholds.
+        """
+        if budget in self.budget_table:
+            entry = self.budget_table[budget]
+            budget, token_ratio, threshold = 'threshold', entry['token_ratio'], entry['threshold']
+        assert budget in (None, 'topk', 'threshold'), 'unknown budget {}'.format(budget)
+        if token_ratio is not None:
+            assert len(token_ratio) == len(self.pruning_loc), 'need one keep ratio per pruning stage'
+            self.token_ratio = list(token_ratio)
+        if threshold is not None:
+            assert len(threshold) == len(self.pruning_loc), 'need one threshold per pruning stage'
+            self.keep_threshold = list(threshold)
+        assert budget != 'threshold' or self.keep_threshold is not None, 'budget threshold needs keep_threshold'
+        self.budget = budget
+
     def get_classifier(self):
         return self.head
 
@@ -506,91 +593,61 @@ class VisionTransformerDiffPruning(nn.Module):
         self.head = nn.Linear(self.embed_dim, num_classes) if num_classes > 0 else nn.Identity()
 
     def forward(self, x):
+        if not self.training and self.inference_mode != 'mask':
+            # with the topk budget there is no padding left for packing to skip
+            return self.forward_compact(x, packed=self.inference_mode == 'packed' and self.budget != 'topk')
+
         B= x.shape[0]
+        grid = self.patch_grid(x)
         x = self.patch_embed(x)
 
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
 
-        x = x + self.pos_embed
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
 
         x = self.pos_drop(x)
 
         p_count = 0
         out_pred_prob = []
-        init_n = 14 * 14
-        sparse = []
-        score_dict = {}
-        policy = torch.ones(B, init_n + 1, 1, dtype=x.dtype, device=x.device)
-
-        prev_decision = torch.ones(B, init_n, 1, dtype=x.dtype, device=x.device)
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
+        telemetry = PruningTelemetry()
+        record = [] if not self.training and score_log.sample() else None
+        # cls, spatial and all rep tokens, every stage writes its keep decision over the spatial entries
+        policy = torch.ones(B, 1 + init_n + len(self.pruning_loc), 1, dtype=x.dtype, device=x.device)
+        stage_policy = StagePolicy(policy[:, :init_n + 1]) # rebuilt only at pruning locations
 
         for i, blk in enumerate(self.blocks):
-            if math.isnan(x.mean()):
-                print('hello****')
-                print('blk num',i)
             if i in self.pruning_loc:
                 spatial_x = x[:, 1:]
-                if i != self.pruning_loc[0]:
-                    rep_decision = torch.ones(B, p_count, 1, dtype=x.dtype, device=x.device)
-                    prev_decision = torch.cat([prev_decision, rep_decision], dim=1)
+                prev_decision = policy[:, 1:1 + init_n + p_count] # the rep tokens are always kept
                 pred_score, softmax_score = self.score_predictor[p_count](spatial_x, prev_decision)
                 pred_score = pred_score.reshape(B, -1, 2)
                 softmax_score = softmax_score.reshape(B, -1, 2)
-                #-------------------- 确定 informative token 和 placeholder 的 mask
-                if i == self.pruning_loc[0]:
-                    hard_keep_decision = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
-                    hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision) #  current drop decision
-                else:
-                    hard_keep_decision_all = F.gumbel_softmax(pred_score, hard=True)[:, :, 0:1] *  prev_decision
-                    hard_keep_decision = torch.cat([hard_keep_decision_all[:,:-p_count], rep_decision], dim=1)
-                    hard_drop_decision = (1 - hard_keep_decision) - (1 - prev_decision)
-                ############### end
-
-                ###get representative token  (regularization)
-                softmax_score = softmax_score[:, :, 0:1]  # softmax score of all tokens to keep
-                placeholder_score = softmax_score * hard_drop_decision  #keep score of only placeholder tokens
-                x2 = spatial_x * placeholder_score  # placehoder score [96, 196, 384]
-                x2_sum = torch.sum(x2, dim=1)  # sum by the N dimension, output (B,N,C)-->(B,C) [96, 384]
-                x2_sum = torch.unsqueeze(x2_sum, dim=1)  # resize to (B,1,C)  [96, 1, 384]
-                #--------------------
-                # placeholder_score_sum = torch.sum(placeholder_score, dim=1)  # sum of token score, [96, 196, 1]-->[96, 1]
-                # placeholder_score_sum = torch.unsqueeze(placeholder_score_sum, dim=1)  # resize to [96, 1, 1]
-                #--------------------
-
-                represent_token = x2_sum   #/ (placeholder_score_sum)
-
-                rep_mean = represent_token.mean()
-                if torch.isnan(rep_mean):
-                    print('has nan')
-                    represent_token = torch.nan_to_num(represent_token, nan = 1e-8)
+                threshold = self.keep_threshold[p_count] if self.budget == 'threshold' else None
+                hard_keep_decision, represent_token = self.pruning_stage(
+                    spatial_x, pred_score, softmax_score, prev_decision, init_n, self.budget,
+                    int(init_n * self.token_ratio[p_count]), threshold)
+                represent_token = score_log.nan_to_num(represent_token, nan = 1e-8)
 
                 x = torch.cat((x,represent_token), dim=1)
-                if i != self.pruning_loc[0]:
-                    hard_keep_decision = hard_keep_decision[:,:-p_count]
+                policy, stage_mask = self.pruning_stage.policy(policy, hard_keep_decision, p_count + 1)
+                stage_policy = StagePolicy(stage_mask, self.live_attention, self.live_mlp)
+                x = blk(x, policy=stage_policy)   #when i=None, means no output rep. token. Such as first 3 layers.
+                prev_decision = hard_keep_decision
 
                 if self.training:
                     out_pred_prob.append(hard_keep_decision.reshape(B, init_n))
-                    cls_policy = torch.ones(B, 1, 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    rep_policy = torch.ones(B, (p_count + 1), 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    policy = torch.cat([cls_policy, hard_keep_decision, rep_policy], dim=1)
-                    x = blk(x, policy=policy)   #when i=None, means no output rep. token. Such as first 3 layers.
-                    prev_decision = hard_keep_decision
                 else:
-                    cls_policy = torch.ones(B, 1,1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    rep_policy = torch.ones(B, (p_count + 1), 1, dtype=hard_keep_decision.dtype, device=hard_keep_decision.device)
-                    policy = torch.cat([cls_policy, hard_keep_decision, rep_policy], dim=1)
-                    x = blk(x, policy=policy)   #when i=None, means no output rep. token. Such as first 3 layers.
-                    prev_decision = hard_keep_decision
-                    zeros, unzeros = test_irregular_sparsity(p_count, policy)
-                    sparse.append([zeros, unzeros])
-                    score = pred_score[:, :, 0:1].cpu().numpy().tolist()
-                    score_dict[p_count] = score[0]
+                    telemetry.add_stage(policy_sparsity(stage_mask), (hard_keep_decision > 0.5).sum(dim=(1, 2)), init_n, represent_token,
+                                        hard_keep_decision[:, :, 0])
+                    if record is not None:
+                        record.append((pred_score[0, :, 0], hard_keep_decision[0, :, 0]))
                 p_count += 1
 
             ### first 3 layers. No rep token, placeholder, etc.
             else:
-                x = blk(x, policy)
+                x = blk(x, stage_policy)
             ############### end
 
         x = self.norm(x)
@@ -605,11 +662,129 @@ class VisionTransformerDiffPruning(nn.Module):
             else:
                 return x, out_pred_prob
         else:
-            with open(file, 'a') as f: # ins
-                json.dump(score_dict, f)
-                f.write('\n')
-            sparse = torch.FloatTensor(sparse).cuda()
-            return x, sparse.detach()
+            if record:
+                score_log.append(record) # written by the background thread
+            return x, telemetry
+
+    def forward_compact(self, x, packed=False):
+        """ eval forward that physically removes the dropped tokens
+
+        After every pruning location the kept tokens are gathered (in spatial order) in front
+        of the old representative tokens, so the following blocks only see cls + kept + rep tokens.
+        Images that keep fewer tokens than the batch maximum are padded and the padding is masked
+        by the policy. With packed=True the blocks instead run on the tokens of all images packed
+        into one (T, C) sequence, so the cost of the linear layers follows the total number of kept
+        tokens rather than B x max_keep. The attention runs batched on the padded slots, with the
+        empty slots masked out as keys. Decisions, cls output and sparsity match the masked forward.
+        With budget='topk' every image keeps the same number of tokens and the blocks run unmasked.
+        With self.rebucket the padded batch is split into buckets of images with similar keep counts
+        after every pruning location (rebucket_tokens) and merged back for the next keep decision.
+        """
+        B = x.shape[0]
+        grid = self.patch_grid(x)
+        x = self.patch_embed(x)
+
+        cls_tokens = self.cls_token.expand(B, -1, -1)
+        x = torch.cat((cls_tokens, x), dim=1)
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
+        x = self.pos_drop(x)
+
+        p_count = 0
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
+        telemetry = PruningTelemetry()
+        record = [] if score_log.sample() else None
+        policy = None
+        stage_policy = None
+        buckets = None
+        prev_decision = torch.ones(B, init_n, 1, dtype=x.dtype, device=x.device)
+        keep_index = torch.arange(init_n, device=x.device).view(1, init_n).expand(B, init_n) # original position of each compact token
+
+        for i, blk in enumerate(self.blocks):
+            if i in self.pruning_loc:
+                if packed and policy is not None:
+                    x = unpack_tokens(x, pack_mask, pack_index)
+                if buckets is not None: # the predictor and the keep decision run on the whole batch again
+                    x, buckets = unbucket_tokens([b[:2] for b in buckets], keep_index.size(1), p_count), None
+                num_slots = keep_index.size(1)
+                spatial_x = x[:, 1:]
+                if i != self.pruning_loc[0]:
+                    rep_decision = torch.ones(B, p_count, 1, dtype=x.dtype, device=x.device)
+                    prev_decision = torch.cat([prev_decision, rep_decision], dim=1)
+                    rep_index = torch.arange(init_n, init_n + p_count, device=x.device).view(1, p_count).expand(B, p_count)
+                    noise_index = torch.cat([keep_index, rep_index], dim=1)
+                else:
+                    noise_index = None
+                pred_score, softmax_score = self.score_predictor[p_count](spatial_x, prev_decision)
+                pred_score = pred_score.reshape(B, -1, 2)
+                softmax_score = softmax_score.reshape(B, -1, 2)
+
+                # rep tokens are always kept, only the spatial slots can be dropped
+                if self.budget == 'topk':
+                    # every image keeps the same number of tokens, so there is no padding slot to exclude
+                    num_keep_node = int(init_n * self.token_ratio[p_count])
+                    order = topk_keep_index(pred_score[:, :num_slots, 0], num_keep_node, keep_index)
+                    hard_keep_decision = torch.zeros_like(prev_decision[:, :num_slots]).scatter_(1, order.unsqueeze(-1), 1.0)
+                elif self.budget == 'threshold':
+                    hard_keep_decision = threshold_keep_decision(pred_score[:, :num_slots, 0], self.keep_threshold[p_count], prev_decision[:, :num_slots])
+                else:
+                    hard_keep_decision = gumbel_keep_decision(pred_score, noise_index, init_n + p_count) * prev_decision
+                    hard_keep_decision = hard_keep_decision[:, :num_slots]
+                represent_token = self.pruning_stage.representative_token(spatial_x, softmax_score, hard_keep_decision, prev_decision)
+                represent_token = score_log.nan_to_num(represent_token, nan = 1e-8)
+
+                if self.budget == 'topk':
+                    num_keep = torch.full((B,), num_keep_node, device=x.device)
+                else:
+                    order, num_keep = compact_keep_order(hard_keep_decision)
+                x = torch.cat([x[:, :1], batch_index_select(spatial_x[:, :num_slots], order), spatial_x[:, num_slots:], represent_token], dim=1)
+                if record is not None: # scores and decisions at the original token positions, like the masked forward
+                    slot_index = noise_index[0] if noise_index is not None else keep_index[0]
+                    score = pred_score.new_full((init_n + p_count,), float('nan')).scatter(0, slot_index, pred_score[0, :, 0])
+                    keep = hard_keep_decision.new_zeros(init_n).scatter(0, keep_index[0], hard_keep_decision[0, :, 0])
+                    record.append((score, keep))
+                keep_index = batch_index_select(keep_index, order)
+                prev_decision = batch_index_select(hard_keep_decision, order)
+
+                if self.budget == 'topk':
+                    policy = stage_policy = None # nothing to mask, every slot holds a kept token
+                else:
+                    policy = x.new_ones(B, 1 + prev_decision.size(1) + p_count + 1, 1)
+                    policy = self.pruning_stage.policy(policy, prev_decision, p_count + 1)[1]
+                    stage_policy = StagePolicy(policy, self.live_attention, self.live_mlp)
+                if packed:
+                    x, pack_mask, pack_index = pack_tokens(x, policy)
+                    x = blk.forward_packed(x, pack_mask, pack_index)
+                elif self.rebucket and policy is not None and B > self.rebucket:
+                    buckets = [(index, x_b, StagePolicy(policy_b, self.live_attention, self.live_mlp))
+                               for index, x_b, policy_b in rebucket_tokens(x, policy, num_keep, self.rebucket)]
+                    buckets = [(index, blk(x_b, policy=policy_b), policy_b) for index, x_b, policy_b in buckets]
+                else:
+                    x = blk(x, policy=stage_policy)
+
+                # same counts as policy_sparsity on the full-length policy of the masked forward
+                unzeros = num_keep.sum().float() + B * (p_count + 2)
+                keep = prev_decision.new_zeros(B, init_n).scatter(1, keep_index, prev_decision[:, :, 0]) # padding slots hold dropped tokens
+                telemetry.add_stage(torch.stack([B * (init_n + p_count + 2) - unzeros, unzeros]), num_keep, init_n, represent_token, keep)
+                p_count += 1
+            elif packed and policy is not None:
+                x = blk.forward_packed(x, pack_mask, pack_index)
+            elif buckets is not None:
+                buckets = [(index, blk(x_b, policy_b), policy_b) for index, x_b, policy_b in buckets]
+            else:
+                x = blk(x, stage_policy)
+
+        if packed and policy is not None:
+            x = unpack_tokens(x, pack_mask, pack_index)
+        if buckets is not None:
+            x = unbucket_tokens([b[:2] for b in buckets], keep_index.size(1), p_count)
+        x = self.norm(x)
+        x = x[:, 0]
+        x = self.pre_logits(x)
+        x = self.head(x)
+
+        if record:
+            score_log.append(record)
+        return x, telemetry
 
 class VisionTransformerTeacher(nn.Module):
     """ Vision Transformer
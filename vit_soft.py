@@ -28,7 +28,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
-from utils import batch_index_select
+from utils import batch_index_select, topk_keep_index, PosEmbedCache
 
 from timm.data import IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
 from timm.models.layers import DropPath, to_2tuple, trunc_normal_
@@ -237,10 +237,7 @@ class PatchEmbed(nn.Module):
         self.proj = nn.Conv2d(in_chans, embed_dim, kernel_size=patch_size, stride=patch_size)
 
     def forward(self, x):
-        B, C, H, W = x.shape
-        # FIXME look at relaxing size constraints
-        assert H == self.img_size[0] and W == self.img_size[1], \
-            f"Input image size ({H}*{W}) doesn't match model ({self.img_size[0]}*{self.img_size[1]})."
+        # any input size, the model resizes pos_embed to the (H // patch_size, W // patch_size) grid
         x = self.proj(x).flatten(2).transpose(1, 2)
         return x
 
@@ -345,7 +342,7 @@ class VisionTransformerDiffPruning(nn.Module):
     def __init__(self, img_size=224, patch_size=16, in_chans=3, num_classes=1000, embed_dim=768, depth=12,
                  num_heads=12, mlp_ratio=4., qkv_bias=True, qk_scale=None, representation_size=None,
                  drop_rate=0., attn_drop_rate=0., drop_path_rate=0., hybrid_backbone=None, norm_layer=None, 
-                 pruning_loc=None, token_ratio=None, distill=False):
+                 pruning_loc=None, token_ratio=None, distill=False, budget=None):
         """
         Args:
             img_size (int, tuple): input image size
@@ -364,6 +361,8 @@ class VisionTransformerDiffPruning(nn.Module):
             drop_path_rate (float): stochastic depth rate
             hybrid_backbone (nn.Module): CNN backbone to use in-place of PatchEmbed module
             norm_layer: (nn.Module): normalization layer
+            budget (str): None keeps the tokens above the learned threshold at inference, 'topk' keeps
+                exactly token_ratio of the tokens in every image so that all batches have the same shapes
         """
         super().__init__()
 
@@ -382,6 +381,7 @@ class VisionTransformerDiffPruning(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim))
+        self.pos_embed_cache = PosEmbedCache([i // p for i, p in zip(to_2tuple(img_size), to_2tuple(patch_size))])
         self.pos_drop = nn.Dropout(p=drop_rate)
 
         dpr = [x.item() for x in torch.linspace(0, drop_path_rate, depth)]  # stochastic depth decay rule
@@ -413,6 +413,8 @@ class VisionTransformerDiffPruning(nn.Module):
 
         self.pruning_loc = pruning_loc
         self.token_ratio = token_ratio
+        assert budget in (None, 'topk')
+        self.budget = budget
 
         trunc_normal_(self.pos_embed, std=.02)
         trunc_normal_(self.cls_token, std=.02)
@@ -431,6 +433,12 @@ class VisionTransformerDiffPruning(nn.Module):
     def no_weight_decay(self):
         return {'pos_embed', 'cls_token'}
 
+    def patch_grid(self, x):
+        """ (H, W) patch grid of the images x, any size is accepted and pos_embed is resized to it """
+        if not hasattr(self.patch_embed, 'patch_size'): # hybrid backbones keep their training grid
+            return self.pos_embed_cache.grid
+        return x.size(-2) // self.patch_embed.patch_size[0], x.size(-1) // self.patch_embed.patch_size[1]
+
     def get_classifier(self):
         return self.head
 
@@ -440,17 +448,18 @@ class VisionTransformerDiffPruning(nn.Module):
 
     def forward(self, x):
         B = x.shape[0]
+        grid = self.patch_grid(x)
         x = self.patch_embed(x)
         # print(x.shape) [72, 196, 384]
 
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
-        x = x + self.pos_embed
+        x = x + self.pos_embed_cache(self.pos_embed, grid)
         x = self.pos_drop(x)
 
         p_count = 0
         out_pred_prob = []
-        init_n = 14 * 14
+        init_n = x.size(1) - 1 # patch tokens, the grid follows the input size
         sparse = []
 
         prev_decision = torch.ones(B, init_n, 1, dtype=x.dtype, device=x.device)
@@ -465,6 +474,16 @@ class VisionTransformerDiffPruning(nn.Module):
                     policy = torch.cat([cls_policy, curent_mask], dim=1)
                     x = blk(x, policy=policy)
                     prev_decision = curent_mask
+                elif self.budget == 'topk':
+                    num_keep_node = int(init_n * self.token_ratio[p_count])
+                    keep_policy = topk_keep_index(pred_score[:, :, 0], num_keep_node)
+                    cls_policy = torch.zeros(B, 1, dtype=keep_policy.dtype, device=keep_policy.device)
+                    now_policy = torch.cat([cls_policy, keep_policy + 1], dim=1)
+                    x = batch_index_select(x, now_policy)
+                    prev_decision = batch_index_select(prev_decision, keep_policy)
+                    unzeros = B * (num_keep_node + 1) * x.shape[2]
+                    sparse.append([B * (init_n + 1) * x.shape[2] - unzeros, unzeros])
+                    x = blk(x)
                 else:
                     cls_policy = torch.ones(B, 1, 1, dtype=curent_mask.dtype, device=curent_mask.device)
                     now_policy = torch.cat([cls_policy, curent_mask], dim=1)